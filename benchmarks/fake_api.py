@@ -0,0 +1,225 @@
+"""
+fake_api
+---------
+
+| A local stand-in for the Telegram Bot API that is used by the benchmarks.
+| It serves `getUpdates`, `sendMessage`, `sendPhoto`, `sendMediaGroup` and a few other methods
+| with a configurable latency, so that the connector can be measured without a live bot token.
+
+.. code-block:: python
+
+    with FakeTelegramServer(latency=0.01) as server:
+        server.push_updates([...])
+        bot = DFFBot("123:fake")
+        bot.send_message(1, "text")
+
+"""
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional
+from urllib.parse import parse_qsl, urlparse
+
+from telebot import apihelper
+
+
+class FakeTelegramServer:
+    """
+    Threaded HTTP server that imitates the Telegram Bot API.
+
+    Parameters
+    -----------
+
+    latency: float
+        Delay in seconds added to every `send*` request and to every `getUpdates` response that returns updates,
+        like the round-trip to the real Bot API.
+    host: str
+        Interface to bind to. The port is picked automatically.
+
+    """
+
+    def __init__(self, latency: float = 0.0, host: str = "127.0.0.1"):
+        self.latency = latency
+        self._updates: List[dict] = []
+        self._updates_available = threading.Condition()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._lock = threading.Lock()
+        self._enqueued: Dict[str, Deque[float]] = defaultdict(deque)
+        self.reply_latencies: List[float] = []
+        self.replies = 0
+        self.requests: Dict[str, int] = defaultdict(int)
+        self.replied = threading.Condition(self._lock)
+        self._server = ThreadingHTTPServer((host, 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+        self._api_url: Optional[str] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self._api_url = apihelper.API_URL
+        apihelper.API_URL = self.url + "/bot{0}/{1}"
+        return self
+
+    def stop(self):
+        apihelper.API_URL = self._api_url
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def create_update(self, user_id: int, text: str) -> dict:
+        """Build the JSON of a text message update, as it would be sent by Telegram."""
+        with self._lock:
+            update_id = self._next_update_id
+            self._next_update_id += 1
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                "chat": {"id": user_id, "type": "private"},
+                "date": int(time.time()),
+                "text": text,
+            },
+        }
+
+    def push_updates(self, updates: List[dict]):
+        """Make the updates available to `getUpdates` and start measuring the time until the replies."""
+        now = time.perf_counter()
+        with self._lock:
+            for update in updates:
+                chat_id = str(update["message"]["chat"]["id"])
+                self._enqueued[chat_id].append(now)
+        with self._updates_available:
+            self._updates.extend(updates)
+            self._updates_available.notify_all()
+
+    def mark_enqueued(self, chat_id: int):
+        """Start measuring the time until the reply for an update that is delivered by other means (webhook)."""
+        with self._lock:
+            self._enqueued[str(chat_id)].append(time.perf_counter())
+
+    def wait_for_replies(self, count: int, timeout: float = 60.0) -> bool:
+        deadline = time.perf_counter() + timeout
+        with self.replied:
+            while self.replies < count:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or not self.replied.wait(remaining):
+                    return False
+        return True
+
+    def reset_stats(self):
+        with self._lock:
+            self._enqueued.clear()
+            self.reply_latencies = []
+            self.replies = 0
+            self.requests.clear()
+
+    def _get_updates(self, params: dict) -> List[dict]:
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        timeout = float(params.get("timeout", 0) or 0)
+        deadline = time.perf_counter() + timeout
+        with self._updates_available:
+            while True:
+                if offset < 0:
+                    return self._updates[offset:]
+                self._updates = [update for update in self._updates if update["update_id"] >= offset]
+                if self._updates:
+                    return self._updates[:limit]
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return []
+                self._updates_available.wait(remaining)
+
+    def _message(self, params: dict, **content) -> dict:
+        with self._lock:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        chat_id = params.get("chat_id", "0")
+        return {
+            "message_id": message_id,
+            "chat": {"id": int(chat_id), "type": "private"},
+            "date": int(time.time()),
+            **content,
+        }
+
+    def _photo(self, file_id: str) -> dict:
+        return {"photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}]}
+
+    def _record_reply(self, params: dict):
+        with self._lock:
+            enqueued = self._enqueued.get(str(params.get("chat_id")))
+            if enqueued:
+                self.reply_latencies.append(time.perf_counter() - enqueued.popleft())
+            self.replies += 1
+            self.replied.notify_all()
+
+    def handle(self, method: str, params: dict):
+        self.requests[method] += 1
+        if method == "getUpdates":
+            updates = self._get_updates(params)
+            if updates:
+                time.sleep(self.latency)
+            return updates
+        if method in ("setWebhook", "deleteWebhook"):
+            return True
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"}
+
+        time.sleep(self.latency)
+        if method == "sendMessage":
+            result = self._message(params, text=params.get("text", ""))
+            self._record_reply(params)
+            return result
+        if method == "sendPhoto":
+            return self._message(params, **self._photo(params.get("photo", "uploaded_photo")))
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            return [self._message(params, **self._photo(item["media"])) for item in media]
+        if method in ("sendVideo", "sendDocument", "sendAudio", "sendLocation"):
+            return self._message(params)
+        return True
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _respond(self):
+                parsed = urlparse(self.path)
+                method = parsed.path.rsplit("/", 1)[-1]
+                params = dict(parse_qsl(parsed.query))
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                if body and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                    params.update(parse_qsl(body.decode("utf-8")))
+                payload = json.dumps({"ok": True, "result": server.handle(method, params)}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = _respond
+            do_POST = _respond
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+run_benchmarks
+---------------
+
+| Benchmarks for the hot paths of the connector. The Telegram Bot API is replaced with
+| :py:class:`~fake_api.FakeTelegramServer`, so no bot token is required.
+| Every benchmark is run for each of the user counts and reports throughput and p50/p99 latency.
+| The results are written as JSON, so that they can be compared between revisions.
+
+.. code-block:: bash
+
+    python benchmarks/run_benchmarks.py --users 1 10 100 --latency 0.005 --output bench.json
+
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import requests  # noqa: E402
+from telebot import types  # noqa: E402
+from df_engine.core import Actor  # noqa: E402
+from df_engine.core.keywords import GLOBAL, RESPONSE, TRANSITIONS  # noqa: E402
+import df_engine.conditions as cnd  # noqa: E402
+from df_runner import Runner  # noqa: E402
+
+from dff_telegram_connector.basic_connector import DFFBot, DatabaseMiddleware  # noqa: E402
+from dff_telegram_connector.dispatcher import UserDispatcher  # noqa: E402
+from dff_telegram_connector.request_provider import PollingRequestProvider, FlaskRequestProvider  # noqa: E402
+from dff_telegram_connector.serialization import loads_update, update_to_json  # noqa: E402
+from dff_telegram_connector.transport import Transport, unregister_transport  # noqa: E402
+from dff_telegram_connector.utils import get_initial_context, get_user_id, set_state, unwrap_update  # noqa: E402
+
+from fake_api import FakeTelegramServer  # noqa: E402
+
+TOKEN = "123:benchmark"
+KITTEN = Path(__file__).parent.parent / "examples" / "pictures" / "kitten.jpg"
+
+
+def percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def summarize(name: str, users: int, latencies: List[float], elapsed: float, **extra) -> dict:
+    return {
+        "name": name,
+        "users": users,
+        "operations": len(latencies),
+        "seconds": round(elapsed, 6),
+        "throughput": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 4),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 4),
+        **extra,
+    }
+
+
+def make_actor(bot: DFFBot) -> Actor:
+    script = {
+        GLOBAL: {
+            TRANSITIONS: {
+                ("root", "start", 2): bot.cnd.message_handler(commands=["start"]),
+                ("root", "image", 2): bot.cnd.message_handler(content_types=["photo", "sticker"]),
+                ("animals", "have_pets", 2): bot.cnd.message_handler(commands=["pets"]),
+                ("animals", "like_animals", 2): bot.cnd.message_handler(commands=["animals"]),
+                ("root", "document", 2): bot.cnd.message_handler(content_types=["document"]),
+            }
+        },
+        "root": {
+            "start": {RESPONSE: "Hi", TRANSITIONS: {("root", "talk"): cnd.true()}},
+            "talk": {RESPONSE: "How are you?", TRANSITIONS: {("root", "talk"): cnd.true()}},
+            "image": {RESPONSE: "Nice image"},
+            "document": {RESPONSE: "Nice document"},
+            "fallback": {RESPONSE: "Oops"},
+        },
+        "animals": {
+            "have_pets": {RESPONSE: "do you have pets?"},
+            "like_animals": {RESPONSE: "do you like it?"},
+        },
+    }
+    return Actor(script, start_label=("root", "start"), fallback_label=("root", "fallback"))
+
+
+def create_message(user_id: int, text: str) -> types.Message:
+    params = {"text": text}
+    user = types.User(user_id, False, "test")
+    chat = types.Chat(user_id, "private")
+    return types.Message(1, user, 0, chat, "text", params, "")
+
+
+def run_threads(users: int, per_user: int, operation: Callable[[int, int], None]) -> (List[float], float):
+    """Run `operation(user_id, turn)` in one thread per user and collect the latency of every call."""
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def worker(user_id: int):
+        local = []
+        for turn in range(per_user):
+            start = time.perf_counter()
+            operation(user_id, turn)
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(user_id,)) for user_id in range(1, users + 1)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+
+def bench_send_response(server: FakeTelegramServer, users: int, turns: int) -> List[dict]:
+    results = []
+    responses = {
+        "text": "Hello",
+        "photo": {"text": "Kitten", "image": {"source": KITTEN, "title": "kitten"}},
+    }
+    # a pool smaller than the number of the sending threads would make them wait for a connection
+    for transport in [None, Transport(pool_size=users)]:
+        bot = DFFBot(TOKEN, threaded=False, transport=transport)
+        suffix = "" if transport is None else ".transport"
+        for kind, response in responses.items():
+            latencies, elapsed = run_threads(users, turns, lambda user_id, turn: bot.send_response(user_id, response))
+            extra = {} if transport is None else {"connections": transport.stats()["connections"]}
+            results.append(summarize(f"send_response.{kind}{suffix}", users, latencies, elapsed, **extra))
+        if transport is not None:
+            unregister_transport(TOKEN)
+            transport.close()
+    return results
+
+
+def bench_middleware(users: int, turns: int) -> List[dict]:
+    connector = dict()
+    middleware = DatabaseMiddleware(connector)
+    messages = {user_id: create_message(user_id, "hello") for user_id in range(1, users + 1)}
+
+    def operation(user_id: int, turn: int):
+        data = {}
+        middleware.pre_process(messages[user_id], data)
+        middleware.post_process(messages[user_id], data)
+
+    latencies, elapsed = run_threads(users, turns, operation)
+    return [summarize("database_middleware", users, latencies, elapsed)]
+
+
+def bench_conditions(users: int, turns: int) -> List[dict]:
+    bot = DFFBot(TOKEN, threaded=False)
+    actor = make_actor(bot)
+    contexts = {user_id: get_initial_context(str(user_id)) for user_id in range(1, users + 1)}
+    texts = ["/start", "hello", "/pets", "/animals", "how are you"]
+
+    def operation(user_id: int, turn: int):
+        context = set_state(contexts[user_id], create_message(user_id, texts[turn % len(texts)]))
+        contexts[user_id] = actor(context)
+
+    latencies, elapsed = run_threads(users, turns, operation)
+    return [
+        summarize(
+            "cnd_namespace.actor_turn",
+            users,
+            latencies,
+            elapsed,
+            cache_hits=bot.cnd.cache_hits,
+            cache_misses=bot.cnd.cache_misses,
+        )
+    ]
+
+
+def legacy_unwrap_update(update: types.Update):
+    """Unwrapping as it was done before the lookup table, kept for comparison."""
+    _, inner_update = next(
+        filter(
+            lambda key_val: key_val[0] != "update_id" and key_val[1] is not None,
+            list(update.__dict__.items()),
+        )
+    )
+    assert hasattr(inner_update, "from_user"), f"Received an invalid update object: {str(type(inner_update))}"
+    return str(inner_update.from_user.id), inner_update
+
+
+def create_update_stream(users: int, turns: int) -> List[types.Update]:
+    """Mixed stream of messages, callback queries, channel posts and poll answers."""
+    updates = []
+    for turn in range(turns):
+        for user_id in range(1, users + 1):
+            user = {"id": user_id, "is_bot": False, "first_name": "test"}
+            chat = {"id": user_id, "type": "private"}
+            kind = (user_id + turn) % 4
+            if kind == 0:
+                inner = {"message": {"message_id": turn, "from": user, "chat": chat, "date": 0, "text": "hi"}}
+            elif kind == 1:
+                inner = {"callback_query": {"id": str(turn), "from": user, "chat_instance": "1", "data": "4"}}
+            elif kind == 2:
+                channel = {"id": -user_id, "type": "channel"}
+                inner = {"channel_post": {"message_id": turn, "chat": channel, "date": 0, "text": "news"}}
+            else:
+                inner = {"poll_answer": {"poll_id": str(turn), "user": user, "option_ids": [0]}}
+            updates.append(types.Update.de_json({"update_id": len(updates), **inner}))
+    return updates
+
+
+def bench_unwrap(users: int, turns: int) -> List[dict]:
+    updates = create_update_stream(users, turns)
+    results = []
+    for name, unwrap in [("legacy", legacy_unwrap_update), ("table", unwrap_update)]:
+        latencies, errors = [], 0
+        start = time.perf_counter()
+        for update in updates:
+            started = time.perf_counter()
+            try:
+                unwrap(update)
+            except (AssertionError, AttributeError):
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+        results.append(summarize(f"unwrap_update.{name}", users, latencies, time.perf_counter() - start, errors=errors))
+    return results
+
+
+def bench_polling(server: FakeTelegramServer, users: int, turns: int) -> List[dict]:
+    results = []
+    modes: Dict[str, dict] = {
+        "sequential": {},
+        "dispatcher": {"dispatcher": UserDispatcher(max_workers=min(users, 32))},
+        "pipelined": {"dispatcher": UserDispatcher(max_workers=min(users, 32)), "pipelined": True},
+    }
+    for mode, params in modes.items():
+        bot = DFFBot(TOKEN, threaded=False)
+        provider = PollingRequestProvider(bot, interval=0, timeout=5, long_polling_timeout=1, **params)
+        runner = Runner(actor=make_actor(bot), db=dict(), request_provider=provider)
+        server.reset_stats()
+        thread = threading.Thread(target=provider.run, args=(runner,), daemon=True)
+        thread.start()
+        start = time.perf_counter()
+        for turn in range(turns):
+            server.push_updates([server.create_update(user_id, "hello") for user_id in range(1, users + 1)])
+        completed = server.wait_for_replies(users * turns)
+        elapsed = time.perf_counter() - start
+        bot._TeleBot__stop_polling.set()
+        thread.join()
+        if "dispatcher" in params:
+            params["dispatcher"].shutdown()
+        results.append(summarize(f"polling.{mode}", users, server.reply_latencies, elapsed, completed=completed))
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def bench_parse(users: int, turns: int) -> List[dict]:
+    """Parse raw webhook bodies eagerly to telebot objects or lazily, then run the state update and a condition."""
+    bot = DFFBot(TOKEN, threaded=False)
+    start = bot.cnd.message_handler(commands=["start"], chat_types=["private"])
+    bodies = [json.dumps(update_to_json(update)).encode("utf-8") for update in create_update_stream(users, turns)]
+
+    def parse_eager(body: bytes):
+        return unwrap_update(types.Update.de_json(body.decode("utf-8")))
+
+    def parse_lazy(body: bytes):
+        _, inner_update = loads_update(body)
+        return get_user_id(inner_update), inner_update
+
+    results = []
+    for name, parse in [("eager", parse_eager), ("lazy", parse_lazy)]:
+        latencies = []
+        start_time = time.perf_counter()
+        for body in bodies:
+            started = time.perf_counter()
+            ctx_id, inner_update = parse(body)
+            start(set_state(get_initial_context(ctx_id), inner_update), None)
+            latencies.append(time.perf_counter() - started)
+        results.append(summarize(f"parse_update.{name}", users, latencies, time.perf_counter() - start_time))
+    return results
+
+
+def bench_flask(server: FakeTelegramServer, users: int, turns: int) -> List[dict]:
+    try:
+        from flask import Flask
+    except ImportError:
+        return []
+
+    results = []
+    for lazy_updates in [False, True]:
+        results.extend(run_flask(server, Flask(__name__), users, turns, lazy_updates))
+    return results
+
+
+def run_flask(server: FakeTelegramServer, app, users: int, turns: int, lazy_updates: bool) -> List[dict]:
+    bot = DFFBot(TOKEN, threaded=False)
+    port = free_port()
+    provider = FlaskRequestProvider(bot, app, host="127.0.0.1", port=port, lazy_updates=lazy_updates)
+    runner = Runner(actor=make_actor(bot), db=dict(), request_provider=provider)
+    threading.Thread(target=provider.run, args=(runner,), daemon=True).start()
+    url = f"http://127.0.0.1:{port}{provider.endpoint}"
+    for _ in range(100):
+        try:
+            requests.get(url)
+            break
+        except requests.ConnectionError:
+            time.sleep(0.05)
+
+    sessions = {user_id: requests.Session() for user_id in range(1, users + 1)}
+    server.reset_stats()
+
+    def operation(user_id: int, turn: int):
+        update = server.create_update(user_id, "hello")
+        sessions[user_id].post(url, json=update)
+
+    latencies, elapsed = run_threads(users, turns, operation)
+    name = "flask_provider.lazy_request" if lazy_updates else "flask_provider.request"
+    return [summarize(name, users, latencies, elapsed)]
+
+
+BENCHMARKS = ["send_response", "middleware", "conditions", "unwrap", "parse", "polling", "flask"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--turns", type=int, default=20, help="number of updates per user")
+    parser.add_argument("--latency", type=float, default=0.005, help="latency of the fake API in seconds")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--output", default="-", help="path to the JSON report, `-` for stdout")
+    args = parser.parse_args()
+
+    results = []
+    with FakeTelegramServer(latency=args.latency) as server:
+        for users in args.users:
+            if "send_response" in args.only:
+                results.extend(bench_send_response(server, users, args.turns))
+            if "middleware" in args.only:
+                results.extend(bench_middleware(users, args.turns))
+            if "conditions" in args.only:
+                results.extend(bench_conditions(users, args.turns))
+            if "unwrap" in args.only:
+                results.extend(bench_unwrap(users, args.turns))
+            if "parse" in args.only:
+                results.extend(bench_parse(users, args.turns))
+            if "polling" in args.only:
+                results.extend(bench_polling(server, users, args.turns))
+            if "flask" in args.only:
+                results.extend(bench_flask(server, users, args.turns))
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "latency_s": args.latency,
+            "turns": args.turns,
+            "timestamp": time.time(),
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        Path(args.output).write_text(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+async_connector
+-----------------
+
+| Async connector module provides the :py:class:`~dff_telegram_connector.async_connector.AsyncDFFBot` class.
+| It inherits from the :py:class:`~telebot.async_telebot.AsyncTeleBot` class from the :py:mod:`~pytelegrambotapi`
+| library and mirrors the interface of :py:class:`~dff_telegram_connector.basic_connector.DFFBot`.
+| All the outgoing requests are coroutines, so a single event loop can serve many conversations at once.
+
+"""
+import asyncio
+import inspect
+import re
+from pathlib import Path
+from typing import Any, Dict, MutableMapping, Optional, Union
+
+from telebot import types, util, logger, custom_filters
+from telebot.util import update_types
+
+from df_engine.core import Context
+
+from .basic_connector import CndNamespace
+from .utils import get_initial_context, get_user_id, set_state, open_io, close_io
+from .retention import RetentionPolicy
+from .types import MediaStream, TelegramResponse, cast_response
+
+import df_generics
+
+try:
+    from telebot.async_telebot import AsyncTeleBot
+    from telebot.asyncio_handler_backends import BaseMiddleware as AsyncBaseMiddleware
+    from telebot.asyncio_filters import SimpleCustomFilter as AsyncSimpleCustomFilter
+except ImportError:
+    AsyncTeleBot, AsyncBaseMiddleware, AsyncSimpleCustomFilter = object, object, custom_filters.SimpleCustomFilter
+
+
+class AsyncDFFBot(AsyncTeleBot):
+    """
+
+    Parameters
+    -----------
+
+    db_connector: :py:class:`~typing.MutableMapping`
+        | Any :py:class:`~typing.MutableMapping`-like object that supports setting, getting and deleting items.
+        | Note that this argument is keyword-only.
+
+        | Passing this parameter to the constructor enables the :py:class:`~AsyncDatabaseMiddleware`.
+
+    trusted_responses: bool
+        | Skip the validation of the responses, where possible.
+        | See :py:func:`~dff_telegram_connector.types.cast_response` for details.
+
+    retention: Optional[:py:class:`~dff_telegram_connector.retention.RetentionPolicy`]
+        | Policy that trims the context histories before the :py:class:`~AsyncDatabaseMiddleware` saves them.
+
+    """
+
+    def __init__(
+        self,
+        *args,
+        db_connector: MutableMapping = None,
+        trusted_responses: bool = False,
+        retention: Optional[RetentionPolicy] = None,
+        **kwargs,
+    ):
+        if AsyncTeleBot is object:
+            raise ModuleNotFoundError("aiohttp is not installed")
+
+        super().__init__(*args, **kwargs)
+        self._connector = db_connector
+        self.trusted_responses = trusted_responses
+        self.cnd = AsyncCndNamespace(self)
+        if db_connector is not None:
+            self.setup_middleware(AsyncDatabaseMiddleware(self._connector, retention))
+
+    async def send_response(
+        self, chat_id: Union[str, int], response: Union[str, dict, df_generics.Response, TelegramResponse]
+    ):
+        """
+        Cast the `response` argument to the :py:class:`~TelegramResponse` type and send it.
+        The order is that the media are sent first, after which the marked-up text message is sent.
+
+        Parameters
+        -----------
+        chat_id: Union[str, int]
+            ID of the chat to send the response to
+        response: Union[str, dict, df_generics.Response, TelegramResponse]
+            Response data. Can be passed as a :py:class:`~str`, a :py:class:`~dict`,
+            or a :py:class:`~df_generics.Response`
+            which will then be used to instantiate a :py:class:`~TelegramResponse` object.
+            A :py:class:`~TelegramResponse` can also be passed directly.
+
+        """
+        ready_response = cast_response(response, trusted=self.trusted_responses)
+
+        for attachment_prop, method in [
+            (ready_response.image, self.send_photo),
+            (ready_response.video, self.send_video),
+            (ready_response.document, self.send_document),
+            (ready_response.audio, self.send_audio),
+        ]:
+            if attachment_prop is None:
+                continue
+            params = {"caption": attachment_prop.title}
+            if isinstance(attachment_prop.source, Path):
+                with open(attachment_prop.source, "rb") as file:
+                    await method(chat_id, file, **params)
+            elif isinstance(attachment_prop.source, MediaStream) and attachment_prop.source.is_async:
+                source = attachment_prop.source
+                await method(chat_id, (source.filename, source.content), **params)
+            else:
+                await method(chat_id, attachment_prop.source or attachment_prop.id, **params)
+
+        if ready_response.location:
+            await self.send_location(
+                chat_id=chat_id, latitude=ready_response.location.latitude, longitude=ready_response.location.longitude
+            )
+
+        if ready_response.attachments:
+            opened_media = [open_io(item, asynchronous=True) for item in ready_response.attachments.files]
+            try:
+                await self.send_media_group(chat_id=chat_id, media=opened_media)
+            finally:
+                for item in opened_media:
+                    close_io(item)
+
+        await self.send_message(
+            chat_id=chat_id, text=ready_response.text, reply_markup=ready_response.ui and ready_response.ui.keyboard
+        )
+
+
+class AsyncCndNamespace(CndNamespace):
+    """
+    | The counterpart of :py:class:`~dff_telegram_connector.basic_connector.CndNamespace`
+    | for the :py:class:`~dff_telegram_connector.async_connector.AsyncDFFBot`.
+
+    | The :py:class:`~df_engine.core.Actor` evaluates conditions synchronously, so the filters are tested
+    | without awaiting anything: built-in filters and synchronous custom filters are supported,
+    | while custom filters with coroutine `check` methods always evaluate to `False`.
+
+    """
+
+    def _test_handler(self, update_handler: dict, update: types.JsonDeserializable) -> bool:
+        for update_filter, filter_value in update_handler["filters"].items():
+            if filter_value is None:
+                continue
+            if not self._test_filter(update_filter, filter_value, update):
+                return False
+        return True
+
+    def _test_filter(self, update_filter: str, filter_value, update: types.JsonDeserializable) -> bool:
+        if update_filter == "content_types":
+            return update.content_type in filter_value
+        elif update_filter == "regexp":
+            return update.content_type == "text" and bool(re.search(filter_value, update.text, re.IGNORECASE))
+        elif update_filter == "commands":
+            return update.content_type == "text" and util.extract_command(update.text) in filter_value
+        elif update_filter == "chat_types":
+            return update.chat.type in filter_value
+        elif update_filter == "func":
+            return filter_value(update)
+
+        custom_filter = self.bot.custom_filters.get(update_filter)
+        if custom_filter is None:
+            return False
+        is_simple = isinstance(custom_filter, (custom_filters.SimpleCustomFilter, AsyncSimpleCustomFilter))
+        result = custom_filter.check(update) if is_simple else custom_filter.check(update, filter_value)
+        if inspect.isawaitable(result):
+            result.close()
+            logger.error(f"Custom filter `{update_filter}` is a coroutine and cannot be tested inside a condition.")
+            return False
+        return filter_value == result if is_simple else result
+
+
+class AsyncDatabaseMiddleware(AsyncBaseMiddleware):
+    """
+    | The counterpart of :py:class:`~dff_telegram_connector.basic_connector.DatabaseMiddleware`
+    | for the :py:class:`~dff_telegram_connector.async_connector.AsyncDFFBot`.
+    | It is instantiated automatically, if you pass the `db_connector` parameter to the bot.
+
+    | The bot handles a batch of updates concurrently, so the middleware holds a lock of the user
+    | from :py:meth:`pre_process` to :py:meth:`post_process`: the updates of the same user are handled
+    | one after another and never overwrite each other's context.
+
+    """
+
+    def __init__(self, db_connector: MutableMapping, retention: Optional[RetentionPolicy] = None) -> None:
+        self.update_types = update_types
+        self._connector = db_connector
+        self.retention = retention
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._lock_users: Dict[str, int] = {}
+
+    async def pre_process(self, update, data: dict):
+        user_id = get_user_id(update)
+        lock = _UserLock(self, user_id)
+        await lock.__aenter__()
+        data["_user_lock"] = lock
+        try:
+            context = self._connector.get(user_id)
+            if context is None:
+                context = get_initial_context(user_id)
+            context = set_state(context, update)
+        except BaseException:
+            await data.pop("_user_lock").__aexit__(None, None, None)
+            raise
+
+        data["context"] = context
+
+    async def post_process(self, update, data: dict, exception=None):
+        lock = data.pop("_user_lock", None)
+        if lock is None:
+            return
+        try:
+            if exception:
+                print(exception)
+
+            user_id = get_user_id(update)
+            context: Context = data["context"]
+            if self.retention is not None:
+                context = self.retention(context)
+            self._connector[user_id] = context
+        finally:
+            await lock.__aexit__(None, None, None)
+
+
+class _UserLock:
+    """
+    | Per-user lock that is removed from its owner, when no task holds or awaits it.
+    | The owner keeps the locks in `_locks` and the number of the tasks that use them in `_lock_users`.
+    """
+
+    def __init__(self, owner: Any, ctx_id: str):
+        self.owner = owner
+        self.ctx_id = ctx_id
+
+    async def __aenter__(self):
+        owner, ctx_id = self.owner, self.ctx_id
+        lock = owner._locks.setdefault(ctx_id, asyncio.Lock())
+        owner._lock_users[ctx_id] = owner._lock_users.get(ctx_id, 0) + 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._release_user()
+            raise
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.owner._locks[self.ctx_id].release()
+        self._release_user()
+
+    def _release_user(self):
+        owner, ctx_id = self.owner, self.ctx_id
+        owner._lock_users[ctx_id] -= 1
+        if owner._lock_users[ctx_id] == 0:
+            del owner._lock_users[ctx_id]
+            del owner._locks[ctx_id]
@@ -0,0 +1,360 @@
+import asyncio
+import json
+from functools import partial
+from typing import Dict, Optional, Set, Tuple
+
+from telebot import types, logger
+
+from df_engine.core import Context, Actor
+from df_runner import AbsRequestProvider, Runner
+
+from .async_connector import AsyncDFFBot, _UserLock
+from .retention import RetentionPolicy
+from .types import TelegramResponse, cast_response
+from .utils import can_reply, set_state, get_initial_context_factory, unwrap_update
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+try:
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config as HypercornConfig
+except ImportError:
+    hypercorn_serve, HypercornConfig = None, None
+
+
+class AsyncRequestProvider(AbsRequestProvider):
+    """
+    | Base class for the request providers that run on an event loop.
+    | Updates are handled in separate tasks, so that a slow reply does not block other conversations.
+    | Updates from the same user are handled one after another.
+    | A :py:class:`~dff_telegram_connector.retention.RetentionPolicy` passed as `retention` trims the contexts
+    | before the runner saves them.
+    """
+
+    def __init__(self, bot: AsyncDFFBot, retention: Optional[RetentionPolicy] = None):
+        self.bot = bot
+        self.retention = retention
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._lock_users: Dict[str, int] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def _unwrap_update(update: types.Update) -> Tuple[str, types.JsonDeserializable]:
+        return unwrap_update(update)
+
+    async def handle_update(self, runner: Runner, update: types.Update):
+        ctx_id, inner_update = self._unwrap_update(update)
+        async with self._user_lock(ctx_id):
+            ctx: Context = runner.request_handler(ctx_id, inner_update, get_initial_context_factory(ctx_id))
+            if can_reply(inner_update):
+                await self.bot.send_response(ctx_id, ctx.last_response)
+
+    def _user_lock(self, ctx_id: str) -> "_UserLock":
+        return _UserLock(self, ctx_id)
+
+    def create_task(self, runner: Runner, update: types.Update) -> asyncio.Task:
+        """Handle an update in a separate task. A reference to the task is kept until it is done."""
+        task = asyncio.get_running_loop().create_task(self.handle_update(runner, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+        return task
+
+    def _on_task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(task.exception())
+
+    @property
+    def tasks_in_flight(self) -> int:
+        """Number of updates that are being handled at the moment."""
+        return len(self._tasks)
+
+    def _setup_runner(self, runner: Runner):
+        if self.set_state not in runner._pre_annotators:
+            runner._pre_annotators.append(self.set_state)
+        if self.retention is not None and self.retention not in runner._post_annotators:
+            runner._post_annotators.append(self.retention)
+
+    @staticmethod
+    def set_state(ctx: Context, actor: Actor):
+        return set_state(ctx, ctx.last_request)
+
+
+class AsyncPollingRequestProvider(AsyncRequestProvider):
+    """
+    Class for compatibility with df_runner. Retrieves updates by polling on an event loop.
+    """
+
+    def __init__(
+        self,
+        bot: AsyncDFFBot,
+        interval=0,
+        allowed_updates=None,
+        timeout=20,
+        request_timeout=25,
+        retention: Optional[RetentionPolicy] = None,
+    ):
+        super().__init__(bot, retention)
+        self.interval = interval
+        self.allowed_updates = allowed_updates
+        self.timeout = timeout
+        self.request_timeout = request_timeout
+        self._polling = False
+
+    def run(self, runner: Runner):
+        self._setup_runner(runner)
+
+        asyncio.run(self.polling(runner))
+
+    async def polling(self, runner: Runner):
+        """Coroutine version of :py:meth:`run` that can be scheduled on an existing event loop."""
+        logger.info("started polling")
+        self._polling = True
+        try:
+            updates = await self.bot.get_updates(offset=-1)
+            offset = updates[-1].update_id + 1 if updates else None
+            while self._polling:
+                try:
+                    updates = await self.bot.get_updates(
+                        offset=offset,
+                        allowed_updates=self.allowed_updates,
+                        timeout=self.timeout,
+                        request_timeout=self.request_timeout,
+                    )
+                except Exception as e:
+                    print(e)
+                    break
+                for update in updates:
+                    offset = max(offset or 0, update.update_id + 1)
+                    self.create_task(runner, update)
+                if self.interval:
+                    await asyncio.sleep(self.interval)
+            if self._tasks:
+                await asyncio.wait(self._tasks)
+        finally:
+            self._polling = False
+            await self.bot.close_session()
+
+    def stop(self):
+        """Stop polling after the current `get_updates` call returns."""
+        self._polling = False
+
+
+class AsyncWebhookRequestProvider(AsyncRequestProvider):
+    """Class for compatibility with df_runner. Retrieves updates from post json requests with an aiohttp server."""
+
+    def __init__(
+        self,
+        bot: AsyncDFFBot,
+        app: Optional["web.Application"] = None,
+        host: str = "localhost",
+        port: int = 8443,
+        endpoint: str = "/dff-bot",
+        full_uri: str = None,
+        retention: Optional[RetentionPolicy] = None,
+    ):
+        if web is None:
+            raise ModuleNotFoundError("aiohttp is not installed")
+
+        super().__init__(bot, retention)
+        self.app = app or web.Application()
+        self.host = host
+        self.port = port
+        self.endpoint = endpoint
+        self.full_uri = full_uri or "".join([f"https://{host}:{port}", self.endpoint])
+
+    def run(self, runner: Runner):
+        self._setup_runner(runner)
+
+        self.app.router.add_post(self.endpoint, partial(self.handle_request, runner))
+        self.app.on_startup.append(self._set_webhook)
+        self.app.on_cleanup.append(self._close_session)
+        web.run_app(self.app, host=self.host, port=self.port)
+
+    async def handle_request(self, runner: Runner, request: "web.Request"):
+        if not request.content_type == "application/json":
+            raise web.HTTPForbidden()
+        update = types.Update.de_json(await request.text())
+        self.create_task(runner, update)
+        return web.Response()
+
+    async def _set_webhook(self, app: "web.Application"):
+        await self.bot.remove_webhook()
+        await self.bot.set_webhook(self.full_uri)
+
+    async def _close_session(self, app: "web.Application"):
+        await self.bot.close_session()
+
+
+def get_webhook_reply(chat_id: str, response: TelegramResponse) -> Optional[dict]:
+    """
+    | Build the body of a webhook response that makes Telegram send the reply itself.
+    | Only responses that consist of a single text message (with an optional keyboard) qualify,
+    | otherwise `None` is returned and the response has to be sent with the Bot API.
+    """
+    if any(
+        item is not None
+        for item in (response.image, response.video, response.document, response.audio, response.location)
+    ) or (response.attachments and response.attachments.files):
+        return None
+    reply = {"method": "sendMessage", "chat_id": chat_id, "text": response.text}
+    keyboard = response.ui and response.ui.keyboard
+    if keyboard is not None:
+        reply["reply_markup"] = json.loads(keyboard.to_json())
+    return reply
+
+
+class ASGIWebhookRequestProvider(AsyncRequestProvider):
+    """
+    | Class for compatibility with df_runner. Retrieves updates from post json requests.
+    | The provider is an ASGI application itself, it is served with `uvicorn` or `hypercorn`.
+
+    | With `reply_in_webhook=True` text-only replies are returned in the body of the webhook response,
+    | and Telegram sends them on behalf of the bot. This saves a round-trip to the Bot API on every text turn.
+    | Note that Telegram reports no result or error for such replies.
+    | An update that fails is logged and answered with an empty response, so that Telegram does not redeliver it.
+    | Other responses are sent with :py:meth:`~dff_telegram_connector.async_connector.AsyncDFFBot.send_response`.
+
+    .. code-block:: python
+
+        provider = ASGIWebhookRequestProvider(bot=bot, host="0.0.0.0", full_uri="https://example.com/dff-bot")
+        runner = Runner(actor=actor, request_provider=provider)
+        runner.start()
+
+    To serve the provider with a custom server setup, get the application with :py:meth:`get_app`.
+
+    Parameters
+    -----------
+
+    server: str
+        Server that :py:meth:`run` starts: `"uvicorn"` or `"hypercorn"`.
+    reply_in_webhook: bool
+        Return text-only replies in the webhook response.
+    set_webhook: bool
+        Register `full_uri` with Telegram on startup.
+
+    """
+
+    def __init__(
+        self,
+        bot: AsyncDFFBot,
+        host: str = "localhost",
+        port: int = 8443,
+        endpoint: str = "/dff-bot",
+        full_uri: str = None,
+        server: str = "uvicorn",
+        reply_in_webhook: bool = True,
+        set_webhook: bool = True,
+        retention: Optional[RetentionPolicy] = None,
+    ):
+        if server not in ("uvicorn", "hypercorn"):
+            raise ValueError(f"Unknown server: {server}")
+
+        super().__init__(bot, retention)
+        self.host = host
+        self.port = port
+        self.endpoint = endpoint
+        self.full_uri = full_uri or "".join([f"https://{host}:{port}", endpoint])
+        self.server = server
+        self.reply_in_webhook = reply_in_webhook
+        self.set_webhook = set_webhook
+        self.webhook_replies = 0
+        self._runner: Optional[Runner] = None
+
+    def get_app(self, runner: Runner) -> "ASGIWebhookRequestProvider":
+        """Bind the provider to the runner and return the ASGI application."""
+        self._setup_runner(runner)
+        self._runner = runner
+        return self
+
+    def run(self, runner: Runner):
+        if self.server == "uvicorn" and uvicorn is None:
+            raise ModuleNotFoundError("uvicorn is not installed")
+        if self.server == "hypercorn" and hypercorn_serve is None:
+            raise ModuleNotFoundError("hypercorn is not installed")
+
+        app = self.get_app(runner)
+        if self.server == "uvicorn":
+            uvicorn.run(app, host=self.host, port=self.port, lifespan="on")
+        else:
+            config = HypercornConfig()
+            config.bind = [f"{self.host}:{self.port}"]
+            asyncio.run(hypercorn_serve(app, config))
+
+    async def __call__(self, scope: dict, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            status, body = await self._handle_http(scope, receive)
+            headers = [(b"content-type", b"application/json")] if body else []
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if self.set_webhook:
+                    await self.bot.remove_webhook()
+                    await self.bot.set_webhook(self.full_uri)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._tasks:
+                    await asyncio.wait(self._tasks)
+                await self.bot.close_session()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _handle_http(self, scope: dict, receive) -> Tuple[int, bytes]:
+        if scope["path"] != self.endpoint or scope["method"] != "POST":
+            return 404, b""
+        headers = dict(scope["headers"])
+        if headers.get(b"content-type", b"").split(b";")[0].strip() != b"application/json":
+            return 403, b""
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        update = types.Update.de_json(body.decode("utf-8"))
+        if not self.reply_in_webhook:
+            self.create_task(self._runner, update)
+            return 200, b""
+        try:
+            reply = await self.handle_update(self._runner, update)
+        except Exception as e:
+            # an error status would make Telegram deliver the same update again
+            logger.error(f"Update {update.update_id} failed: {e!r}")
+            return 200, b""
+        if reply is None:
+            return 200, b""
+        self.webhook_replies += 1
+        return 200, json.dumps(reply).encode("utf-8")
+
+    async def handle_update(self, runner: Runner, update: types.Update) -> Optional[dict]:
+        """
+        Handle the update and return the webhook reply, if the response is a text-only one.
+        Otherwise, the response is sent with the Bot API and `None` is returned.
+        """
+        if not self.reply_in_webhook:
+            return await super().handle_update(runner, update)
+        ctx_id, inner_update = self._unwrap_update(update)
+        async with self._user_lock(ctx_id):
+            ctx: Context = runner.request_handler(ctx_id, inner_update, get_initial_context_factory(ctx_id))
+            if not can_reply(inner_update):
+                return None
+            response = cast_response(ctx.last_response, trusted=self.bot.trusted_responses)
+            reply = get_webhook_reply(ctx_id, response)
+            if reply is None:
+                await self.bot.send_response(ctx_id, response)
+            return reply
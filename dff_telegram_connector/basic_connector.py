@@ -7,22 +7,57 @@ basic_connector
 | Using it, you can put Telegram update handlers inside your script and condition your transitions on them.
 
 """
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from functools import partial
 from pathlib import Path
-from typing import MutableMapping, Union
+from threading import BoundedSemaphore, Lock
+from typing import Callable, Dict, FrozenSet, Iterable, List, MutableMapping, Optional, Set, Tuple, Union
 from pydantic import BaseModel
 
 from telebot import types, TeleBot
+from telebot.apihelper import ApiTelegramException
 from telebot.handler_backends import BaseMiddleware
 from telebot.util import update_types
 
 from df_engine.core import Context, Actor
 
-from .utils import get_initial_context, get_user_id, set_state, partialmethod, open_io, close_io
-from .types import TelegramResponse
+from .utils import (
+    get_initial_context,
+    get_user_id,
+    set_state,
+    partialmethod,
+    open_io,
+    close_io,
+    replace_media,
+    classify_update,
+    get_turn_cache,
+    StripedLock,
+)
+from .broadcast import BroadcastProgress
+from .cache import FileIdCache, MemoryFileIdCache, get_file_id, is_file_id_error
+from .rate_limit import RateLimiter
+from .retention import RetentionPolicy
+from .transport import Transport, register_transport
+from .types import MediaStream, TelegramAttachment, TelegramResponse, cast_response
 
 import df_generics
 
 
+class SendOrder(str, Enum):
+    """
+    Ordering policy for the requests that :py:meth:`~DFFBot.send_response` makes.
+
+    * `SEQUENTIAL`: every item is sent after the previous one is delivered (default).
+    * `TEXT_LAST`: media are uploaded concurrently in any order, the text message is sent after all of them.
+    * `CONCURRENT`: all the items including the text message are sent concurrently.
+    """
+
+    SEQUENTIAL = "sequential"
+    TEXT_LAST = "text_last"
+    CONCURRENT = "concurrent"
+
+
 class DFFBot(TeleBot):
     """
 
@@ -39,22 +74,99 @@ class DFFBot(TeleBot):
         | In the release version you will be able to use the `dff-db-connector` library
         | that adapts many kinds of database connectors to this interface.
 
+    send_order: :py:class:`~SendOrder`
+        | Ordering policy for the requests of :py:meth:`~send_response`.
+        | Any policy, other than `SEQUENTIAL`, sends the independent uploads in parallel.
+
+    send_workers: int
+        | Size of the thread pool used for parallel sending. Each worker keeps its own HTTP session,
+        | so the connections are reused between the responses. With a `transport` all the workers share its pool.
+        | The pool is started with the first parallel response and shut down by :py:meth:`stop_bot`.
+
+    file_cache: Optional[:py:class:`~dff_telegram_connector.cache.FileIdCache`]
+        | Cache for the `file_id` values returned by Telegram. When it is set, local files and URLs
+        | are uploaded only once, later responses reference the uploaded file by its id.
+
+    trusted_responses: bool
+        | Skip the validation of the responses, where possible.
+        | See :py:func:`~dff_telegram_connector.types.cast_response` for details.
+        | Enable it, if the responses come from a static script and are never mutated.
+
+    rate_limiter: Optional[:py:class:`~dff_telegram_connector.rate_limit.RateLimiter`]
+        | Scheduler that keeps the requests of :py:meth:`~send_response` within the flood limits of Telegram
+        | and retries the requests rejected with the error 429.
+
+    retention: Optional[:py:class:`~dff_telegram_connector.retention.RetentionPolicy`]
+        | Policy that trims the context histories before the :py:class:`~DatabaseMiddleware` saves them.
+
+    transport: Optional[:py:class:`~dff_telegram_connector.transport.Transport`]
+        | Shared HTTP session with a sized connection pool, per-method timeouts and a retry policy
+        | for all the requests of the bot.
+
     """
 
-    def __init__(self, *args, db_connector: MutableMapping = None, **kwargs):
+    def __init__(
+        self,
+        *args,
+        db_connector: MutableMapping = None,
+        send_order: SendOrder = SendOrder.SEQUENTIAL,
+        send_workers: int = 4,
+        file_cache: Optional[FileIdCache] = None,
+        trusted_responses: bool = False,
+        rate_limiter: Optional[RateLimiter] = None,
+        retention: Optional[RetentionPolicy] = None,
+        transport: Optional[Transport] = None,
+        **kwargs,
+    ):
         use_middleware = db_connector is not None
         super().__init__(*args, use_class_middlewares=use_middleware, **kwargs)
         self._connector = db_connector
         self.cnd = CndNamespace(self)
+        self.send_order = SendOrder(send_order)
+        self._send_workers = send_workers
+        self._send_executor: Optional[ThreadPoolExecutor] = None
+        self._send_executor_lock = Lock()
+        self.file_cache = file_cache
+        self.trusted_responses = trusted_responses
+        self.rate_limiter = rate_limiter
+        self.transport = transport
+        if transport is not None:
+            register_transport(self.token, transport)
+        self._middleware: Optional[DatabaseMiddleware] = None
         if use_middleware:
-            self.setup_middleware(DatabaseMiddleware(self._connector))
+            self._middleware = DatabaseMiddleware(self._connector, retention)
+            self.setup_middleware(self._middleware)
+
+    def _run_middlewares_and_handler(self, message, handlers, middlewares, *args, **kwargs):
+        """
+        | Run the middlewares and the handlers holding the lock of the user.
+        | In the threaded mode, this makes the read-modify-write of the context atomic,
+        | while the updates of different users are still handled in parallel.
+        | The lock is keyed like the context, so updates without a sender, e. g. polls, are locked too.
+        """
+        if self._middleware is None:
+            return super()._run_middlewares_and_handler(message, handlers, middlewares, *args, **kwargs)
+        with self._middleware.get_lock(message):
+            return super()._run_middlewares_and_handler(message, handlers, middlewares, *args, **kwargs)
+
+    def stop_bot(self):
+        """Stop polling and the worker pool of telebot and shut down the pool used for parallel sending."""
+        super().stop_bot()
+        with self._send_executor_lock:
+            executor, self._send_executor = self._send_executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
 
     def send_response(
-        self, chat_id: Union[str, int], response: Union[str, dict, df_generics.Response, TelegramResponse]
+        self,
+        chat_id: Union[str, int],
+        response: Union[str, dict, df_generics.Response, TelegramResponse],
+        priority: int = 0,
     ):
         """
         Cast the `response` argument to the :py:class:`~TelegramResponse` type and send it.
         The order is that the media are sent first, after which the marked-up text message is sent.
+        Media can be sent concurrently, see the `send_order` parameter of the class.
 
         Parameters
         -----------
@@ -65,23 +177,109 @@ class DFFBot(TeleBot):
             which will then be used to instantiate a :py:class:`~TelegramResponse` object.
             A :py:class:`~TelegramResponse` can also be passed directly.
             Note, that the dict should implement the :py:class:`~TelegramResponse` schema.
+        priority: int
+            Priority of the requests for the `rate_limiter`: lower values are sent first.
 
+        """
+        ready_response = cast_response(response, trusted=self.trusted_responses)
+        keyboard = ready_response.ui and ready_response.ui.keyboard
+        self._run_send_calls(
+            *self._get_send_calls(chat_id, ready_response, keyboard, self.file_cache, self.rate_limiter, priority)
+        )
 
+    def broadcast_response(
+        self,
+        chat_ids: Iterable[Union[str, int]],
+        response: Union[str, dict, df_generics.Response, TelegramResponse],
+        progress: Optional[BroadcastProgress] = None,
+        workers: int = 8,
+        priority: int = 1,
+    ) -> BroadcastProgress:
         """
-        if isinstance(response, TelegramResponse):
-            ready_response = response
-        elif isinstance(response, str):
-            ready_response = TelegramResponse(text=response)
-        elif isinstance(response, dict) or isinstance(response, df_generics.Response):
-            ready_response = TelegramResponse.parse_obj(response)
-        else:
-            raise TypeError(
-                """
-                Type of the response argument should be one of the following: 
-                str, dict, TelegramResponse, or df_generics.Response
-                """
-            )
+        | Send the same `response` to many chats.
+        | The response is validated and its keyboard is serialized once. The media are uploaded
+        | with the first successful delivery, the rest of the chats receive them by `file_id`.
+        | The deliveries run on `workers` threads and go through the `rate_limiter` of the bot
+        | (or a default :py:class:`~dff_telegram_connector.rate_limit.RateLimiter`, if the bot has none).
+        | A failed delivery does not stop the broadcast: the error is saved in the `progress`.
+        | The :py:class:`~dff_telegram_connector.types.MediaStream` sources need a `key` to be broadcast.
 
+        Parameters
+        -----------
+        chat_ids: Iterable[Union[str, int]]
+            IDs of the recipients. Any iterable can be passed, it is consumed lazily.
+        response: Union[str, dict, df_generics.Response, TelegramResponse]
+            Response data, see :py:meth:`~send_response`.
+        progress: Optional[:py:class:`~dff_telegram_connector.broadcast.BroadcastProgress`]
+            Progress of a previous run to resume. The chats that it marks as delivered are skipped.
+        workers: int
+            Number of the concurrent deliveries.
+        priority: int
+            Priority of the requests for the rate limiter. The default lets the replies to the users go first.
+
+        """
+        progress = progress if progress is not None else BroadcastProgress()
+        ready_response = cast_response(response, trusted=self.trusted_responses)
+        keyboard = ready_response.ui and ready_response.ui.keyboard
+        if isinstance(keyboard, types.JsonSerializable):
+            keyboard = keyboard.to_json()
+        file_cache = self.file_cache if self.file_cache is not None else MemoryFileIdCache()
+        rate_limiter = self.rate_limiter if self.rate_limiter is not None else RateLimiter()
+        attachments = [
+            attachment
+            for attachment in (
+                ready_response.image,
+                ready_response.video,
+                ready_response.document,
+                ready_response.audio,
+                ready_response.attachments,
+            )
+            if attachment is not None
+        ]
+        sources = [getattr(attachment, "source", None) for attachment in attachments]
+        if ready_response.attachments is not None:
+            sources.extend(item.media for item in ready_response.attachments.files)
+        if any(isinstance(source, MediaStream) and source.key is None for source in sources):
+            raise ValueError("A media stream can be sent only once, set its `key` to broadcast it.")
+        has_media = bool(attachments)
+
+        def deliver(chat_id: Union[str, int]) -> bool:
+            try:
+                self._run_send_calls(
+                    *self._get_send_calls(chat_id, ready_response, keyboard, file_cache, rate_limiter, priority)
+                )
+            except Exception as exc:
+                progress.fail(chat_id, exc)
+                return False
+            progress.succeed(chat_id)
+            return True
+
+        progress.start()
+        slots = BoundedSemaphore(workers * 2)
+        recipients = (chat_id for chat_id in chat_ids if not progress.is_delivered(chat_id))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dff-broadcast") as executor:
+            for chat_id in recipients:
+                if progress.cancelled:
+                    break
+                if has_media:
+                    # deliver one by one until the media are uploaded and their ids are cached
+                    has_media = not deliver(chat_id)
+                    continue
+                slots.acquire()
+                executor.submit(deliver, chat_id).add_done_callback(lambda future: slots.release())
+        progress.finish()
+        return progress
+
+    def _get_send_calls(
+        self,
+        chat_id: Union[str, int],
+        ready_response: TelegramResponse,
+        keyboard: Optional[Union[types.JsonSerializable, str]],
+        file_cache: Optional[FileIdCache],
+        rate_limiter: Optional[RateLimiter],
+        priority: int,
+    ) -> Tuple[List[Callable], Callable]:
+        media_calls = []
         for attachment_prop, method in [
             (ready_response.image, self.send_photo),
             (ready_response.video, self.send_video),
@@ -90,27 +288,107 @@ class DFFBot(TeleBot):
         ]:
             if attachment_prop is None:
                 continue
-            params = {"caption": attachment_prop.title}
-            if isinstance(attachment_prop.source, Path):
-                with open(attachment_prop.source, "rb") as file:
-                    method(chat_id, file, **params)
-            else:
-                method(chat_id, attachment_prop.source or attachment_prop.id, **params)
+            media_calls.append(partial(self._send_attachment, method, chat_id, attachment_prop, file_cache))
 
         if ready_response.location:
-            self.send_location(
-                chat_id=chat_id, latitude=ready_response.location.latitude, longitude=ready_response.location.longitude
+            media_calls.append(
+                partial(
+                    self.send_location,
+                    chat_id=chat_id,
+                    latitude=ready_response.location.latitude,
+                    longitude=ready_response.location.longitude,
+                )
             )
 
         if ready_response.attachments:
-            opened_media = [open_io(item) for item in ready_response.attachments.files]
-            self.send_media_group(chat_id=chat_id, media=opened_media)
+            media_calls.append(partial(self._send_media_group, chat_id, ready_response.attachments.files, file_cache))
+
+        text_call = partial(self.send_message, chat_id=chat_id, text=ready_response.text, reply_markup=keyboard)
+        if rate_limiter is not None:
+            media_calls = [partial(rate_limiter.call, chat_id, call, priority=priority) for call in media_calls]
+            text_call = partial(rate_limiter.call, chat_id, text_call, priority=priority)
+        return media_calls, text_call
+
+    def _send_attachment(
+        self,
+        method: Callable,
+        chat_id: Union[str, int],
+        attachment: TelegramAttachment,
+        file_cache: Optional[FileIdCache],
+    ):
+        params = {"caption": attachment.title}
+        file_id = file_cache.get(attachment.source) if file_cache is not None else None
+        if file_id is not None:
+            try:
+                return method(chat_id, file_id, **params)
+            except ApiTelegramException as exc:
+                if not is_file_id_error(exc):
+                    raise
+                file_cache.discard(attachment.source)
+
+        if isinstance(attachment.source, Path):
+            with open(attachment.source, "rb") as file:
+                message = method(chat_id, file, **params)
+        else:
+            message = method(chat_id, attachment.source or attachment.id, **params)
+        if file_cache is not None:
+            file_cache.set(attachment.source, get_file_id(message))
+        return message
+
+    def _send_media_group(
+        self, chat_id: Union[str, int], files: List[types.InputMedia], file_cache: Optional[FileIdCache]
+    ):
+        if file_cache is not None:
+            cached_media = [replace_media(item, file_cache.get(item.media) or item.media) for item in files]
+            if any(cached.media is not item.media for cached, item in zip(cached_media, files)):
+                try:
+                    return self._upload_media_group(chat_id, cached_media, files, file_cache)
+                except ApiTelegramException as exc:
+                    if not is_file_id_error(exc):
+                        raise
+                    for item in files:
+                        file_cache.discard(item.media)
+        return self._upload_media_group(chat_id, files, files, file_cache)
+
+    def _upload_media_group(
+        self,
+        chat_id: Union[str, int],
+        media: List[types.InputMedia],
+        sources: List[types.InputMedia],
+        file_cache: Optional[FileIdCache],
+    ):
+        opened_media = [open_io(item) for item in media]
+        try:
+            messages = self.send_media_group(chat_id=chat_id, media=opened_media)
+        finally:
             for item in opened_media:
                 close_io(item)
-
-        self.send_message(
-            chat_id=chat_id, text=ready_response.text, reply_markup=ready_response.ui and ready_response.ui.keyboard
-        )
+        if file_cache is not None:
+            for item, message in zip(sources, messages):
+                file_cache.set(item.media, get_file_id(message))
+        return messages
+
+    def _get_send_executor(self) -> ThreadPoolExecutor:
+        with self._send_executor_lock:
+            if self._send_executor is None:
+                self._send_executor = ThreadPoolExecutor(max_workers=self._send_workers, thread_name_prefix="dff-send")
+            return self._send_executor
+
+    def _run_send_calls(self, media_calls: List[Callable], text_call: Callable):
+        if self.send_order == SendOrder.SEQUENTIAL or not media_calls:
+            for call in media_calls:
+                call()
+            text_call()
+            return
+
+        executor = self._get_send_executor()
+        if self.send_order == SendOrder.CONCURRENT:
+            media_calls = [*media_calls, text_call]
+        futures = [executor.submit(call) for call in media_calls]
+        for future in futures:
+            future.result()
+        if self.send_order == SendOrder.TEXT_LAST:
+            text_call()
 
 
 class CndNamespace:
@@ -129,10 +407,23 @@ class CndNamespace:
 
     in your :py:class:`~df_engine.core.Script` will always be `True`, unless the new update is not a message.
 
+    | All the conditions created by the namespace share an index keyed by update type, content type and command.
+    | The update is classified once per turn, after which the `content_types` and `commands` filters
+    | of every condition are resolved with a dictionary lookup.
+    | Conditions with identical filters are evaluated at most once per update: the results are kept
+    | in a per-update cache outside of the context (see :py:func:`~dff_telegram_connector.utils.get_turn_cache`),
+    | and the :py:attr:`cache_hits` and :py:attr:`cache_misses` counters track its efficiency.
+
     """
 
     def __init__(self, bot: DFFBot):
         self.bot = bot
+        self._static_filters: List[Tuple[type, Optional[FrozenSet[str]], Optional[FrozenSet[str]]]] = []
+        self._index: Dict[tuple, FrozenSet[int]] = {}
+        self._commands: Set[str] = set()
+        self._result_ids: Dict[tuple, int] = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def handler(
         self, target_type: type, commands=None, regexp=None, func=None, content_types=None, chat_types=None, **kwargs
@@ -142,26 +433,103 @@ class CndNamespace:
         The signature is equal with the :py:class:`~telebot.Telebot` method of the same name.
         """
 
+        handler_id = self._register(target_type, content_types, commands)
         update_handler = self.bot._build_handler_dict(
-            None,
-            False,
-            commands=commands,
-            regexp=regexp,
-            func=func,
-            content_types=content_types,
-            chat_types=chat_types,
-            **kwargs
+            None, False, regexp=regexp, func=func, chat_types=chat_types, **kwargs
         )
+        filter_key = self._get_filter_key(
+            target_type, commands=commands, content_types=content_types, **update_handler["filters"]
+        )
+        # conditions with identical filters share the ID, under which the result is cached
+        result_id = self._result_ids.setdefault(filter_key, len(self._result_ids))
 
         def condition(ctx: Context, actor: Actor, *args, **kwargs):
-            update = ctx.framework_states.get("TELEGRAM_CONNECTOR", {}).get("data")
-            if not update or not isinstance(update, target_type):
+            state = ctx.framework_states.get("TELEGRAM_CONNECTOR", {})
+            update = state.get("data")
+            if not update:
                 return False
-            test_result = self.bot._test_message_handler(update_handler, update)
+            cache = get_turn_cache(ctx)
+            if cache is None:
+                return handler_id in self._get_matches(update, cache) and self._test_handler(update_handler, update)
+
+            results = cache.setdefault("filter_results", {})
+            test_result = results.get(result_id)
+            if test_result is not None:
+                self.cache_hits += 1
+                return test_result
+            self.cache_misses += 1
+            test_result = handler_id in self._get_matches(update, cache) and bool(
+                self._test_handler(update_handler, update)
+            )
+            results[result_id] = test_result
             return test_result
 
         return condition
 
+    @staticmethod
+    def _get_filter_key(target_type: type, **filters) -> tuple:
+        """
+        | Normalize the filters of a handler, so that identical filters produce equal keys.
+        | Lists are compared as sets, callables and unhashable values by identity.
+        """
+        normalized = []
+        for name, value in sorted(filters.items()):
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple, set, frozenset)):
+                value = frozenset(value)
+            try:
+                hash(value)
+            except TypeError:
+                value = ("id", id(value))
+            normalized.append((name, value))
+        return (target_type, tuple(normalized))
+
+    def _register(self, target_type: type, content_types, commands) -> int:
+        """
+        | Add the filters that only depend on the update type, content type and command to the index.
+        | The rest of the filters are tested by the condition itself.
+        """
+        self._static_filters.append(
+            (
+                target_type,
+                frozenset(content_types) if content_types is not None else None,
+                frozenset(commands) if commands is not None else None,
+            )
+        )
+        self._commands.update(commands or ())
+        self._index.clear()
+        return len(self._static_filters) - 1
+
+    def _get_matches(self, update: types.JsonDeserializable, cache: Optional[dict]) -> FrozenSet[int]:
+        """
+        | Returns IDs of the handlers, whose static filters accept the update.
+        | The update is classified once per turn, the classification result is kept in the turn cache.
+        | The commands that no handler declares are indexed as `None`, so that the index stays bounded,
+        | whatever the users type.
+        """
+        key = None if cache is None else cache.get("update_key")
+        if key is None:
+            update_type, content_type, command = classify_update(update)
+            key = (update_type, content_type, command if command in self._commands else None)
+            if cache is not None:
+                cache["update_key"] = key
+
+        matches = self._index.get(key)
+        if matches is None:
+            update_type, content_type, command = key
+            matches = self._index[key] = frozenset(
+                handler_id
+                for handler_id, (target_type, content_types, commands) in enumerate(self._static_filters)
+                if issubclass(update_type, target_type)
+                and (content_types is None or content_type in content_types)
+                and (commands is None or command in commands)
+            )
+        return matches
+
+    def _test_handler(self, update_handler: dict, update: types.JsonDeserializable) -> bool:
+        return self.bot._test_message_handler(update_handler, update)
+
     message_handler = partialmethod(handler, target_type=types.Message)
 
     edited_message_handler = partialmethod(handler, target_type=types.Message)
@@ -208,15 +576,37 @@ class DatabaseMiddleware(BaseMiddleware):
 
     The proper usage of this feature is documented in library examples.
 
+    | To avoid a blocking database round-trip on every update, wrap the connector in a
+    | :py:class:`~dff_telegram_connector.storage.WriteBehindConnector` that caches hot contexts
+    | and writes them in batches.
+    | To store compact byte strings instead of the context objects, wrap it in a
+    | :py:class:`~dff_telegram_connector.storage.SerializingConnector`.
+    | To write only the entries appended during the turn, wrap it in a
+    | :py:class:`~dff_telegram_connector.storage.DeltaConnector`.
+
+    | The middleware keeps striped per-user locks. :py:class:`~dff_telegram_connector.basic_connector.DFFBot`
+    | holds the lock of the user while an update is processed, so `threaded=True` is safe:
+    | updates of the same user never overwrite each other's context, while different users run in parallel.
+
     """
 
-    def __init__(self, db_connector: MutableMapping) -> None:
+    def __init__(
+        self, db_connector: MutableMapping, retention: Optional[RetentionPolicy] = None, lock_stripes: int = 64
+    ) -> None:
         self.update_types = update_types
         self._connector = db_connector
+        self.retention = retention
+        self.locks = StripedLock(lock_stripes)
+
+    def get_lock(self, update) -> Lock:
+        """Lock that guards the context of the user who sent the update."""
+        return self.locks.get(get_user_id(update))
 
     def pre_process(self, update, data: dict):
         user_id = get_user_id(update)
-        context = self._connector.get(user_id, get_initial_context(user_id))
+        context = self._connector.get(user_id)
+        if context is None:
+            context = get_initial_context(user_id)
         context = set_state(context, update)
 
         data["context"] = context
@@ -226,4 +616,7 @@ class DatabaseMiddleware(BaseMiddleware):
             print(exception)
 
         user_id = get_user_id(update)
-        self._connector[user_id] = data["context"]
+        context = data["context"]
+        if self.retention is not None:
+            context = self.retention(context)
+        self._connector[user_id] = context
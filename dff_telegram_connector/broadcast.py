@@ -0,0 +1,89 @@
+"""
+broadcast
+----------
+
+| This module provides the :py:class:`~dff_telegram_connector.broadcast.BroadcastProgress` class
+| that tracks the deliveries of :py:meth:`~dff_telegram_connector.basic_connector.DFFBot.broadcast_response`.
+| A broadcast can be interrupted and resumed: the recipients that have already received the response are skipped.
+
+.. code-block:: python
+
+    progress = BroadcastProgress(delivered=load_delivered_ids())
+    bot.broadcast_response(chat_ids, response, progress=progress)
+    save_delivered_ids(progress.delivered)
+    print(progress.stats(), progress.errors)
+
+"""
+import time
+from threading import Event, Lock
+from typing import Dict, Iterable, Optional, Set, Union
+
+
+class BroadcastProgress:
+    """
+    Delivery state of a broadcast. All the methods are thread-safe.
+
+    Parameters
+    -----------
+
+    delivered: Iterable[Union[str, int]]
+        IDs of the chats that have already received the response, e. g. in an interrupted run.
+
+    """
+
+    def __init__(self, delivered: Iterable[Union[str, int]] = ()):
+        self.delivered: Set[str] = {str(chat_id) for chat_id in delivered}
+        self.errors: Dict[str, Exception] = {}
+        self._lock = Lock()
+        self._cancelled = Event()
+        self._started: Optional[float] = None
+        self._finished: Optional[float] = None
+        self._sent = 0
+
+    def is_delivered(self, chat_id: Union[str, int]) -> bool:
+        return str(chat_id) in self.delivered
+
+    def start(self):
+        with self._lock:
+            self._started = time.monotonic()
+            self._finished = None
+            self._sent = 0
+
+    def finish(self):
+        with self._lock:
+            self._finished = time.monotonic()
+
+    def succeed(self, chat_id: Union[str, int]):
+        """Mark the chat as delivered. An error from a previous attempt is forgotten."""
+        with self._lock:
+            self.delivered.add(str(chat_id))
+            self.errors.pop(str(chat_id), None)
+            self._sent += 1
+
+    def fail(self, chat_id: Union[str, int], exc: Exception):
+        """Record the error of the chat. The chat is retried, when the broadcast is resumed."""
+        with self._lock:
+            self.errors[str(chat_id)] = exc
+
+    def cancel(self):
+        """Stop the broadcast. The deliveries that have already started are finished."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def stats(self) -> dict:
+        """Number of the delivered and the failed chats and the throughput of the last run in chats per second."""
+        with self._lock:
+            if self._started is None:
+                elapsed = 0.0
+            else:
+                elapsed = (self._finished if self._finished is not None else time.monotonic()) - self._started
+            return {
+                "delivered": len(self.delivered),
+                "failed": len(self.errors),
+                "sent": self._sent,
+                "elapsed": elapsed,
+                "throughput": self._sent / elapsed if elapsed > 0 else 0.0,
+            }
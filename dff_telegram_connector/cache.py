@@ -0,0 +1,192 @@
+"""
+cache
+------
+
+| This module provides caches for the Telegram `file_id` values.
+| Once a local file or an URL has been sent, Telegram returns a `file_id` that can be used to send the same file
+| again without uploading it. Pass a cache to :py:class:`~dff_telegram_connector.basic_connector.DFFBot`
+| as the `file_cache` parameter to turn repeated uploads into id-only requests.
+
+.. code-block:: python
+
+    bot = DFFBot(token=token, file_cache=MemoryFileIdCache())
+
+"""
+import shelve
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Any, Optional
+
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+
+from .types import MediaStream
+
+_FILE_ID_ERRORS = ("file identifier", "file_id", "file id")
+
+
+def get_cache_key(source: Any) -> Optional[str]:
+    """
+    | Build a cache key for an attachment source.
+    | Local files are identified by the resolved path, modification time and size, so that an edited file
+    | gets uploaded again. URLs are identified by themselves, streams by their `key`, if it is set.
+    | Other sources are not cached.
+    """
+    if isinstance(source, Path):
+        stat = source.stat()
+        return f"path:{source.resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+    if isinstance(source, str):
+        return f"url:{source}"
+    if isinstance(source, MediaStream) and source.key is not None:
+        return f"stream:{source.key}"
+    return None
+
+
+def get_file_id(message: types.Message) -> Optional[str]:
+    """Extract the `file_id` of the attachment from a message returned by one of the `send_*` methods."""
+    for content_type in ("photo", "video", "document", "audio", "animation", "voice"):
+        content = getattr(message, content_type, None)
+        if not content:
+            continue
+        if isinstance(content, list):  # photos come in several sizes, the largest one is the last
+            content = content[-1]
+        return content.file_id
+    return None
+
+
+def is_file_id_error(exc: Exception) -> bool:
+    """
+    | Check, if Telegram rejected a request because of an invalid or expired `file_id`.
+    | Only such errors mean that the cached id should be dropped and the file uploaded again,
+    | other errors, e. g. flood limits or a blocked bot, would fail the upload as well.
+    """
+    if not isinstance(exc, ApiTelegramException) or exc.error_code != 400:
+        return False
+    description = exc.description.lower()
+    return any(error in description for error in _FILE_ID_ERRORS)
+
+
+class FileIdCache(ABC):
+    """
+    Base class for the `file_id` caches. Subclasses should implement :py:meth:`_get` and :py:meth:`_set`.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, source: Any) -> Optional[str]:
+        """Return a cached `file_id` for the source or `None`."""
+        key = get_cache_key(source)
+        if key is None:
+            return None
+        with self._lock:
+            file_id = self._get(key)
+            if file_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return file_id
+
+    def set(self, source: Any, file_id: Optional[str]):
+        """Save the `file_id` that Telegram returned for the source."""
+        key = get_cache_key(source)
+        if key is None or file_id is None:
+            return
+        with self._lock:
+            self._set(key, file_id)
+
+    def discard(self, source: Any):
+        """Remove the source from the cache, e. g. when Telegram rejects a stale `file_id`."""
+        key = get_cache_key(source)
+        if key is None:
+            return
+        with self._lock:
+            self._discard(key)
+
+    @abstractmethod
+    def _get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _set(self, key: str, file_id: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _discard(self, key: str):
+        raise NotImplementedError
+
+
+class MemoryFileIdCache(FileIdCache):
+    """
+    In-memory `file_id` cache.
+
+    Parameters
+    -----------
+
+    maxsize: Optional[int]
+        Maximum number of the cached entries. Least recently used entries are evicted first.
+        If `None`, the cache is not bounded.
+
+    """
+
+    def __init__(self, maxsize: Optional[int] = 1024):
+        super().__init__()
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, str]" = OrderedDict()
+
+    def _get(self, key: str) -> Optional[str]:
+        file_id = self._data.get(key)
+        if file_id is not None:
+            self._data.move_to_end(key)
+        return file_id
+
+    def _set(self, key: str, file_id: str):
+        self._data[key] = file_id
+        self._data.move_to_end(key)
+        if self.maxsize is not None and len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def _discard(self, key: str):
+        self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ShelveFileIdCache(FileIdCache):
+    """
+    On-disk `file_id` cache based on the :py:mod:`shelve` module. The entries survive restarts of the bot.
+
+    Parameters
+    -----------
+
+    filename: str
+        Path to the database file.
+
+    """
+
+    def __init__(self, filename: str):
+        super().__init__()
+        self._shelf = shelve.open(filename)
+
+    def _get(self, key: str) -> Optional[str]:
+        return self._shelf.get(key)
+
+    def _set(self, key: str, file_id: str):
+        self._shelf[key] = file_id
+        self._shelf.sync()
+
+    def _discard(self, key: str):
+        if key in self._shelf:
+            del self._shelf[key]
+
+    def close(self):
+        with self._lock:
+            self._shelf.close()
+
+    def __len__(self):
+        return len(self._shelf)
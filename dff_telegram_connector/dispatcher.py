@@ -0,0 +1,181 @@
+"""
+dispatcher
+-----------
+
+| Dispatcher module provides the :py:class:`~dff_telegram_connector.dispatcher.UserDispatcher` class.
+| It runs update handlers on a pool of workers, so that updates from different users are processed in parallel,
+| while updates from the same user are still processed strictly in the order of arrival.
+
+"""
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from queue import Full
+from threading import Condition, Lock
+from typing import Callable, Deque, Dict, Hashable, Optional
+
+
+class UserDispatcher:
+    """
+    | Per-user ordered dispatcher for update handlers.
+    | Each call to :py:meth:`submit` is tied to a key (normally the value of `get_user_id`).
+    | Tasks with different keys run concurrently on the underlying executor,
+    | tasks with the same key are queued and started only after the previous one has finished.
+
+    .. code-block:: python
+
+        dispatcher = UserDispatcher(max_workers=8)
+        provider = PollingRequestProvider(bot=bot, dispatcher=dispatcher)
+
+    Parameters
+    -----------
+
+    max_workers: Optional[int]
+        Size of the worker pool. Ignored, if `executor` is passed.
+    executor: Optional[:py:class:`~concurrent.futures.Executor`]
+        | A thread-based executor to run the tasks with. The dispatcher does not own it and never shuts it down.
+        | Process pools are rejected: the tasks are bound methods of the provider holding the runner and the bot,
+        | which can not be pickled. Use a :py:class:`~dff_telegram_connector.sharding.ShardPool` to use processes.
+    max_pending: Optional[int]
+        | Maximum number of unfinished tasks. When it is reached, :py:meth:`submit` raises :py:class:`~queue.Full`
+        | and the task is counted in :py:attr:`dropped`. If `None`, the queue is not bounded.
+
+    """
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        executor: Executor = None,
+        max_pending: Optional[int] = None,
+    ):
+        if isinstance(executor, ProcessPoolExecutor):
+            raise TypeError("UserDispatcher runs the tasks in threads, use a ShardPool for the worker processes")
+        self._owns_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._executor = executor
+        self._lock = Lock()
+        self._task_done = Condition(self._lock)
+        self._queues: Dict[Hashable, Deque[tuple]] = {}
+        self._pending = 0
+        self.max_pending = max_pending
+        self.max_queue_depth = 0
+        self.dropped = 0
+        self.completed = 0
+        self._latencies: Deque[float] = deque(maxlen=1000)
+
+    def submit(self, key: Hashable, func: Callable, *args, **kwargs) -> Future:
+        """
+        Schedule `func(*args, **kwargs)` to be run after all the previously submitted tasks with the same `key`.
+        Returns a :py:class:`~concurrent.futures.Future` that resolves to the result of the call.
+        Raises :py:class:`~queue.Full`, if `max_pending` tasks are already waiting.
+        """
+        future = Future()
+        task = (func, args, kwargs, future, time.perf_counter())
+        with self._lock:
+            if self.max_pending is not None and self._pending >= self.max_pending:
+                self.dropped += 1
+                raise Full(f"{self._pending} tasks are pending")
+            self._pending += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._pending)
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append(task)
+                return future
+            self._queues[key] = deque()
+        self._start(key, task)
+        return future
+
+    def _start(self, key: Hashable, task: tuple):
+        func, args, kwargs, future, submitted = task
+        if not future.set_running_or_notify_cancel():
+            self._finish(key, submitted)
+            return
+        try:
+            inner_future = self._executor.submit(func, *args, **kwargs)
+        except Exception as exc:
+            future.set_exception(exc)
+            self._finish(key, submitted)
+            return
+        inner_future.add_done_callback(partial(self._on_done, key, future, submitted))
+
+    def _on_done(self, key: Hashable, future: Future, submitted: float, inner_future: Future):
+        exception = inner_future.exception()
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(inner_future.result())
+        self._finish(key, submitted)
+
+    def _finish(self, key: Hashable, submitted: float):
+        latency = time.perf_counter() - submitted
+        with self._lock:
+            self._latencies.append(latency)
+            self.completed += 1
+            self._pending -= 1
+            self._task_done.notify_all()
+            queue = self._queues[key]
+            if not queue:
+                del self._queues[key]
+                return
+            next_task = queue.popleft()
+        self._start(key, next_task)
+
+    def wait_for_capacity(self, max_pending: Optional[int] = None, timeout: Optional[float] = None) -> bool:
+        """
+        | Wait until fewer than `max_pending` tasks are unfinished. Defaults to the `max_pending` of the dispatcher,
+        | if neither is set, returns at once. Returns `False`, if the `timeout` has expired.
+        | Call it before :py:meth:`submit` to block the producer instead of dropping the task.
+        """
+        limit = self.max_pending if max_pending is None else max_pending
+        if limit is None:
+            return True
+        with self._task_done:
+            return self._task_done.wait_for(lambda: self._pending < limit, timeout)
+
+    @property
+    def queue_depth(self) -> int:
+        """Total number of tasks that have been submitted, but have not finished yet."""
+        return self._pending
+
+    @property
+    def active_keys(self) -> int:
+        """Number of keys (users) that currently have running or queued tasks."""
+        return len(self._queues)
+
+    def queue_depths(self) -> Dict[Hashable, int]:
+        """Number of unfinished tasks per key. The task that is currently running is included."""
+        with self._lock:
+            return {key: len(queue) + 1 for key, queue in self._queues.items()}
+
+    def latency_percentile(self, share: float) -> float:
+        """Submit-to-completion latency of the recent tasks in seconds, e. g. `share=0.99` for p99."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(share * len(latencies)))]
+
+    def metrics(self) -> dict:
+        """Snapshot of the queue-depth, latency and drop metrics."""
+        return {
+            "queue_depth": self.queue_depth,
+            "active_keys": self.active_keys,
+            "max_queue_depth": self.max_queue_depth,
+            "completed": self.completed,
+            "dropped": self.dropped,
+            "latency_p50": self.latency_percentile(0.5),
+            "latency_p99": self.latency_percentile(0.99),
+        }
+
+    def shutdown(self, wait: bool = True):
+        """
+        Shut down the executor, if it was created by the dispatcher.
+        With `wait=True` all the queued tasks are finished first.
+        """
+        if wait:
+            with self._task_done:
+                self._task_done.wait_for(lambda: self._pending == 0)
+        if self._owns_executor:
+            self._executor.shutdown(wait=wait)
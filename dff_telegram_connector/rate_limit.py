@@ -0,0 +1,202 @@
+"""
+rate_limit
+-----------
+
+| This module provides the :py:class:`~dff_telegram_connector.rate_limit.RateLimiter` class.
+| Telegram limits the outgoing messages of a bot: about 30 messages per second in total,
+| about one message per second in a single chat and 20 messages per minute in a group.
+| Requests over the limit fail with the error 429 "Too Many Requests".
+| Pass a limiter to :py:class:`~dff_telegram_connector.basic_connector.DFFBot` as the `rate_limiter` parameter
+| to keep the outgoing requests within the limits.
+
+.. code-block:: python
+
+    bot = DFFBot(token=token, rate_limiter=RateLimiter())
+
+"""
+import heapq
+import itertools
+import time
+from collections import deque
+from threading import Condition, Lock
+from typing import Callable, Deque, Dict, Hashable, Tuple, Union
+
+from telebot import logger
+from telebot.apihelper import ApiTelegramException
+
+
+class TokenBucket:
+    """
+    | Token bucket that refills at `rate` tokens per second up to `capacity` tokens.
+    | The bucket is not thread-safe, it is guarded by the lock of the :py:class:`~RateLimiter`.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds to wait until a token is available."""
+        self._refill(now)
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+    def reserve(self, now: float) -> float:
+        """Take a token in advance and return the delay after which it may be used."""
+        delay = self.delay(now)
+        self.tokens -= 1
+        return delay
+
+    def block(self, until: float):
+        """Make the bucket unavailable, e. g. for the `retry_after` period of a 429 error."""
+        self.blocked_until = max(self.blocked_until, until)
+
+
+def is_group(chat_id: Union[str, int]) -> bool:
+    """Identifiers of groups, supergroups and channels are negative."""
+    return str(chat_id).startswith("-")
+
+
+class RateLimiter:
+    """
+    | Token-bucket scheduler for the outgoing requests.
+    | Every request takes a token from the per-chat bucket (or the per-group bucket for the group chats)
+    | and from the global bucket. Requests to the same chat are delayed independently of other chats,
+    | while the global tokens are handed out by priority: lower values go first, equal priorities keep their order.
+
+    | When Telegram still responds with 429, the bucket of the chat is blocked for `retry_after` seconds
+    | and the request is retried, up to `max_retries` times.
+
+    Parameters
+    -----------
+
+    global_rate: float
+        Requests per second for the whole bot.
+    chat_rate: float
+        Requests per second for a private chat.
+    group_rate: float
+        Requests per second for a group chat.
+    burst: int
+        Capacity of the per-chat and per-group buckets, i. e. the number of requests that may be sent
+        in a quick succession. A response with media consists of several requests.
+    max_retries: int
+        Number of retries after a 429 error.
+
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        chat_rate: float = 1,
+        group_rate: float = 20 / 60,
+        burst: int = 3,
+        max_retries: int = 3,
+    ):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[Hashable, TokenBucket] = {}
+        self._lock = Lock()
+        self._condition = Condition(self._lock)
+        self._waiting = []
+        self._counter = itertools.count()
+        self._delays: Deque[float] = deque(maxlen=1000)
+        self._started = None
+        self.sent = 0
+        self.retries = 0
+
+    def _get_chat_bucket(self, chat_id: Union[str, int], now: float) -> TokenBucket:
+        key = str(chat_id)
+        bucket = self._chats.get(key)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                self._drop_idle_buckets(now)
+            bucket = self._chats[key] = TokenBucket(self.group_rate if is_group(key) else self.chat_rate, self.burst)
+        return bucket
+
+    def _drop_idle_buckets(self, now: float):
+        for key, bucket in list(self._chats.items()):
+            if bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self._chats[key]
+
+    def acquire(self, chat_id: Union[str, int], priority: int = 0):
+        """Block until a request to the chat may be sent."""
+        enqueued = time.monotonic()
+        with self._lock:
+            if self._started is None:
+                self._started = enqueued
+            chat_delay = self._get_chat_bucket(chat_id, enqueued).reserve(enqueued)
+        if chat_delay > 0:
+            time.sleep(chat_delay)
+
+        ticket: Tuple[int, int] = (priority, next(self._counter))
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    delay = None
+                    if self._waiting[0] == ticket:
+                        delay = self._global.delay(time.monotonic())
+                        if delay == 0:
+                            self._global.tokens -= 1
+                            break
+                    self._condition.wait(delay)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+            self.sent += 1
+            self._delays.append(time.monotonic() - enqueued)
+
+    def call(self, chat_id: Union[str, int], func: Callable, *args, priority: int = 0, **kwargs):
+        """Send a request with `func(*args, **kwargs)` within the limits and retry it after 429 errors."""
+        for attempt in itertools.count():
+            self.acquire(chat_id, priority)
+            try:
+                return func(*args, **kwargs)
+            except ApiTelegramException as exc:
+                if exc.error_code != 429 or attempt >= self.max_retries:
+                    raise
+                self.handle_retry_after(chat_id, exc)
+
+    def handle_retry_after(self, chat_id: Union[str, int], exc: ApiTelegramException):
+        """Block the bucket of the chat for the period that Telegram asked to wait."""
+        retry_after = get_retry_after(exc)
+        logger.warning(f"Flood limit exceeded for chat {chat_id}, retrying in {retry_after} seconds")
+        with self._condition:
+            self.retries += 1
+            now = time.monotonic()
+            self._get_chat_bucket(chat_id, now).block(now + retry_after)
+
+    @property
+    def queue_length(self) -> int:
+        """Number of the requests that wait for a global token."""
+        return len(self._waiting)
+
+    def stats(self) -> dict:
+        """Throughput in requests per second, queueing delay in seconds and the retry count."""
+        with self._lock:
+            delays = sorted(self._delays)
+            elapsed = time.monotonic() - self._started if self._started is not None else 0.0
+            return {
+                "sent": self.sent,
+                "retries": self.retries,
+                "queue_length": len(self._waiting),
+                "throughput": self.sent / elapsed if elapsed > 0 else 0.0,
+                "delay_avg": sum(delays) / len(delays) if delays else 0.0,
+                "delay_max": delays[-1] if delays else 0.0,
+            }
+
+
+def get_retry_after(exc: ApiTelegramException, default: float = 1.0) -> float:
+    """Extract the `retry_after` parameter of a 429 error."""
+    parameters = (exc.result_json or {}).get("parameters") or {}
+    return float(parameters.get("retry_after", default))
@@ -1,10 +1,21 @@
+from functools import partial
+from queue import Queue, Empty, Full
+from threading import Thread
+from typing import List, Optional
+
 from telebot import types, logger
+from telebot.apihelper import ApiTelegramException
 
 from df_engine.core import Context, Actor
 from df_runner import AbsRequestProvider, Runner
 
 from .basic_connector import DFFBot
-from .utils import get_user_id, set_state, get_initial_context
+from .dispatcher import UserDispatcher
+from .rate_limit import get_retry_after
+from .retention import RetentionPolicy
+from .serialization import loads_update
+from .sharding import ShardPool
+from .utils import can_reply, get_user_id, set_state, get_initial_context_factory, unwrap_update
 
 try:
     from flask import Flask, request, abort
@@ -12,57 +23,267 @@ except ImportError:
     Flask, request, abort = None, None, None
 
 
-class PollingRequestProvider(AbsRequestProvider):
+class TelegramRequestProvider(AbsRequestProvider):
     """
-    Class for compatibility with df_runner. Retrieves updates by polling.
+    | Base class for the request providers that handle Telegram updates with a :py:class:`~DFFBot`.
+    | If a :py:class:`~dff_telegram_connector.dispatcher.UserDispatcher` is passed as `dispatcher`,
+    | the updates are handled concurrently: updates from different users run in parallel,
+    | while updates from the same user keep their order.
+    | If a :py:class:`~dff_telegram_connector.sharding.ShardPool` is passed as `shards`, the updates are
+    | routed to the worker processes by user id, and the runner of the provider does not handle them.
+    | A :py:class:`~dff_telegram_connector.retention.RetentionPolicy` passed as `retention` trims the contexts
+    | before the runner saves them.
+    | When the dispatcher or the shard queue is full, the update is dropped and counted in :py:attr:`dropped_updates`.
     """
 
-    def __init__(self, bot: DFFBot, interval=3, allowed_updates=None, timeout=20, long_polling_timeout=20):
+    def __init__(
+        self,
+        bot: DFFBot,
+        dispatcher: Optional[UserDispatcher] = None,
+        shards: Optional[ShardPool] = None,
+        retention: Optional[RetentionPolicy] = None,
+    ):
         self.bot = bot
+        self.retention = retention
+        self.dispatcher = dispatcher
+        self.shards = shards
+        self.dropped_updates = 0
+
+    def _handle_update(self, runner: Runner, update: types.Update):
+        ctx_id, inner_update = unwrap_update(update)
+        self._handle_inner_update(runner, ctx_id, inner_update)
+
+    def _handle_inner_update(self, runner: Runner, ctx_id: str, inner_update: types.JsonDeserializable):
+        try:
+            if self.shards is not None:
+                self.shards.submit(ctx_id, inner_update)
+            elif self.dispatcher is None:
+                self.process_update(runner, ctx_id, inner_update)
+            else:
+                future = self.dispatcher.submit(ctx_id, self.process_update, runner, ctx_id, inner_update)
+                future.add_done_callback(self._report_exception)
+        except Full:
+            self.dropped_updates += 1
+            logger.warning(f"An update from {ctx_id} was dropped: the queue is full")
+
+    def process_update(self, runner: Runner, ctx_id: str, inner_update: types.JsonDeserializable):
+        """
+        Run the actor turn for a single update and send the response back to the user.
+        Updates that do not come from a chat, e. g. polls, update the context without a reply.
+        """
+        ctx: Context = runner.request_handler(ctx_id, inner_update, get_initial_context_factory(ctx_id))
+        if can_reply(inner_update):
+            self.bot.send_response(ctx_id, ctx.last_response)
+
+    def metrics(self) -> dict:
+        """Queue length, enqueue-to-reply latency and drop counts of the background processing."""
+        metrics = {}
+        if self.dispatcher is not None:
+            metrics.update(self.dispatcher.metrics())
+        if self.shards is not None:
+            metrics.update(self.shards.metrics())
+        return {**metrics, "dropped_updates": self.dropped_updates}
+
+    @staticmethod
+    def _report_exception(future):
+        if future.exception() is not None:
+            print(future.exception())
+
+    def _setup_runner(self, runner: Runner):
+        if self.set_state not in runner._pre_annotators:
+            runner._pre_annotators.append(self.set_state)
+        if self.retention is not None and self.retention not in runner._post_annotators:
+            runner._post_annotators.append(self.retention)
+
+    @staticmethod
+    def set_state(ctx: Context, actor: Actor):
+        return set_state(ctx, ctx.last_request)
+
+
+class PollingRequestProvider(TelegramRequestProvider):
+    """
+    Class for compatibility with df_runner. Retrieves updates by polling.
+
+    | With `pipelined=True` a background fetcher keeps a long poll open at all times
+    | and feeds a bounded queue of `queue_size` updates. The fixed `interval` between polls is not applied,
+    | instead the fetcher blocks, when the consumers fall behind and the queue is full.
+    | With a `dispatcher` the updates are taken from the queue only while the dispatcher holds fewer than
+    | `queue_size` unfinished updates, so a slow actor pauses the fetcher instead of growing the dispatcher queue.
+    | The mode hides the round-trip of `getUpdates`, it does not make the actor turns faster:
+    | when they are CPU-bound, the throughput is the same as without pipelining.
+
+    | If the `dispatcher` has a `max_pending` limit, polling waits for a free slot instead of dropping updates.
+    """
+
+    def __init__(
+        self,
+        bot: DFFBot,
+        interval=3,
+        allowed_updates=None,
+        timeout=20,
+        long_polling_timeout=20,
+        dispatcher: Optional[UserDispatcher] = None,
+        pipelined: bool = False,
+        queue_size: int = 100,
+        shards: Optional[ShardPool] = None,
+        retention: Optional[RetentionPolicy] = None,
+    ):
+        super().__init__(bot, dispatcher, shards, retention)
         self.interval = interval
         self.allowed_updates = allowed_updates
         self.timeout = timeout
         self.long_polling_timeout = long_polling_timeout
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+        self._updates_queue: Optional[Queue] = None
 
     def run(self, runner: Runner):
-        if self.set_state not in runner._pre_annotators:
-            runner._pre_annotators.append(self.set_state)
+        self._setup_runner(runner)
 
         self.bot._TeleBot__stop_polling.clear()
         logger.info("started polling")
         self.bot.get_updates(offset=-1)
+        if self.pipelined:
+            self._run_pipelined(runner)
+            return
+
         while not self.bot._TeleBot__stop_polling.wait(self.interval):
             try:
-                updates = self.bot.get_updates(
-                    offset=(self.bot.last_update_id + 1),
-                    allowed_updates=self.allowed_updates,
-                    timeout=self.timeout,
-                    long_polling_timeout=self.long_polling_timeout,
-                )
-                for update in updates:
-                    if update.update_id > self.bot.last_update_id:
-                        self.bot.last_update_id = update.update_id
-                    _, inner_update = next(
-                        filter(
-                            lambda key_val: key_val[0] != "update_id" and key_val[1] is not None,
-                            list(update.__dict__.items()),
-                        )
-                    )
-                    ctx_id = get_user_id(inner_update)
-                    ctx: Context = runner.request_handler(ctx_id, inner_update, get_initial_context(ctx_id))
-                    self.bot.send_response(ctx_id, ctx.last_response)
+                updates = self._get_updates(self.bot.last_update_id + 1)
             except Exception as e:
-                print(e)
-                self.bot._TeleBot__stop_polling.set()
+                if not self._handle_error(e):
+                    break
+                continue
+            if not self._handle_batch(runner, updates, self.dispatcher and self.dispatcher.max_pending):
                 break
 
-    @staticmethod
-    def set_state(ctx: Context, actor: Actor):
-        return set_state(ctx, ctx.last_request)
+    def _handle_batch(self, runner: Runner, updates: List[types.Update], max_pending: Optional[int]) -> bool:
+        """
+        Handle the updates one by one, an error only affects the update that caused it:
+        it is logged, the update is acknowledged and polling continues with the next one,
+        e. g. when a user who has blocked the bot makes the reply fail with 403.
+        An update is acknowledged, once it is handled, so the rest of the batch is not lost, when polling stops.
+        Returns `False`, if polling has been stopped.
+        """
+        for update in updates:
+            if not self._wait_for_dispatcher(max_pending):
+                return False
+            try:
+                self._handle_update(runner, update)
+            except Exception as e:
+                logger.error(f"Update {update.update_id} failed: {e!r}")
+            finally:
+                self._acknowledge(update)
+        return True
+
+    def _run_pipelined(self, runner: Runner):
+        stop_polling = self.bot._TeleBot__stop_polling
+        self._updates_queue = Queue(maxsize=self.queue_size)
+        fetcher = Thread(target=self._fetch_updates, args=(self._updates_queue,), name="dff-fetcher", daemon=True)
+        fetcher.start()
+        while not stop_polling.is_set():
+            try:
+                update = self._updates_queue.get(timeout=self._stop_check_interval)
+            except Empty:
+                continue
+            if not self._handle_batch(runner, [update], self.queue_size):
+                break
+
+    @property
+    def _stop_check_interval(self) -> float:
+        """How often the blocked threads check, if polling has been stopped. A zero `interval` would make them spin."""
+        return max(self.interval, 0.1)
+
+    def _wait_for_dispatcher(self, max_pending: Optional[int]) -> bool:
+        """
+        Block, while the dispatcher holds `max_pending` unfinished updates.
+        Returns `False`, if polling has been stopped meanwhile.
+        """
+        if self.dispatcher is None or max_pending is None:
+            return True
+        if self.dispatcher.max_pending is not None:
+            max_pending = min(max_pending, self.dispatcher.max_pending)
+        stop_polling = self.bot._TeleBot__stop_polling
+        while not self.dispatcher.wait_for_capacity(max_pending, timeout=self._stop_check_interval):
+            if stop_polling.is_set():
+                return False
+        return True
+
+    def _fetch_updates(self, updates_queue: Queue):
+        """
+        Keep a long poll open while the previous batch is being processed.
+        When the queue is full, the fetcher blocks instead of polling further, which provides the backpressure.
+        """
+        stop_polling = self.bot._TeleBot__stop_polling
+        offset = self.bot.last_update_id + 1
+        while not stop_polling.is_set():
+            try:
+                updates = self._get_updates(offset)
+            except Exception as e:
+                if not self._handle_error(e):
+                    break
+                continue
+            for update in updates:
+                offset = max(offset, update.update_id + 1)
+                while not stop_polling.is_set():
+                    try:
+                        updates_queue.put(update, timeout=self._stop_check_interval)
+                        break
+                    except Full:
+                        continue
+
+    def _handle_error(self, exc: Exception) -> bool:
+        """
+        Handle an error of `getUpdates`. Flood limit errors (429) pause polling for the `retry_after` period,
+        any other error stops it. Returns `True`, if polling may continue.
+        """
+        stop_polling = self.bot._TeleBot__stop_polling
+        if isinstance(exc, ApiTelegramException) and exc.error_code == 429:
+            retry_after = get_retry_after(exc)
+            logger.warning(f"Flood limit exceeded, polling is paused for {retry_after} seconds")
+            stop_polling.wait(retry_after)
+            return True
+        print(exc)
+        stop_polling.set()
+        return False
 
+    def _get_updates(self, offset: int) -> List[types.Update]:
+        return self.bot.get_updates(
+            offset=offset,
+            allowed_updates=self.allowed_updates,
+            timeout=self.timeout,
+            long_polling_timeout=self.long_polling_timeout,
+        )
 
-class FlaskRequestProvider(AbsRequestProvider):
-    """Class for compatibility with df_runner. Retrieves updates from post json requests."""
+    def _acknowledge(self, update: types.Update):
+        """Mark the update as handled. The next poll of :py:meth:`run` starts after the last handled update."""
+        if update.update_id > self.bot.last_update_id:
+            self.bot.last_update_id = update.update_id
+
+    @property
+    def pending_updates(self) -> int:
+        """Number of fetched updates that wait in the queue. Only meaningful in the pipelined mode."""
+        return self._updates_queue.qsize() if self._updates_queue is not None else 0
+
+
+class FlaskRequestProvider(TelegramRequestProvider):
+    """
+    Class for compatibility with df_runner. Retrieves updates from post json requests.
+
+    | If a :py:class:`~dff_telegram_connector.dispatcher.UserDispatcher` is passed as `dispatcher`,
+    | the webhook request is answered as soon as the update is validated and queued,
+    | the actor turn and the replies are processed by the dispatcher workers in the background.
+    | Telegram does not have to wait for a slow reply, so it neither retries nor throttles the webhook.
+
+    | With `lazy_updates=True` the request body is not converted to telebot objects.
+    | The updates are passed to the runner as :py:class:`~dff_telegram_connector.serialization.LazyUpdate`
+    | instances that build the telebot objects only when the script reads fields other than the plain values,
+    | users and chats. Use :py:func:`~dff_telegram_connector.utils.get_update_class` instead of :py:func:`type`
+    | to check the type of such an update: :py:func:`isinstance` checks against telebot classes fail for it.
+    | The option is off by default. Measured with `benchmarks/run_benchmarks.py` (20 turns, 5 ms latency),
+    | parsing alone is not faster (about 11.2k updates/s both ways for 1 user, at most 7% faster for 10 users),
+    | the webhook round trip gains about 20% throughput for 1 user and about 45% for 10 and 50 users.
+    """
 
     def __init__(
         self,
@@ -72,45 +293,42 @@ class FlaskRequestProvider(AbsRequestProvider):
         port: int = 8443,
         endpoint: str = "/dff-bot",
         full_uri: str = None,
+        dispatcher: Optional[UserDispatcher] = None,
+        shards: Optional[ShardPool] = None,
+        retention: Optional[RetentionPolicy] = None,
+        lazy_updates: bool = False,
     ):
         if Flask is None or request is None or abort is None:
             raise ModuleNotFoundError("Flask is not installed")
 
-        self.bot = bot
+        super().__init__(bot, dispatcher, shards, retention)
         self.app = app
         self.host = host
         self.port = port
         self.endpoint = endpoint
         self.full_uri = full_uri or "".join([f"https://{host}:{port}", endpoint])
+        self.lazy_updates = lazy_updates
 
     def run(self, runner: Runner):
-        if self.set_state not in runner._pre_annotators:
-            runner._pre_annotators.append(self.set_state)
-
-        def handle_updates():
-            if not request.headers.get("content-type") == "application/json":
-                abort(403)
-            json_string = request.get_data().decode("utf-8")
-            update = types.Update.de_json(json_string)
-            if update.update_id > self.bot.last_update_id:
-                self.bot.last_update_id = update.update_id
-            _, inner_update = next(
-                filter(
-                    lambda key_val: key_val[0] != "update_id" and key_val[1] is not None,
-                    list(update.__dict__.items()),
-                )
-            )
-            ctx_id = get_user_id(inner_update)
-            ctx: Context = runner.request_handler(ctx_id, inner_update)
-            self.bot.send_response(id, ctx.last_response)
-            return ""
+        self._setup_runner(runner)
 
-        self.app.route(self.endpoint, methods=["POST"])(handle_updates)
+        self.app.route(self.endpoint, methods=["POST"], endpoint="dff_bot")(partial(self.handle_updates, runner))
         self.bot.remove_webhook()
         self.bot.set_webhook(self.full_uri)
 
         self.app.run(host=self.host, port=self.port)
 
-    @staticmethod
-    def set_state(ctx: Context, actor: Actor):
-        return set_state(ctx, ctx.last_request)
+    def handle_updates(self, runner: Runner):
+        if not request.headers.get("content-type") == "application/json":
+            abort(403)
+        if self.lazy_updates:
+            update_id, inner_update = loads_update(request.get_data())
+            ctx_id = get_user_id(inner_update)
+        else:
+            update = types.Update.de_json(request.get_data().decode("utf-8"))
+            update_id = update.update_id
+            ctx_id, inner_update = unwrap_update(update)
+        if update_id > self.bot.last_update_id:
+            self.bot.last_update_id = update_id
+        self._handle_inner_update(runner, ctx_id, inner_update)
+        return ""
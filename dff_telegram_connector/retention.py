@@ -0,0 +1,137 @@
+"""
+retention
+----------
+
+| This module provides the :py:class:`~dff_telegram_connector.retention.RetentionPolicy` class.
+| Every update adds requests, a response and a label to the context, so the histories of long-lived users
+| grow without bounds, and so does the time needed to load and save their contexts.
+| A retention policy trims the histories before the context is persisted.
+
+| Pass a policy to :py:class:`~dff_telegram_connector.basic_connector.DFFBot` as the `retention` parameter
+| to use it with the :py:class:`~dff_telegram_connector.basic_connector.DatabaseMiddleware`,
+| or to a request provider to apply it to the contexts saved by the runner.
+
+.. code-block:: python
+
+    provider = PollingRequestProvider(bot=bot, retention=RetentionPolicy(max_turns=20))
+
+"""
+import time
+from threading import Lock
+from typing import Callable, Dict, Hashable, List, Optional
+
+from df_engine.core import Actor, Context
+
+HISTORY_FIELDS = ("requests", "responses", "labels")
+
+
+def get_context_size(ctx: Context) -> int:
+    """Total number of the entries in the request, response and label histories."""
+    return sum(len(getattr(ctx, field)) for field in HISTORY_FIELDS)
+
+
+class RetentionPolicy:
+    """
+    | Policy that decides which turns of a context are kept.
+    | A turn is everything the context gained between two calls of the policy: e. g. with the
+    | :py:class:`~df_runner.Runner` an update adds two requests, a response and a label.
+    | The boundaries of the turns are recorded in the framework states. The entries that the policy sees
+    | for the first time are split into as many turns as there are new labels.
+    | A turn is kept only if all the configured criteria keep it. The latest turn is always kept.
+    | The policy is also a :py:class:`~df_runner.Runner` annotator: called with a context, it trims it in place
+    | and returns it.
+
+    Parameters
+    -----------
+
+    max_turns: Optional[int]
+        Number of the latest turns to keep.
+    max_age: Optional[float]
+        Maximum age of a turn in seconds. The time of every turn is recorded in the framework states,
+        when the policy first sees the turn.
+    predicate: Optional[Callable[[Context, Optional[int]], bool]]
+        Function that receives the context and the index of the label of a turn (`None` for a turn without a label)
+        and returns `True`, if the turn is kept.
+
+    """
+
+    def __init__(
+        self,
+        max_turns: Optional[int] = None,
+        max_age: Optional[float] = None,
+        predicate: Optional[Callable[[Context, Optional[int]], bool]] = None,
+    ):
+        if max_turns is not None and max_turns < 1:
+            raise ValueError("max_turns should be positive")
+        self.max_turns = max_turns
+        self.max_age = max_age
+        self.predicate = predicate
+        self._lock = Lock()
+        self.sizes: Dict[Hashable, int] = {}
+        self.trimmed = 0
+
+    def __call__(self, ctx: Context, actor: Optional[Actor] = None) -> Context:
+        states = ctx.framework_states.setdefault("TELEGRAM_CONNECTOR", {})
+        states.pop("turn_times", None)
+        turns = self._get_turns(ctx, states.get("turns", []))
+        dropped = self._get_dropped(ctx, turns)
+        for position in dropped:
+            starts = turns[position - 1][1:] if position > 0 else [-1] * len(HISTORY_FIELDS)
+            for field, start, end in zip(HISTORY_FIELDS, starts, turns[position][1:]):
+                history = getattr(ctx, field)
+                for index in [index for index in history if start < index <= end]:
+                    del history[index]
+        states["turns"] = [turn for position, turn in enumerate(turns) if position not in dropped]
+        with self._lock:
+            self.trimmed += len(dropped)
+            self.sizes[ctx.id] = get_context_size(ctx)
+        return ctx
+
+    @staticmethod
+    def _get_turns(ctx: Context, turns: List[list]) -> List[list]:
+        """
+        | Returns the recorded turns followed by the new ones. A turn is a list of its time
+        | and the last index of every history field, the entries of a turn follow the ones of the previous turn.
+        """
+        turns = [list(turn) for turn in turns]
+        ends = turns[-1][1:] if turns else [-1] * len(HISTORY_FIELDS)
+        new_entries = [
+            sorted(index for index in getattr(ctx, field) if index > end) for field, end in zip(HISTORY_FIELDS, ends)
+        ]
+        new_turns = len(new_entries[-1]) or int(any(new_entries))
+        now = time.time()
+        for turn in range(new_turns):
+            turn_ends = []
+            for entries, end in zip(new_entries, ends):
+                # the new entries are spread evenly over the new turns, the surplus goes to the first ones
+                count = -(-len(entries) * (turn + 1) // new_turns)
+                turn_ends.append(entries[count - 1] if count else end)
+            turns.append([now, *turn_ends])
+        return turns
+
+    def _get_dropped(self, ctx: Context, turns: List[list]) -> List[int]:
+        candidates = range(len(turns) - 1)
+        dropped = set()
+        if self.max_turns is not None:
+            dropped.update(candidates[: len(turns) - self.max_turns])
+        if self.max_age is not None:
+            now = time.time()
+            dropped.update(position for position in candidates if now - turns[position][0] > self.max_age)
+        if self.predicate is not None:
+            for position in candidates:
+                label_end = turns[position][-1]
+                has_label = label_end > (turns[position - 1][-1] if position > 0 else -1)
+                if not self.predicate(ctx, label_end if has_label else None):
+                    dropped.add(position)
+        return sorted(dropped)
+
+    def stats(self) -> dict:
+        """Number of the trimmed turns and the history size of the contexts after trimming."""
+        with self._lock:
+            sizes = list(self.sizes.values())
+            return {
+                "trimmed": self.trimmed,
+                "contexts": len(sizes),
+                "size_avg": sum(sizes) / len(sizes) if sizes else 0.0,
+                "size_max": max(sizes, default=0),
+            }
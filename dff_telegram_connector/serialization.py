@@ -0,0 +1,360 @@
+"""
+serialization
+--------------
+
+| This module provides serializers that turn the contexts into compact byte strings.
+| Use them with :py:class:`~dff_telegram_connector.storage.SerializingConnector`
+| to store the contexts in backends that keep bytes, e. g. key-value stores.
+
+| The Telegram updates that the runner adds to the requests and :py:func:`~dff_telegram_connector.utils.set_state`
+| puts in the framework states are stored as the raw Bot API JSON instead of a pickled object tree.
+| On load, the updates are wrapped in :py:class:`~LazyUpdate` instances that parses it only when it is accessed.
+| :py:func:`~loads_update` wraps the updates received by a webhook the same way.
+
+.. code-block:: python
+
+    connector = SerializingConnector(db_connector, MsgpackSerializer(compression="zlib"))
+    bot = DFFBot(token=token, db_connector=connector)
+
+"""
+import json
+import lzma
+import pickle
+import zlib
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, FrozenSet, Optional, Tuple, Union
+
+from pydantic import BaseModel
+from telebot import types
+
+from df_engine.core import Context
+
+from .types import MediaStream
+from .utils import UPDATE_FIELDS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+COMPRESSIONS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+_RENAMED_FIELDS = {"from_user": "from"}
+
+
+def update_to_json(update: Any) -> Any:
+    """
+    | Convert a telebot object back to the Bot API JSON.
+    | Messages keep the JSON they were parsed from, other objects are converted field by field.
+    """
+    if isinstance(update, list):
+        return [update_to_json(item) for item in update]
+    if not isinstance(update, types.JsonDeserializable):
+        return update
+    raw_json = getattr(update, "json", None)
+    if isinstance(raw_json, dict):
+        return raw_json
+    return {
+        _RENAMED_FIELDS.get(key, key): update_to_json(value)
+        for key, value in update.__dict__.items()
+        if value is not None
+    }
+
+
+class LazyUpdate:
+    """
+    | Telegram update that keeps the Bot API JSON and the name of the telebot class.
+    | Scalar fields, e. g. `text` or `data`, are read from the JSON directly, and the fields that hold
+    | users, chats and messages are wrapped in lazy updates too. The telebot object is created
+    | only when any other attribute is accessed.
+    | The update is treated as immutable: copying it returns the same instance.
+    | It is not an instance of the telebot class, so :py:func:`isinstance` checks see the wrapper.
+    | The attributes learned from the materialized objects are kept per telebot class
+    | for the whole process, not per update.
+    """
+
+    __slots__ = ("update_type", "json", "_update", "_nested")
+
+    def __init__(self, update_type: str, json: dict):
+        self.update_type = update_type
+        self.json = json
+        self._update = None
+        self._nested = None
+
+    @property
+    def update_class(self) -> type:
+        """Class of the telebot object."""
+        return getattr(types, self.update_type)
+
+    def materialize(self) -> types.JsonDeserializable:
+        """Return the telebot object."""
+        if self._update is None:
+            self._update = getattr(types, self.update_type).de_json(self.json)
+            _learn_attributes(self.update_type, self.json, self._update)
+        return self._update
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if self._update is None:
+            key = _RENAMED_FIELDS.get(name, name)
+            value = self.json.get(key)
+            if type(value) in _SCALAR_TYPES:
+                return value
+            if key in _NESTED_TYPES and isinstance(value, dict):
+                return self._get_nested(key, value)
+            if name == "content_type":
+                if self.update_type != "Message":
+                    raise AttributeError(name)
+                if "text" in self.json:
+                    return "text"
+            elif value is None:
+                if name in _OPTIONAL_ATTRIBUTES.get(self.update_type, ()):
+                    return None
+                attributes = _ATTRIBUTES.get(self.update_type)
+                if attributes is not None and name not in attributes and not hasattr(self.update_class, name):
+                    raise AttributeError(name)
+        return getattr(self.materialize(), name)
+
+    def _get_nested(self, key: str, value: dict) -> "LazyUpdate":
+        if self._nested is None:
+            self._nested = {}
+        nested = self._nested.get(key)
+        if nested is None:
+            nested = self._nested[key] = LazyUpdate(_NESTED_TYPES[key], value)
+        return nested
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo: dict):
+        return self
+
+    def __getstate__(self):
+        return self.update_type, self.json
+
+    def __setstate__(self, state):
+        self.update_type, self.json = state
+        self._update = None
+        self._nested = None
+
+
+_SCALAR_TYPES = (str, int, float, bool)
+
+_NESTED_TYPES = {"from": "User", "chat": "Chat", "sender_chat": "Chat", "user": "User", "message": "Message"}
+
+# attributes of the telebot objects seen so far, per class, and the ones that were None when their key was missing
+_ATTRIBUTES: Dict[str, FrozenSet[str]] = {}
+_OPTIONAL_ATTRIBUTES: Dict[str, FrozenSet[str]] = {}
+
+
+def _learn_attributes(update_type: str, update_json: dict, update: types.JsonDeserializable):
+    """
+    | Remember the attributes of a materialized update, so that the lazy updates of the same class
+    | can answer the lookups of the absent optional fields without materializing.
+    """
+    attributes = vars(update)
+    optional = frozenset(
+        name
+        for name, value in attributes.items()
+        if value is None and _RENAMED_FIELDS.get(name, name) not in update_json
+    )
+    _ATTRIBUTES[update_type] = _ATTRIBUTES.get(update_type, frozenset()).union(attributes)
+    _OPTIONAL_ATTRIBUTES[update_type] = _OPTIONAL_ATTRIBUTES.get(update_type, frozenset()).union(optional)
+
+
+def loads_update(data: Union[bytes, str]) -> Tuple[int, LazyUpdate]:
+    """
+    | Parse the Bot API JSON of an :py:class:`~telebot.types.Update` without building the telebot objects.
+    | Returns the update id and the inner update wrapped in a :py:class:`~LazyUpdate`.
+    | The JSON is parsed with :py:mod:`orjson` straight from the bytes, if it is installed.
+    """
+    update = orjson.loads(data) if orjson is not None else json.loads(data)
+    for field, update_class in UPDATE_FIELDS.items():
+        inner_update = update.get(field)
+        if inner_update is not None:
+            return update["update_id"], LazyUpdate(update_class.__name__, inner_update)
+    raise ValueError(f"Update {update.get('update_id')} has no known fields")
+
+
+def compact_update(update: Any) -> Optional[dict]:
+    """Convert the update kept in the context into a JSON-compatible dict."""
+    if update is None:
+        return None
+    if isinstance(update, LazyUpdate):
+        return {"type": update.update_type, "json": update.json}
+    return {"type": type(update).__name__, "json": update_to_json(update)}
+
+
+def restore_update(compacted: Optional[dict]) -> Optional[LazyUpdate]:
+    if compacted is None:
+        return None
+    return LazyUpdate(compacted["type"], compacted["json"])
+
+
+def _to_builtins(value: Any) -> Any:
+    """Fallback for the values that JSON and msgpack do not support natively."""
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if isinstance(value, types.JsonSerializable):
+        return json.loads(value.to_json())
+    if isinstance(value, LazyUpdate):
+        return compact_update(value)
+    if isinstance(value, MediaStream):
+        return {"filename": value.filename, "size": value.size, "key": value.key}
+    if isinstance(value, Path):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} cannot be serialized")
+
+
+class Serializer(ABC):
+    """
+    Base class for the serializers. Subclasses should implement :py:meth:`_dumps` and :py:meth:`_loads`.
+
+    Parameters
+    -----------
+
+    compression: Optional[str]
+        Compression of the serialized data: `"zlib"`, `"lzma"` or `None`.
+
+    """
+
+    def __init__(self, compression: Optional[str] = None):
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+        self.compression = compression
+
+    def dumps(self, ctx: Context) -> bytes:
+        data = self._dumps(self._compact(ctx))
+        if self.compression is not None:
+            data = COMPRESSIONS[self.compression][0](data)
+        return data
+
+    def loads(self, data: bytes) -> Context:
+        if self.compression is not None:
+            data = COMPRESSIONS[self.compression][1](data)
+        return self._restore(self._loads(data))
+
+    @staticmethod
+    def _compact_states(framework_states: dict) -> dict:
+        framework_states = dict(framework_states)
+        connector_states = framework_states.get("TELEGRAM_CONNECTOR")
+        if connector_states is not None:
+            connector_states = dict(connector_states)
+            connector_states["data"] = compact_update(connector_states.get("data"))
+            framework_states["TELEGRAM_CONNECTOR"] = connector_states
+        return framework_states
+
+    @staticmethod
+    def _compact_requests(requests: dict) -> dict:
+        return {
+            index: {"__update__": compact_update(request)}
+            if isinstance(request, (types.JsonDeserializable, LazyUpdate))
+            else request
+            for index, request in requests.items()
+        }
+
+    @staticmethod
+    def _restore_requests(requests: dict) -> dict:
+        return {
+            index: restore_update(request["__update__"])
+            if isinstance(request, dict) and request.keys() == {"__update__"}
+            else request
+            for index, request in requests.items()
+        }
+
+    @staticmethod
+    def _restore_states(framework_states: dict) -> dict:
+        connector_states = framework_states.get("TELEGRAM_CONNECTOR")
+        if connector_states is not None:
+            connector_states["data"] = restore_update(connector_states.get("data"))
+        return framework_states
+
+    def _compact(self, ctx: Context) -> Any:
+        data = ctx.dict()
+        data["requests"] = self._compact_requests(ctx.requests)
+        data["framework_states"] = self._compact_states(ctx.framework_states)
+        return data
+
+    def _restore(self, data: Any) -> Context:
+        data["requests"] = self._restore_requests(data["requests"])
+        data["framework_states"] = self._restore_states(data["framework_states"])
+        return Context.parse_obj(data)
+
+    @abstractmethod
+    def _dumps(self, data: Any) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _loads(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class PickleSerializer(Serializer):
+    """
+    | Serializer based on :py:mod:`pickle`. Any picklable responses and states are supported.
+    | The context object is pickled directly, so loading it needs no validation.
+    """
+
+    def _compact(self, ctx: Context) -> Context:
+        return ctx.copy(
+            update={
+                "requests": self._compact_requests(ctx.requests),
+                "framework_states": self._compact_states(ctx.framework_states),
+            }
+        )
+
+    def _restore(self, ctx: Context) -> Context:
+        ctx.requests = self._restore_requests(ctx.requests)
+        self._restore_states(ctx.framework_states)
+        return ctx
+
+    def _dumps(self, data: Context) -> bytes:
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _loads(self, data: bytes) -> Context:
+        return pickle.loads(data)
+
+
+class JSONSerializer(Serializer):
+    """
+    | Serializer to JSON. It uses :py:mod:`orjson`, if it is installed, and :py:mod:`json` otherwise.
+    | Pydantic models and telebot objects in the responses and states are stored as dicts.
+    """
+
+    def _dumps(self, data: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(data, default=_to_builtins, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(data, default=_to_builtins, separators=(",", ":")).encode("utf-8")
+
+    def _loads(self, data: bytes) -> Any:
+        return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+class MsgpackSerializer(Serializer):
+    """
+    | Serializer to the binary `msgpack` format. Requires the :py:mod:`msgpack` package.
+    | Pydantic models and telebot objects in the responses and states are stored as dicts.
+    """
+
+    def __init__(self, compression: Optional[str] = None):
+        if msgpack is None:
+            raise ModuleNotFoundError("msgpack is not installed")
+        super().__init__(compression)
+
+    def _dumps(self, data: Any) -> bytes:
+        return msgpack.packb(data, default=_to_builtins)
+
+    def _loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, strict_map_key=False)
@@ -0,0 +1,169 @@
+"""
+sharding
+---------
+
+| Sharding module provides the :py:class:`~dff_telegram_connector.sharding.ShardPool` class.
+| It spreads the conversations across several worker processes, so that a busy bot is not limited
+| to a single core. Every update is routed by a stable hash of the user id, which means that
+| the updates of a user are always processed by the same worker, one after another.
+
+| Each worker builds its own :py:class:`~df_runner.Runner` and bot with the `worker_factory`.
+| The factory is called in the worker process, so the actor, the bot and the context cache are not shared.
+
+.. code-block:: python
+
+    def create_worker():
+        from my_bot import actor, bot, db  # the script conditions refer to the worker's own bot
+        return Runner(actor=actor, db=db), bot
+
+    if __name__ == "__main__":
+        shards = ShardPool(create_worker, workers=4)
+        provider = PollingRequestProvider(bot=bot, shards=shards)
+        runner = Runner(actor=actor, request_provider=provider)
+        runner.start()
+
+"""
+import multiprocessing
+from hashlib import blake2b
+from typing import Callable, List, Optional, Tuple
+
+from telebot import types
+
+from df_engine.core import Actor, Context
+from df_runner import Runner
+
+from .utils import can_reply, get_initial_context_factory, set_state
+
+_FLUSH = "flush"
+
+
+def get_shard(user_id: str, shards: int) -> int:
+    """
+    | Choose one of `shards` workers for the user with rendezvous hashing.
+    | Unlike the built-in :py:func:`hash`, the result is the same in all processes and between restarts.
+    | When the number of shards changes from `N` to `N + 1`, only about `1 / (N + 1)` of the users move.
+    """
+    return max(range(shards), key=lambda shard: blake2b(f"{shard}:{user_id}".encode("utf-8"), digest_size=8).digest())
+
+
+def _set_state(ctx: Context, actor: Actor):
+    return set_state(ctx, ctx.last_request)
+
+
+def _run_worker(worker_factory: Callable, tasks: "multiprocessing.JoinableQueue"):
+    runner, bot = worker_factory()
+    if _set_state not in runner._pre_annotators:
+        runner._pre_annotators.append(_set_state)
+    while True:
+        item = tasks.get()
+        try:
+            if item is None:
+                return
+            if item == _FLUSH:
+                flush = getattr(runner._db, "flush", None)
+                if flush is not None:
+                    flush()
+                continue
+            ctx_id, inner_update = item
+            ctx: Context = runner.request_handler(ctx_id, inner_update, get_initial_context_factory(ctx_id))
+            if can_reply(inner_update):
+                bot.send_response(ctx_id, ctx.last_response)
+        except Exception as e:
+            print(e)
+        finally:
+            tasks.task_done()
+
+
+class ShardPool:
+    """
+    Pool of worker processes that handle the updates routed by :py:func:`get_shard`.
+
+    Parameters
+    -----------
+
+    worker_factory: Callable[[], Tuple[:py:class:`~df_runner.Runner`, :py:class:`~DFFBot`]]
+        | Function that creates the runner and the bot of a worker. It has to be picklable, i. e. defined
+        | at the top level of a module, if the `spawn` start method is used.
+    workers: int
+        Number of the worker processes.
+    queue_size: int
+        Maximum number of the updates waiting for a worker. When it is reached, :py:meth:`submit` blocks.
+    submit_timeout: Optional[float]
+        If set, :py:meth:`submit` raises :py:class:`~queue.Full` after waiting that many seconds.
+    start_method: Optional[str]
+        Start method for the processes: `"fork"`, `"spawn"` or `"forkserver"`. Defaults to the platform default.
+
+    """
+
+    def __init__(
+        self,
+        worker_factory: Callable[[], Tuple[Runner, object]],
+        workers: int = 2,
+        queue_size: int = 100,
+        submit_timeout: Optional[float] = None,
+        start_method: Optional[str] = None,
+    ):
+        self.worker_factory = worker_factory
+        self.queue_size = queue_size
+        self.submit_timeout = submit_timeout
+        self._mp = multiprocessing.get_context(start_method)
+        self._queues: List["multiprocessing.JoinableQueue"] = []
+        self._processes: List["multiprocessing.Process"] = []
+        self.routed: List[int] = []
+        self._start_workers(workers)
+
+    @property
+    def workers(self) -> int:
+        return len(self._processes)
+
+    def _start_workers(self, workers: int):
+        for shard in range(len(self._processes), workers):
+            tasks = self._mp.JoinableQueue(maxsize=self.queue_size)
+            process = self._mp.Process(
+                target=_run_worker, args=(self.worker_factory, tasks), name=f"dff-shard-{shard}", daemon=True
+            )
+            process.start()
+            self._queues.append(tasks)
+            self._processes.append(process)
+            self.routed.append(0)
+
+    def _stop_workers(self, workers: int):
+        for tasks in self._queues[workers:]:
+            tasks.put(None)
+        for process in self._processes[workers:]:
+            process.join()
+        del self._queues[workers:], self._processes[workers:], self.routed[workers:]
+
+    def submit(self, ctx_id: str, inner_update: types.JsonDeserializable):
+        """Send the update to the worker that owns the user. The update object has to be picklable."""
+        shard = get_shard(ctx_id, self.workers)
+        self._queues[shard].put((ctx_id, inner_update), timeout=self.submit_timeout)
+        self.routed[shard] += 1
+
+    def drain(self):
+        """Wait until all the submitted updates are processed and the workers flush their databases."""
+        for tasks in self._queues:
+            tasks.put(_FLUSH)
+        for tasks in self._queues:
+            tasks.join()
+
+    def resize(self, workers: int):
+        """
+        | Change the number of the workers. Call it from the thread that submits the updates.
+        | The queued updates are processed first, so the order of the updates of the users that move
+        | to another worker is preserved. The moved contexts are loaded from the database of the new worker,
+        | so the workers have to share the database.
+        """
+        self.drain()
+        if workers < self.workers:
+            self._stop_workers(workers)
+        else:
+            self._start_workers(workers)
+
+    def metrics(self) -> dict:
+        """Number of the updates routed to every worker."""
+        return {"workers": self.workers, "routed": list(self.routed)}
+
+    def shutdown(self):
+        """Process the queued updates and stop the workers."""
+        self._stop_workers(0)
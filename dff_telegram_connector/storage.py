@@ -0,0 +1,430 @@
+"""
+storage
+--------
+
+| This module provides wrappers for the `db_connector` objects that are used by
+| :py:class:`~dff_telegram_connector.basic_connector.DatabaseMiddleware` and the request providers.
+| The wrappers implement the same :py:class:`~typing.MutableMapping` interface, so they can be stacked
+| on top of any database connector.
+
+.. code-block:: python
+
+    connector = WriteBehindConnector(SqlConnector("SOME_URI"))
+    bot = DFFBot(token=token, db_connector=connector)
+
+"""
+import atexit
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Event, Lock, RLock, Thread
+from typing import Any, Dict, Hashable, Iterator, MutableMapping, Optional, Set
+
+from df_engine.core import Context
+
+from .retention import HISTORY_FIELDS
+from .serialization import Serializer, PickleSerializer
+
+
+class WriteBehindConnector(MutableMapping):
+    """
+    | Write-behind cache for a database connector.
+    | Recently used contexts are kept in an in-process LRU cache, so that reads of hot contexts need no round-trip.
+    | Writes only mark the entry as dirty. Dirty entries are coalesced and written to the wrapped connector
+    | in batches: on a timer, when the number of dirty entries reaches the threshold, or on :py:meth:`close`.
+
+    Parameters
+    -----------
+
+    db_connector: :py:class:`~typing.MutableMapping`
+        The connector that persists the data.
+    cache_size: int
+        Maximum number of the entries kept in memory. Dirty entries are never evicted before they are flushed.
+    flush_interval: Optional[float]
+        Period of the background flush in seconds. If `None`, no background thread is started
+        and the data is flushed by the threshold or manually.
+    flush_threshold: int
+        Number of dirty entries that triggers a flush.
+
+    """
+
+    def __init__(
+        self,
+        db_connector: MutableMapping,
+        cache_size: int = 1024,
+        flush_interval: Optional[float] = 1.0,
+        flush_threshold: int = 100,
+    ):
+        self._connector = db_connector
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._cache: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._dirty: Set[Hashable] = set()
+        self._deleted: Set[Hashable] = set()
+        self._lock = RLock()
+        self._flush_lock = RLock()
+        self._flush_requested = Event()
+        self._closed = False
+        self.flushes = 0
+        self.flushed_items = 0
+        self._flusher: Optional[Thread] = None
+        if flush_interval is not None:
+            self._flusher = Thread(target=self._flush_loop, name="dff-write-behind", daemon=True)
+            self._flusher.start()
+        atexit.register(self.close)
+
+    def __getitem__(self, key: Hashable) -> Any:
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            if key in self._deleted:
+                raise KeyError(key)
+        value = self._connector[key]
+        with self._lock:
+            if key not in self._cache and key not in self._deleted:
+                self._cache[key] = value
+                self._evict()
+            return self._cache.get(key, value)
+
+    def __setitem__(self, key: Hashable, value: Any):
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            self._dirty.add(key)
+            self._deleted.discard(key)
+            self._evict()
+            flush_needed = len(self._dirty) >= self.flush_threshold
+        if flush_needed:
+            self._request_flush()
+
+    def __delitem__(self, key: Hashable):
+        with self._lock:
+            in_cache = key in self._cache
+            self._cache.pop(key, None)
+            self._dirty.discard(key)
+            if not in_cache and key not in self._connector:
+                raise KeyError(key)
+            self._deleted.add(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            if key in self._cache:
+                return True
+            if key in self._deleted:
+                return False
+        return key in self._connector
+
+    def __iter__(self) -> Iterator[Hashable]:
+        self.flush()
+        return iter(self._connector)
+
+    def __len__(self) -> int:
+        self.flush()
+        return len(self._connector)
+
+    @property
+    def dirty_count(self) -> int:
+        """Number of entries that wait to be written."""
+        return len(self._dirty) + len(self._deleted)
+
+    def flush(self):
+        """Write all the dirty entries and the deletions to the wrapped connector."""
+        with self._flush_lock:
+            with self._lock:
+                batch = {key: self._cache[key] for key in self._dirty}
+                deleted = self._deleted
+                self._dirty, self._deleted = set(), set()
+            try:
+                if batch:
+                    self._connector.update(batch)
+                for key in deleted:
+                    self._connector.pop(key, None)
+            except Exception:
+                with self._lock:  # keep the entries that were not overwritten meanwhile for the next attempt
+                    self._dirty.update(key for key in batch if key in self._cache)
+                    self._deleted.update(key for key in deleted if key not in self._cache)
+                raise
+            if batch or deleted:
+                self.flushes += 1
+                self.flushed_items += len(batch) + len(deleted)
+            with self._lock:
+                self._evict()
+
+    def close(self):
+        """Stop the background flush and write the remaining entries. Called automatically at exit."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._flusher is not None:
+            self._flush_requested.set()
+            self._flusher.join()
+        self.flush()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _evict(self):
+        while len(self._cache) > self.cache_size:
+            for key in self._cache:
+                if key not in self._dirty:
+                    del self._cache[key]
+                    break
+            else:  # only dirty entries left, they will be evicted after the flush
+                break
+
+    def _request_flush(self):
+        if self._flusher is None:
+            self.flush()
+        else:
+            self._flush_requested.set()
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(e)
+
+
+class SerializingConnector(MutableMapping):
+    """
+    | Wrapper that stores the contexts in the database connector as compact byte strings.
+    | See :py:mod:`~dff_telegram_connector.serialization` for the available formats.
+    | The wrapper reports the size of the stored contexts and the time spent on (de)serialization.
+
+    .. code-block:: python
+
+        connector = WriteBehindConnector(SerializingConnector(SqlConnector("SOME_URI"), JSONSerializer()))
+
+    Parameters
+    -----------
+
+    db_connector: :py:class:`~typing.MutableMapping`
+        The connector that persists the byte strings.
+    serializer: Optional[:py:class:`~dff_telegram_connector.serialization.Serializer`]
+        Serializer of the contexts. Defaults to :py:class:`~dff_telegram_connector.serialization.PickleSerializer`.
+
+    """
+
+    def __init__(self, db_connector: MutableMapping, serializer: Optional[Serializer] = None):
+        self._connector = db_connector
+        self.serializer = serializer or PickleSerializer()
+        self._lock = Lock()
+        self.stored_bytes: Dict[Hashable, int] = {}
+        self.dump_time = 0.0
+        self.load_time = 0.0
+        self.dumps = 0
+        self.loads = 0
+
+    def __getitem__(self, key: Hashable) -> Context:
+        data = self._connector[key]
+        start = time.perf_counter()
+        ctx = self.serializer.loads(data)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.load_time += elapsed
+            self.loads += 1
+            self.stored_bytes[key] = len(data)
+        return ctx
+
+    def __setitem__(self, key: Hashable, ctx: Context):
+        self._connector[key] = self._dump(key, ctx)
+
+    def __delitem__(self, key: Hashable):
+        del self._connector[key]
+        with self._lock:
+            self.stored_bytes.pop(key, None)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._connector
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self._connector)
+
+    def __len__(self) -> int:
+        return len(self._connector)
+
+    def update(self, other=(), **kwargs):
+        """Serialize the contexts and pass them to the wrapped connector in one batch."""
+        self._connector.update({key: self._dump(key, ctx) for key, ctx in dict(other, **kwargs).items()})
+
+    def _dump(self, key: Hashable, ctx: Context) -> bytes:
+        start = time.perf_counter()
+        data = self.serializer.dumps(ctx)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.dump_time += elapsed
+            self.dumps += 1
+            self.stored_bytes[key] = len(data)
+        return data
+
+    def stats(self) -> dict:
+        """Size of the stored contexts in bytes and the average (de)serialization time in seconds."""
+        with self._lock:
+            sizes = list(self.stored_bytes.values())
+            return {
+                "contexts": len(sizes),
+                "bytes_total": sum(sizes),
+                "bytes_max": max(sizes, default=0),
+                "dump_time_avg": self.dump_time / self.dumps if self.dumps else 0.0,
+                "load_time_avg": self.load_time / self.loads if self.loads else 0.0,
+            }
+
+
+class DeltaConnector(MutableMapping):
+    """
+    | Incremental persistence of the contexts.
+    | Instead of rewriting the whole context every turn, the wrapper writes a delta record with the
+    | history entries appended during the turn and the fields that changed. The deltas are stored under
+    | separate keys next to a snapshot of the context, so a write costs the same for any length of the history.
+    | Every `compact_every` deltas, the snapshot is rewritten and the deltas are deleted.
+
+    | The wrapper remembers what it has written for the recently used contexts. Contexts that it does not
+    | remember are written as a full snapshot. The histories are expected to be append-only,
+    | removed entries (e. g. by a :py:class:`~dff_telegram_connector.retention.RetentionPolicy`) are tracked too,
+    | but changes of the existing entries are not.
+
+    | The wrapped connector stores dicts and :py:class:`~df_engine.core.Context` objects under string keys,
+    | so it has to support arbitrary picklable values, e. g. a :py:mod:`shelve` of the standard library.
+
+    .. code-block:: python
+
+        connector = DeltaConnector(shelve.open("contexts.db"), compact_every=100)
+
+    Parameters
+    -----------
+
+    db_connector: :py:class:`~typing.MutableMapping`
+        The connector that persists the snapshots and the deltas.
+    compact_every: int
+        Number of the deltas that triggers compaction into a new snapshot.
+    cache_size: int
+        Number of the contexts whose written state is remembered.
+
+    """
+
+    def __init__(self, db_connector: MutableMapping, compact_every: int = 50, cache_size: int = 1024):
+        self._connector = db_connector
+        self.compact_every = compact_every
+        self.cache_size = cache_size
+        self._lock = RLock()
+        self._written: "OrderedDict[Hashable, dict]" = OrderedDict()
+        self.snapshots = 0
+        self.deltas = 0
+
+    @staticmethod
+    def _delta_key(key: Hashable, generation: int, seq: int) -> str:
+        return f"{key}:delta:{generation}:{seq}"
+
+    @staticmethod
+    def _get_state(ctx: Context) -> dict:
+        return {
+            "indices": {field: set(getattr(ctx, field)) for field in HISTORY_FIELDS},
+            "misc": deepcopy(ctx.misc),
+            "framework_states": Serializer._compact_states(ctx.framework_states),
+            "validation": ctx.validation,
+        }
+
+    def _remember(self, key: Hashable, generation: int, seq: int, state: dict):
+        self._written[key] = {"generation": generation, "seq": seq, **state}
+        self._written.move_to_end(key)
+        while len(self._written) > self.cache_size:
+            self._written.popitem(last=False)
+
+    def __getitem__(self, key: Hashable) -> Context:
+        record = self._connector[key]
+        ctx: Context = record["snapshot"].copy(deep=True)
+        Serializer._restore_states(ctx.framework_states)
+        generation, seq = record["generation"], 0
+        while True:
+            delta = self._connector.get(self._delta_key(key, generation, seq + 1))
+            if delta is None:
+                break
+            self._apply(ctx, delta)
+            seq += 1
+        with self._lock:
+            self._remember(key, generation, seq, self._get_state(ctx))
+        return ctx
+
+    @staticmethod
+    def _apply(ctx: Context, delta: dict):
+        for field, removed in delta["removed"].items():
+            for index in removed:
+                getattr(ctx, field).pop(index, None)
+        for field, appended in delta["appended"].items():
+            getattr(ctx, field).update(deepcopy(appended))
+        for field in ("misc", "validation"):
+            if field in delta:
+                setattr(ctx, field, deepcopy(delta[field]))
+        if "framework_states" in delta:
+            ctx.framework_states = Serializer._restore_states(deepcopy(delta["framework_states"]))
+
+    def __setitem__(self, key: Hashable, ctx: Context):
+        with self._lock:
+            written = self._written.get(key)
+            if written is None or written["seq"] >= self.compact_every:
+                self._write_snapshot(key, ctx)
+                return
+            state = self._get_state(ctx)
+            delta = {"appended": {}, "removed": {}}
+            for field in HISTORY_FIELDS:
+                history = getattr(ctx, field)
+                old_indices, new_indices = written["indices"][field], state["indices"][field]
+                delta["appended"][field] = {index: history[index] for index in new_indices - old_indices}
+                delta["removed"][field] = list(old_indices - new_indices)
+            for field in ("misc", "framework_states", "validation"):
+                if state[field] != written[field]:
+                    delta[field] = state[field]
+            generation, seq = written["generation"], written["seq"] + 1
+            self._connector[self._delta_key(key, generation, seq)] = delta
+            self._remember(key, generation, seq, state)
+            self.deltas += 1
+
+    def _write_snapshot(self, key: Hashable, ctx: Context):
+        """
+        Write a snapshot of a new generation. The deltas of the old generation are deleted afterwards,
+        so an interrupted compaction leaves a consistent state.
+        """
+        old_record = self._connector.get(key)
+        generation = old_record["generation"] + 1 if old_record is not None else 0
+        states = Serializer._compact_states(ctx.framework_states)
+        snapshot = ctx.copy(deep=True, update={"framework_states": states})
+        self._connector[key] = {"snapshot": snapshot, "generation": generation}
+        if old_record is not None:
+            self._delete_deltas(key, old_record["generation"])
+        self._remember(key, generation, 0, self._get_state(ctx))
+        self.snapshots += 1
+
+    def _delete_deltas(self, key: Hashable, generation: int):
+        seq = 1
+        while self._delta_key(key, generation, seq) in self._connector:
+            del self._connector[self._delta_key(key, generation, seq)]
+            seq += 1
+
+    def __delitem__(self, key: Hashable):
+        with self._lock:
+            record = self._connector[key]
+            del self._connector[key]
+            self._delete_deltas(key, record["generation"])
+            self._written.pop(key, None)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._connector
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return (key for key in self._connector if ":delta:" not in str(key))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def stats(self) -> dict:
+        """Number of the written snapshots and deltas."""
+        return {"snapshots": self.snapshots, "deltas": self.deltas}
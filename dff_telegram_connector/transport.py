@@ -0,0 +1,291 @@
+"""
+transport
+----------
+
+| This module provides the :py:class:`~dff_telegram_connector.transport.Transport` class.
+| By default, telebot keeps a separate HTTP session in every thread, so a bot that sends from many threads
+| opens a connection (and makes a TLS handshake) per thread, and all the methods share the same timeouts.
+| A transport is a single session with a sized connection pool that all the threads of a bot share.
+| It also applies per-method timeouts and a retry policy and counts how often the connections are reused.
+
+| Pass a transport to :py:class:`~dff_telegram_connector.basic_connector.DFFBot` as the `transport` parameter.
+| The transports are registered by the bot token and installed as
+| :py:data:`telebot.apihelper.CUSTOM_REQUEST_SENDER`, the requests of the bots without a transport
+| are sent as before. The sender is not used, when :py:data:`telebot.apihelper.RETRY_ON_ERROR` is enabled.
+
+.. code-block:: python
+
+    transport = Transport(pool_size=16, timeouts={"sendPhoto": 60, "sendMessage": (3, 10)})
+    bot = DFFBot(token=token, transport=transport)
+    print(transport.stats())
+
+| The uploads are streamed: the files and :py:class:`~dff_telegram_connector.types.MediaStream` sources
+| are read in chunks, while the request body is sent, instead of being encoded in memory at once.
+
+| HTTP/2 is not available: the transport is based on :py:mod:`requests`, which only speaks HTTP/1.1.
+
+| Size the pool for the number of the threads that send at the same time, e. g. the `num_threads` of telebot
+| plus the `send_workers` of the bot. With `pool_block=True` the threads that find all the connections busy wait,
+| so a smaller pool caps the throughput at about `pool_size` requests per round-trip, which makes the transport
+| slower than the per-thread sessions of telebot under a high latency.
+
+"""
+import mimetypes
+import os
+import time
+from collections import Counter, deque
+from functools import partial
+from io import BytesIO
+from pathlib import Path
+from threading import Lock
+from typing import Any, Collection, Deque, Dict, Iterator, List, Optional, Tuple, Union
+from uuid import uuid4
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+from urllib3.util.retry import Retry
+
+from .types import MediaStream
+
+Timeout = Union[float, Tuple[float, float]]
+
+
+def _get_size(content: Any) -> Optional[int]:
+    """Number of the bytes left in the content or `None`, if it is unknown."""
+    if isinstance(content, MediaStream):
+        return content.size
+    if isinstance(content, (bytes, bytearray)):
+        return len(content)
+    if isinstance(content, BytesIO):
+        return len(content.getbuffer()) - content.tell()
+    try:
+        return os.fstat(content.fileno()).st_size - content.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _iter_content(content: Any, chunk_size: int) -> Iterator[bytes]:
+    if isinstance(content, MediaStream):
+        yield from content.iter_chunks(chunk_size)
+    elif isinstance(content, (bytes, bytearray)):
+        yield bytes(content)
+    else:
+        for chunk in iter(partial(content.read, chunk_size), b""):
+            yield chunk
+
+
+class MultipartBody:
+    """
+    | Request body in the `multipart/form-data` format that reads the files while it is sent.
+    | If the sizes of all the files are known, the body has a length and is sent with a `Content-Length` header,
+    | otherwise it is sent with the chunked transfer encoding.
+    | The body can be sent again (e. g. when the request is retried) only if all the files are seekable.
+    """
+
+    def __init__(self, files: Dict[str, Any], chunk_size: int = 64 * 1024):
+        self.chunk_size = chunk_size
+        boundary = uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self._parts: List[Tuple[bytes, Any, Optional[int]]] = []
+        for name, value in files.items():
+            filename, content = value if isinstance(value, tuple) else (None, value)
+            if filename is None:
+                filename = getattr(content, "name", None)
+                filename = Path(filename).name if isinstance(filename, str) else name
+            mime_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            header = (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                f"Content-Type: {mime_type}\r\n\r\n"
+            ).encode("utf-8")
+            position = content.tell() if hasattr(content, "seekable") and content.seekable() else None
+            self._parts.append((header, content, position))
+        self._closing = f"--{boundary}--\r\n".encode("utf-8")
+        sizes = [_get_size(content) for _, content, _ in self._parts]
+        # requests takes the length of a streamed body from the `len` attribute
+        self.len = None
+        if None not in sizes:
+            self.len = sum(len(header) + size + 2 for (header, _, _), size in zip(self._parts, sizes))
+            self.len += len(self._closing)
+        self._consumed = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self._consumed:
+            if any(position is None for _, _, position in self._parts):
+                raise RuntimeError("The upload stream has already been consumed")
+            for _, content, position in self._parts:
+                content.seek(position)
+        self._consumed = True
+        for header, content, _ in self._parts:
+            yield header
+            yield from _iter_content(content, self.chunk_size)
+            yield b"\r\n"
+        yield self._closing
+
+
+class Transport:
+    """
+    Shared HTTP session for the requests to the Bot API.
+
+    Parameters
+    -----------
+
+    pool_size: int
+        Maximum number of the connections kept open to the Bot API server, see the note on sizing above.
+    pool_block: bool
+        | If `True`, a thread waits for a free connection, when all of them are busy.
+        | Otherwise an extra connection is opened and closed after the request, which costs a handshake.
+    timeouts: Optional[Dict[str, Union[float, Tuple[float, float]]]]
+        | Timeouts of the Bot API methods, e. g. `{"sendVideo": 120}`.
+        | A tuple sets the connect and the read timeouts separately.
+        | The methods that are not listed use `default_timeout` or the timeouts of telebot.
+    default_timeout: Optional[Union[float, Tuple[float, float]]]
+        | Timeout of the methods that are not listed in `timeouts`.
+        | It is not applied to `getUpdates`, whose timeout telebot derives from the long polling timeout.
+    max_retries: int
+        | Number of retries after a connection error or a response with one of the `retry_statuses`.
+        | Requests that reached the server and timed out are not retried, so that no message is sent twice.
+    backoff_factor: float
+        Delay before the `n`-th retry is `backoff_factor * 2 ** (n - 1)` seconds.
+    retry_statuses: Collection[int]
+        | HTTP statuses that are retried. Only the methods that read data (`get*`, e. g. `getUpdates`) are retried,
+        | a gateway error does not tell, if a message has been sent, so the other methods are not.
+        | The error 429 is handled by the rate limiter, not by the transport.
+    chunk_size: int
+        Number of the bytes read from an uploaded file at a time.
+
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 10,
+        pool_block: bool = True,
+        timeouts: Optional[Dict[str, Timeout]] = None,
+        default_timeout: Optional[Timeout] = None,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        retry_statuses: Collection[int] = (502, 503, 504),
+        chunk_size: int = 64 * 1024,
+    ):
+        self.chunk_size = chunk_size
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.retry_statuses = frozenset(retry_statuses)
+        # only the connection errors are retried by urllib3, the statuses are retried by `request`
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=0,
+            allowed_methods=None,
+            backoff_factor=backoff_factor,
+            raise_on_status=False,
+            respect_retry_after_header=False,
+        )
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry, pool_block=pool_block)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self._lock = Lock()
+        self._latencies: Deque[float] = deque(maxlen=1000)
+        self.methods: Counter = Counter()
+        self.errors = 0
+
+    def get_timeout(self, method_name: str, timeout: Optional[Timeout] = None) -> Optional[Timeout]:
+        """Timeout of a Bot API method. `timeout` is the value that telebot would use."""
+        default_timeout = self.default_timeout if method_name != "getUpdates" else None
+        configured = self.timeouts.get(method_name, default_timeout)
+        return timeout if configured is None else configured
+
+    def request(self, method: str, url: str, timeout: Optional[Timeout] = None, **kwargs) -> requests.Response:
+        """
+        | Send a request with the signature of :py:data:`telebot.apihelper.CUSTOM_REQUEST_SENDER`.
+        | The `files` are sent as a streamed :py:class:`~MultipartBody`.
+        """
+        method_name = url.rsplit("/", 1)[-1]
+        files = kwargs.pop("files", None)
+        if files:
+            body = MultipartBody(files, self.chunk_size)
+            kwargs.update(data=body, headers={"Content-Type": body.content_type})
+        timeout = self.get_timeout(method_name, timeout)
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, timeout=timeout, **kwargs)
+            if method_name.startswith("get"):
+                retries = 0
+                while response.status_code in self.retry_statuses and retries < self.max_retries:
+                    time.sleep(self.backoff_factor * 2 ** retries)
+                    retries += 1
+                    response = self.session.request(method, url, timeout=timeout, **kwargs)
+            return response
+        except requests.RequestException:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.methods[method_name] += 1
+                self._latencies.append(time.perf_counter() - start)
+
+    def stats(self) -> dict:
+        """Request counts, the number of the opened and the reused connections and the request latency."""
+        pools = self.adapter.poolmanager.pools
+        connections = 0
+        pooled_requests = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                pooled_requests += pool.num_requests
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                "requests": sum(self.methods.values()),
+                "errors": self.errors,
+                "methods": dict(self.methods),
+                "connections": connections,
+                "reused": max(pooled_requests - connections, 0),
+                "reuse_ratio": 1 - connections / pooled_requests if pooled_requests else 0.0,
+                "latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+                "latency_max": latencies[-1] if latencies else 0.0,
+            }
+
+    def close(self):
+        self.session.close()
+
+
+_transports: Dict[str, Transport] = {}
+_fallback_sender = None
+
+
+def _send_request(method: str, url: str, **kwargs) -> requests.Response:
+    for token, transport in _transports.items():
+        if token in url:
+            return transport.request(method, url, **kwargs)
+    if _fallback_sender is not None:
+        return _fallback_sender(method, url, **kwargs)
+    return apihelper._get_req_session().request(method, url, **kwargs)
+
+
+def register_transport(token: str, transport: Transport):
+    """
+    | Send the requests of the bot with the `token` through the `transport`.
+    | A custom sender that was installed before is kept for the other bots.
+    """
+    global _fallback_sender
+    if apihelper.CUSTOM_REQUEST_SENDER is not _send_request:
+        _fallback_sender = apihelper.CUSTOM_REQUEST_SENDER
+        apihelper.CUSTOM_REQUEST_SENDER = _send_request
+    _transports[token] = transport
+
+
+def unregister_transport(token: str):
+    """Send the requests of the bot with the `token` as before :py:func:`register_transport`."""
+    global _fallback_sender
+    _transports.pop(token, None)
+    if not _transports and apihelper.CUSTOM_REQUEST_SENDER is _send_request:
+        apihelper.CUSTOM_REQUEST_SENDER = _fallback_sender
+        _fallback_sender = None
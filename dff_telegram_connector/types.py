@@ -6,7 +6,10 @@ This module implements local classes for compatibility with `dff-generics` libra
 You can use :py:class:`~TelegramResponse` class directly with the `send_response` method
 that belongs to the :py:class:`basic_connector.DFFBot` class.
 """
-from typing import Any, List, Optional, Union
+from collections import OrderedDict
+from io import BytesIO, IOBase, RawIOBase
+from threading import Lock
+from typing import Any, Hashable, Iterator, List, Optional, Tuple, Union
 from pathlib import Path
 
 from telebot import types
@@ -28,6 +31,94 @@ class TelegramButton(AdapterModel):
     callback_data: Optional[str] = Field(default=None, alias="payload")
 
 
+class FrozenMarkupMixin:
+    """
+    | Keyboard markup that serializes itself to JSON only once.
+    | Cached keyboards are shared between responses, so the JSON is reused by every `send_message` call.
+    | Adding buttons resets the serialized value.
+    """
+
+    _json: Optional[str] = None
+
+    def to_json(self) -> str:
+        if self._json is None:
+            self._json = super().to_json()
+        return self._json
+
+    def add(self, *args, **kwargs):
+        self._json = None
+        return super().add(*args, **kwargs)
+
+    def row(self, *args, **kwargs):
+        self._json = None
+        return super().row(*args, **kwargs)
+
+
+class FrozenInlineKeyboardMarkup(FrozenMarkupMixin, types.InlineKeyboardMarkup):
+    pass
+
+
+class FrozenReplyKeyboardMarkup(FrozenMarkupMixin, types.ReplyKeyboardMarkup):
+    pass
+
+
+class KeyboardCache:
+    """
+    | Interning cache for the keyboards built by :py:class:`~TelegramUI`.
+    | Keyboards are keyed by the buttons, `is_inline` and `row_width`, so that the same menu
+    | is built and serialized once. The cached keyboards are shared and should not be modified.
+
+    Parameters
+    -----------
+
+    maxsize: int
+        Maximum number of the cached keyboards. Least recently used keyboards are evicted first.
+
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._keyboards: "OrderedDict[tuple, FrozenMarkupMixin]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, buttons: List["TelegramButton"], is_inline: bool, row_width: int) -> FrozenMarkupMixin:
+        """Return a cached keyboard or build a new one."""
+        key = (tuple((item.text, item.url, item.callback_data) for item in buttons), is_inline, row_width)
+        with self._lock:
+            keyboard = self._keyboards.get(key)
+            if keyboard is not None:
+                self._keyboards.move_to_end(key)
+                self.hits += 1
+                return keyboard
+            self.misses += 1
+        keyboard = self.build(buttons, is_inline, row_width)
+        keyboard.to_json()
+        with self._lock:
+            self._keyboards[key] = keyboard
+            if len(self._keyboards) > self.maxsize:
+                self._keyboards.popitem(last=False)
+        return keyboard
+
+    @staticmethod
+    def build(buttons: List["TelegramButton"], is_inline: bool, row_width: int) -> FrozenMarkupMixin:
+        if is_inline:
+            keyboard = FrozenInlineKeyboardMarkup(row_width=row_width)
+            markup_buttons = [types.InlineKeyboardButton(**item.dict()) for item in buttons]
+        else:
+            keyboard = FrozenReplyKeyboardMarkup(row_width=row_width)
+            markup_buttons = [types.KeyboardButton(text=item.text) for item in buttons]
+        keyboard.add(*markup_buttons, row_width=row_width)
+        return keyboard
+
+    def __len__(self):
+        return len(self._keyboards)
+
+
+keyboard_cache = KeyboardCache()
+
+
 class TelegramUI(AdapterModel):
     buttons: Optional[List[TelegramButton]] = None
     is_inline: bool = True
@@ -42,24 +133,128 @@ class TelegramUI(AdapterModel):
             raise ValueError(
                 "`buttons` parameter is required, when `keyboard` is not equal to telebot.types.ReplyKeyboardRemove."
             )
-        kb_args = {"row_width": values.get("row_width")}
-        is_inline = values.get("is_inline")
-        if is_inline:
-            keyboard = types.InlineKeyboardMarkup(**kb_args)
-            buttons = [types.InlineKeyboardButton(**item.dict()) for item in values["buttons"]]
-        else:
-            keyboard = types.ReplyKeyboardMarkup(**kb_args)
-            buttons = [types.KeyboardButton(text=item.text) for item in values["buttons"]]
-        keyboard.add(*buttons, row_width=values["row_width"])
-        values["keyboard"] = keyboard
+        values["keyboard"] = keyboard_cache.get(values["buttons"], values.get("is_inline"), values.get("row_width"))
         return values
 
 
+class MediaStream(RawIOBase):
+    """
+    | Media content that is produced on the fly: a binary file-like object, an iterable of byte chunks
+    | or, for the :py:class:`~dff_telegram_connector.async_connector.AsyncDFFBot`, an async iterable of byte chunks.
+    | The content is read chunk by chunk during the upload. With a
+    | :py:class:`~dff_telegram_connector.transport.Transport` or with the async bot the upload is streamed,
+    | so the content is never kept in memory in full. Otherwise telebot reads it at once.
+
+    | A stream can be sent only once. To send it to several chats, set a `key`: the `file_id` of the first upload
+    | is saved in the `file_cache` of the bot under this key and reused.
+
+    | The stream can be kept in a context: copying it returns the same instance, and pickling it keeps only
+    | the file name, the size and the key. Reading the content of an unpickled stream raises :py:class:`ValueError`.
+
+    Parameters
+    -----------
+
+    content: Union[IOBase, Iterable[bytes], AsyncIterable[bytes]]
+        Source of the data.
+    filename: str
+        File name shown to the user. Telegram also uses it to detect the type of a document.
+    size: Optional[int]
+        Size of the content in bytes, if it is known. It allows sending the upload with a `Content-Length`.
+    key: Optional[str]
+        Stable identifier of the content for the `file_id` cache.
+
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, content: Any, filename: str = "file", size: Optional[int] = None, key: Optional[str] = None):
+        super().__init__()
+        self.content = BytesIO(content) if isinstance(content, (bytes, bytearray)) else content
+        self.filename = filename
+        self.size = len(content) if size is None and isinstance(content, (bytes, bytearray)) else size
+        self.key = key
+        self._chunks: Optional[Iterator[bytes]] = None
+        self._buffer = memoryview(b"")
+
+    @property
+    def name(self) -> str:
+        return self.filename
+
+    @property
+    def is_async(self) -> bool:
+        return hasattr(self.content, "__aiter__")
+
+    def readable(self) -> bool:
+        return True
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo: dict):
+        return self
+
+    def __reduce__(self):
+        return MediaStream, (None, self.filename, self.size, self.key)
+
+    def iter_chunks(self, chunk_size: Optional[int] = None) -> Iterator[bytes]:
+        """Yield the remaining content in chunks of up to `chunk_size` bytes."""
+        if self._buffer:
+            yield self._buffer.tobytes()
+            self._buffer = memoryview(b"")
+        while True:
+            chunk = self._next_chunk(chunk_size or self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def readinto(self, buffer) -> int:
+        if not self._buffer:
+            self._buffer = memoryview(self._next_chunk(max(len(buffer), self.chunk_size)))
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def _next_chunk(self, chunk_size: int) -> bytes:
+        if self.content is None:
+            raise ValueError("The content of an unpickled stream is not available")
+        if self.is_async:
+            raise TypeError("Async sources can only be sent by AsyncDFFBot")
+        if hasattr(self.content, "read"):
+            return self.content.read(chunk_size) or b""
+        if self._chunks is None:
+            self._chunks = iter(self.content)
+        for chunk in self._chunks:
+            if chunk:
+                return bytes(chunk)
+        return b""
+
+    def close(self):
+        close = getattr(self.content, "close", None)
+        if not self.closed and close is not None:
+            close()
+        super().close()
+
+
+def to_media_source(source: Any) -> Any:
+    """Wrap file-like objects, byte strings and (async) iterables of chunks in a :py:class:`~MediaStream`."""
+    if source is None or isinstance(source, (str, Path, MediaStream)):
+        return source
+    if isinstance(source, (bytes, bytearray, IOBase)) or hasattr(source, "__iter__") or hasattr(source, "__aiter__"):
+        name = getattr(source, "name", None)
+        return MediaStream(source, filename=Path(name).name if isinstance(name, str) else "file")
+    return source
+
+
 class TelegramAttachment(AdapterModel):
-    source: Optional[Union[HttpUrl, FilePath]] = None
+    source: Optional[Union[HttpUrl, FilePath, MediaStream]] = None
     id: Optional[str] = None  # id field is made separate to simplify validation.
     title: Optional[str] = None
 
+    @validator("source", pre=True)
+    def wrap_stream(cls, source: Any):
+        return to_media_source(source)
+
     @root_validator
     def validate_id_or_source(cls, values):
         if bool(values["source"]) == bool(values["id"]):
@@ -95,6 +290,7 @@ class TelegramAttachments(AdapterModel):
             file = tg_cls(media=file.source or file.id, caption=file.title)
 
         if isinstance(file, types.InputMedia):
+            file.media = to_media_source(file.media)
             return file
         else:
             raise TypeError(
@@ -113,3 +309,105 @@ class TelegramResponse(AdapterModel):
     video: Optional[TelegramAttachment] = None
     audio: Optional[TelegramAttachment] = None
     attachments: Optional[TelegramAttachments] = None
+
+
+def _freeze(value: Any) -> Hashable:
+    """
+    | Returns a hashable key that is equal for the values with equal content.
+    | Models, dicts and sequences are compared field by field, other values must be hashable.
+    | Raises :py:class:`TypeError` for the values that can not be frozen, and for the stream-like sources
+    | (byte strings, file objects, iterators), which are consumed by the first upload and can not be shared.
+    """
+    if isinstance(value, BaseModel):
+        return (type(value), _freeze(value.__dict__))
+    if isinstance(value, dict):
+        return (dict, frozenset((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_freeze(item) for item in value))
+    if isinstance(value, (bytes, bytearray, memoryview, IOBase)) or any(
+        hasattr(value, name) for name in ("__next__", "__aiter__")
+    ):
+        raise TypeError(f"A {type(value).__name__} source is consumed by the upload")
+    hash(value)
+    return (type(value), value)
+
+
+class ResponseCache:
+    """
+    | Cache of validated :py:class:`~TelegramResponse` templates for the trusted responses.
+    | The templates are keyed by the content of the source object, so a repeated response
+    | is validated only once, even though the :py:class:`~df_engine.core.Actor` hands out a copy of it every turn.
+    | The responses that hold unhashable values or media streams (byte strings, file objects, iterators)
+    | are validated every time, so that every send gets a fresh stream.
+
+    Parameters
+    -----------
+
+    maxsize: int
+        Maximum number of the cached templates. Least recently used templates are evicted first.
+
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._templates: "OrderedDict[Hashable, TelegramResponse]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, response: Union[str, dict, df_generics.Response]) -> TelegramResponse:
+        """Return the validated template for the response, validating it on the first call."""
+        if isinstance(response, str):
+            return TelegramResponse.construct(text=response)
+        try:
+            key = _freeze(response)
+        except TypeError:
+            return TelegramResponse.parse_obj(response)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
+                return template
+            self.misses += 1
+        template = TelegramResponse.parse_obj(response)
+        with self._lock:
+            self._templates[key] = template
+            if len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return template
+
+    def __len__(self):
+        return len(self._templates)
+
+
+response_cache = ResponseCache()
+
+
+def cast_response(
+    response: Union[str, dict, df_generics.Response, TelegramResponse],
+    trusted: bool = False,
+    cache: ResponseCache = response_cache,
+) -> TelegramResponse:
+    """
+    Cast the `response` argument to the :py:class:`~TelegramResponse` type.
+    A :py:class:`~str`, a :py:class:`~dict` or a :py:class:`~df_generics.Response` can be passed.
+
+    | With `trusted=True` each distinct response is validated once and then reused from the `cache`,
+    | plain strings are wrapped without validation at all.
+    | Only use it for the responses that are never mutated, like the ones from a static script.
+    """
+    if isinstance(response, TelegramResponse):
+        return response
+    elif trusted and isinstance(response, (str, dict, df_generics.Response)):
+        return cache.get(response)
+    elif isinstance(response, str):
+        return TelegramResponse(text=response)
+    elif isinstance(response, dict) or isinstance(response, df_generics.Response):
+        return TelegramResponse.parse_obj(response)
+    raise TypeError(
+        """
+        Type of the response argument should be one of the following:
+        str, dict, TelegramResponse, or df_generics.Response
+        """
+    )
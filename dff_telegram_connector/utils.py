@@ -1,12 +1,21 @@
-from functools import wraps
-from typing import Callable
+from functools import partial, wraps
+from itertools import count
+from threading import Lock, local
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple, Union
 from pathlib import Path
 from io import IOBase
 from copy import copy
 
-from telebot import types
+from telebot import types, util
 from df_engine.core import Context
 
+from .types import MediaStream
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python 3.6
+    ContextVar = None
+
 
 def set_state(ctx: Context, update: types.JsonDeserializable):
     """
@@ -23,18 +32,160 @@ def set_state(ctx: Context, update: types.JsonDeserializable):
     """
     ctx.add_request(update.text if (hasattr(update, "text") and update.text) else "data")
     ctx.framework_states["TELEGRAM_CONNECTOR"]["data"] = update
+    turn_id = next(_turn_ids)
+    ctx.framework_states["TELEGRAM_CONNECTOR"]["turn"] = turn_id
+    _turn_cache.set((turn_id, {}))
     return ctx
 
 
+class _ThreadLocalVar(local):
+    """Stand-in for :py:class:`contextvars.ContextVar` on Python 3.6, the value is kept per thread."""
+
+    def __init__(self, name: str, default: Any):
+        self.value = default
+
+    def get(self) -> Any:
+        return self.value
+
+    def set(self, value: Any):
+        self.value = value
+
+
+_turn_ids = count()
+# the async providers run the whole turn synchronously, so a per-thread value also works for them
+_turn_cache = (ContextVar or _ThreadLocalVar)("turn_cache", default=(None, None))
+
+
+def get_turn_cache(ctx: Context) -> Optional[dict]:
+    """
+    | Returns the storage for the values that are computed once per update, e. g. by the conditions.
+    | :py:func:`~set_state` starts a new storage for every update in the current thread or task
+    | and marks the context with the ID of the turn. The storage is not a part of the context,
+    | so it is neither copied by the :py:class:`~df_engine.core.Actor` nor saved to the database.
+    | Returns `None`, if the context does not belong to the turn that is being processed.
+    """
+    turn_id, cache = _turn_cache.get()
+    state = ctx.framework_states.get("TELEGRAM_CONNECTOR", {})
+    if turn_id is None or state.get("turn") != turn_id:
+        return None
+    return cache
+
+
+class StripedLock:
+    """
+    | A fixed set of locks shared by any number of keys.
+    | The same key always maps to the same lock, so operations on a key are mutually exclusive,
+    | while different keys rarely contend. Memory usage does not depend on the number of keys.
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [Lock() for _ in range(stripes)]
+
+    def get(self, key: Hashable) -> Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+
+def get_update_class(update: types.JsonDeserializable) -> type:
+    """Returns the telebot class of an update. Lazy updates report the class of the object they wrap."""
+    update_class = type(update)
+    if issubclass(update_class, types.JsonDeserializable):
+        return update_class
+    return getattr(update, "update_class", update_class)
+
+
+def classify_update(update: types.JsonDeserializable) -> Tuple[type, Optional[str], Optional[str]]:
+    """
+    Returns the type, the content type and the command of an update.
+    The last two values are `None`, if they are not applicable to the update.
+    """
+    content_type = getattr(update, "content_type", None)
+    command = util.extract_command(update.text) if content_type == "text" else None
+    return get_update_class(update), content_type, command
+
+
+def _get_sender_id(update: types.JsonDeserializable) -> int:
+    return update.from_user.id
+
+
+def _get_message_key(update: types.Message) -> int:
+    # channel posts have no sender, they belong to the channel
+    return (update.from_user or update.chat).id
+
+
+_KEY_GETTERS: Dict[type, Callable[[types.JsonDeserializable], Union[int, str]]] = {
+    types.Message: _get_message_key,
+    types.CallbackQuery: _get_sender_id,
+    types.InlineQuery: _get_sender_id,
+    types.ChosenInlineResult: _get_sender_id,
+    types.ShippingQuery: _get_sender_id,
+    types.PreCheckoutQuery: _get_sender_id,
+    types.Poll: lambda update: update.id,
+    types.PollAnswer: lambda update: update.user.id,
+    types.ChatMemberUpdated: _get_sender_id,
+    types.ChatJoinRequest: _get_sender_id,
+}
+
+UPDATE_FIELDS: Dict[str, type] = {
+    "message": types.Message,
+    "edited_message": types.Message,
+    "callback_query": types.CallbackQuery,
+    "channel_post": types.Message,
+    "edited_channel_post": types.Message,
+    "inline_query": types.InlineQuery,
+    "chosen_inline_result": types.ChosenInlineResult,
+    "shipping_query": types.ShippingQuery,
+    "pre_checkout_query": types.PreCheckoutQuery,
+    "poll": types.Poll,
+    "poll_answer": types.PollAnswer,
+    "my_chat_member": types.ChatMemberUpdated,
+    "chat_member": types.ChatMemberUpdated,
+    "chat_join_request": types.ChatJoinRequest,
+}
+
+
 def get_user_id(update: types.JsonDeserializable) -> str:
-    """Extracts user ID from an update instance AND casts it to a string"""
-    assert hasattr(update, "from_user"), f"Received an invalid update object: {str(type(update))}"
-    return str(update.from_user.id)
+    """
+    | Extracts user ID from an update instance AND casts it to a string.
+    | Channel posts are keyed by the channel, polls by the poll ID and poll answers by the user who voted.
+    """
+    get_key = _KEY_GETTERS.get(get_update_class(update))
+    if get_key is None:
+        assert hasattr(update, "from_user"), f"Received an invalid update object: {str(type(update))}"
+        return str(update.from_user.id)
+    return str(get_key(update))
+
+
+_NO_CHAT_TYPES = frozenset({types.Poll})
+
+
+def can_reply(update: types.JsonDeserializable) -> bool:
+    """
+    | Returns `False` for the updates that do not come from a chat, e. g. polls: they are keyed by the poll ID,
+    | so the response can not be sent to the ID of the context.
+    """
+    return get_update_class(update) not in _NO_CHAT_TYPES
+
+
+def unwrap_update(update: types.Update) -> Tuple[str, types.JsonDeserializable]:
+    """
+    | Returns the user ID and the inner update of a :py:class:`~telebot.types.Update`.
+    | The fields are checked in the order of :py:data:`UPDATE_FIELDS`, the most frequent ones first.
+    """
+    fields = update.__dict__
+    for field in UPDATE_FIELDS:
+        inner_update = fields.get(field)
+        if inner_update is not None:
+            return get_user_id(inner_update), inner_update
+    raise ValueError(f"Update {update.update_id} has no known fields")
+
+
+_CONTEXT_TEMPLATE = Context(id="")
 
 
 def get_initial_context(user_id: str):
     """
     Initialize a context with module-specific parameters.
+    The context is cloned from a prebuilt template, so no validation is run.
 
     Parameters
     -----------
@@ -43,9 +194,25 @@ def get_initial_context(user_id: str):
         ID of the user from the update instance.
 
     """
-    ctx = Context(id=user_id)
-    ctx.framework_states.update({"TELEGRAM_CONNECTOR": {"keep_flag": True, "data": None}})
-    return ctx
+    return _CONTEXT_TEMPLATE.copy(
+        update={
+            "id": user_id,
+            "labels": {},
+            "requests": {},
+            "responses": {},
+            "misc": {},
+            "framework_states": {"TELEGRAM_CONNECTOR": {"keep_flag": True, "data": None}},
+        }
+    )
+
+
+def get_initial_context_factory(user_id: str) -> Callable[[], Context]:
+    """
+    | Returns a function that creates the initial context for the user.
+    | Pass it to :py:meth:`~df_runner.Runner.request_handler` as `init_ctx`,
+    | so that the context is only created, if the user has none in the database.
+    """
+    return partial(get_initial_context, user_id)
 
 
 def partialmethod(func: Callable, **part_kwargs):
@@ -63,14 +230,31 @@ def partialmethod(func: Callable, **part_kwargs):
     return wrapper
 
 
-def open_io(item: types.InputMedia):
-    """Returns a copy of InputMedia with an opened file descriptor instead of path"""
+def replace_media(item: types.InputMedia, media: Any) -> types.InputMedia:
+    """Returns a copy of InputMedia with another media, e. g. a `file_id` or an opened file"""
     copied_item = copy(item)
-    if isinstance(copied_item.media, Path):
-        copied_item.media = copied_item.media.open(mode="rb")
+    copied_item.media = media
+    if util.is_string(media):
+        copied_item._media_name = ""
+        copied_item._media_dic = media
+    elif util.is_string(item.media):
+        copied_item._media_name = util.generate_random_token()
+        copied_item._media_dic = f"attach://{copied_item._media_name}"
     return copied_item
 
 
+def open_io(item: types.InputMedia, asynchronous: bool = False):
+    """
+    | Returns a copy of InputMedia with an opened file descriptor instead of path.
+    | With `asynchronous=True` the async streams are passed to aiohttp as they are.
+    """
+    if isinstance(item.media, Path):
+        return replace_media(item, item.media.open(mode="rb"))
+    if asynchronous and isinstance(item.media, MediaStream) and item.media.is_async:
+        return replace_media(item, (item.media.filename, item.media.content))
+    return copy(item)
+
+
 def close_io(item: types.InputMedia):
     """Closes an IO in an InputMedia object to perform the cleanup"""
     if isinstance(item.media, IOBase):
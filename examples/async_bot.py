@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+import os
+import sys
+
+import df_engine.conditions as cnd
+from df_engine.core import Actor
+from df_engine.core.keywords import TRANSITIONS, RESPONSE, GLOBAL
+from df_runner import Runner
+
+from dff_telegram_connector.async_connector import AsyncDFFBot
+from dff_telegram_connector.async_request_provider import AsyncPollingRequestProvider
+
+
+# AsyncDFFBot sends all the requests with aiohttp, so one event loop can serve many users at once.
+bot = AsyncDFFBot(os.getenv("BOT_TOKEN", "SOMETOKEN"))
+
+script = {
+    GLOBAL: {TRANSITIONS: {("root", "start", 2): bot.cnd.message_handler(commands=["start"])}},
+    "root": {
+        "start": {RESPONSE: "Hi", TRANSITIONS: {("root", "how_are_you"): cnd.exact_match("hi")}},
+        "how_are_you": {RESPONSE: "How are you?", TRANSITIONS: {("root", "start"): cnd.true()}},
+        "fallback": {RESPONSE: "Oops"},
+    },
+}
+
+actor = Actor(script, start_label=("root", "start"), fallback_label=("root", "fallback"))
+
+provider = AsyncPollingRequestProvider(bot=bot)
+
+runner = Runner(actor=actor, db=dict(), request_provider=provider)
+
+if __name__ == "__main__":
+    if "BOT_TOKEN" not in os.environ:
+        print("BOT_TOKEN variable needs to be set to continue")
+        sys.exit(1)
+
+    try:
+        runner.start()
+    except KeyboardInterrupt:
+        print("Stopping bot")
+        sys.exit(0)
@@ -72,7 +72,7 @@ def handler(update):
 
     # retrieve or create a context for the user
     user_id = get_user_id(update)
-    context: Context = connector.get(user_id, get_initial_context(user_id))
+    context: Context = connector.get(user_id) or get_initial_context(user_id)
 
     # add newly received user data to the context
     context = set_state(context, update)
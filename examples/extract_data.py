@@ -64,7 +64,7 @@ def extract_data(message):
 @bot.message_handler(func=lambda msg: True, content_types=content_type_media)
 def handler(update):
     user_id = get_user_id(update)
-    context: Context = connector.get(user_id, get_initial_context(user_id))
+    context: Context = connector.get(user_id) or get_initial_context(user_id)
     context = set_state(context, update)
 
     # Extract data if present
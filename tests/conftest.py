@@ -2,6 +2,8 @@ import sys
 import os
 
 import pytest
+from telebot import types
+from df_engine.core import Context
 
 sys.path.insert(0, "../")
 from examples.basic_bot import bot, actor
@@ -11,6 +13,52 @@ for variable in ["BOT_TOKEN"]:
         raise AssertionError(f"{variable} variable needs to be set to continue")
 
 
+class FakeRunner:
+    """Stand-in for the runner that answers every update with `respond(update)` instead of running an actor."""
+
+    def __init__(self, respond=lambda update: getattr(update, "text", update)):
+        self._pre_annotators = []
+        self._post_annotators = []
+        self._db = {}
+        self.respond = respond
+
+    def request_handler(self, ctx_id, ctx_update, init_ctx=None):
+        ctx = Context(id=ctx_id)
+        ctx.add_response(self.respond(ctx_update))
+        return ctx
+
+
+def make_update_json(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "from": {"id": user_id, "is_bot": False, "first_name": "test"},
+            "chat": {"id": user_id, "type": "private"},
+            "date": 0,
+            "text": text,
+        },
+    }
+
+
 @pytest.fixture(scope="session")
 def actor_instance():
     yield actor
+
+
+@pytest.fixture(scope="session")
+def update_json():
+    """Factory of the Bot API JSON of a text message update."""
+    return make_update_json
+
+
+@pytest.fixture(scope="session")
+def create_update():
+    """Factory of a text message update."""
+    return lambda update_id, user_id, text: types.Update.de_json(make_update_json(update_id, user_id, text))
+
+
+@pytest.fixture(scope="session")
+def fake_runner():
+    """The :py:class:`FakeRunner` class, call it with a `respond` function to change the responses."""
+    return FakeRunner
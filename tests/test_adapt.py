@@ -7,6 +7,7 @@ from telebot import types
 sys.path.insert(0, "../dff-generics")
 
 from dff_telegram_connector.types import TelegramResponse, TelegramAttachments, TelegramAttachment
+from dff_telegram_connector.types import KeyboardCache, ResponseCache, cast_response
 
 from df_generics import Attachments, Response, Keyboard, Button, Image
 
@@ -55,3 +56,45 @@ def test_adapt_attachments():
     assert isinstance(telegram_response.attachments.files[0], types.InputMediaPhoto)
     assert telegram_response.attachments.files[0].media == generic_response.attachments.files[0].source
     assert telegram_response.attachments.files[0].caption == generic_response.attachments.files[0].title
+
+
+def test_trusted_response_cache():
+    cache = ResponseCache(maxsize=1)
+    generic_response = Response(text="test", ui=Keyboard(buttons=[Button(text="button 1", payload="1")]))
+    first = cast_response(generic_response, trusted=True, cache=cache)
+    assert cast_response(generic_response, trusted=True, cache=cache) is first
+    assert cast_response(generic_response.copy(deep=True), trusted=True, cache=cache) is first
+    assert cast_response(generic_response, cache=cache) is not first
+    assert (cache.hits, cache.misses) == (2, 1)
+    other_response = {"text": "other"}
+    assert cast_response(other_response, trusted=True, cache=cache).text == "other"
+    assert cast_response(dict(other_response), trusted=True, cache=cache).text == "other"
+    assert len(cache) == 1 and cache.hits == 3
+    for source in [b"data", bytearray(b"data"), iter([b"data"])]:
+        response = {"text": "stream", "document": {"source": source}}
+        assert cast_response(response, trusted=True, cache=cache) is not cast_response(response, cache=cache)
+    first, second = (cast_response({"document": {"source": b"data"}, "text": ""}, trusted=True) for _ in range(2))
+    assert first.document.source.read() == second.document.source.read() == b"data"
+    assert len(cache) == 1 and cache.hits == 3
+    assert cast_response("text", trusted=True) == TelegramResponse(text="text")
+
+
+def test_keyboard_cache():
+    buttons = [Button(text="button 1", payload="1"), Button(text="button 2", payload="2")]
+    first = TelegramResponse.parse_obj(Response(text="first", ui=Keyboard(buttons=buttons)))
+    second = TelegramResponse.parse_obj(Response(text="second", ui=Keyboard(buttons=buttons)))
+    assert first.ui.keyboard is second.ui.keyboard
+    assert isinstance(first.ui.keyboard, types.InlineKeyboardMarkup)
+    assert json.loads(first.ui.keyboard.to_json())["inline_keyboard"][0][0]["text"] == "button 1"
+    other = TelegramResponse(text="other", ui={"buttons": [{"text": "button 1"}], "is_inline": False})
+    assert other.ui.keyboard is not first.ui.keyboard
+    assert isinstance(other.ui.keyboard, types.ReplyKeyboardMarkup)
+
+    cache = KeyboardCache(maxsize=1)
+    keyboard = cache.get(first.ui.buttons, True, 3)
+    assert cache.get(first.ui.buttons, True, 3) is keyboard
+    assert cache.get(first.ui.buttons, True, 2) is not keyboard
+    assert len(cache) == 1
+    serialized = keyboard.to_json()
+    keyboard.add(types.InlineKeyboardButton(text="button 3", callback_data="3"))
+    assert keyboard.to_json() != serialized
@@ -0,0 +1,123 @@
+import asyncio
+import json
+
+import pytest
+from df_engine.core import Context
+
+from dff_telegram_connector.async_connector import AsyncDFFBot, AsyncDatabaseMiddleware
+from dff_telegram_connector.async_request_provider import AsyncPollingRequestProvider, ASGIWebhookRequestProvider
+
+
+@pytest.fixture
+def async_bot():
+    yield AsyncDFFBot("1:test")
+
+
+@pytest.mark.parametrize("text,expected", [("/start", True), ("start", False)])
+def test_async_conditions(async_bot, create_update, text, expected):
+    condition = async_bot.cnd.message_handler(commands=["start"])
+    context = Context(id=123)
+    context.framework_states["TELEGRAM_CONNECTOR"] = {"keep_flag": True, "data": create_update(1, 1, text).message}
+    assert condition(context, None) == expected
+
+
+def test_async_middleware(create_update):
+    connector = dict()
+    data = dict()
+    update = create_update(1, 1, "text").message
+    middleware = AsyncDatabaseMiddleware(connector)
+    asyncio.run(middleware.pre_process(update, data))
+    assert isinstance(data["context"], Context)
+    asyncio.run(middleware.post_process(update, data))
+    assert "1" in connector
+
+
+def test_async_middleware_lock(create_update):
+    connector = dict()
+    bot = AsyncDFFBot("1:test", db_connector=connector)
+
+    async def handler(message, data):
+        count = data["context"].misc.get("count", 0)
+        await asyncio.sleep(0.01)
+        data["context"].misc["count"] = count + 1
+        data["context"].misc.setdefault("texts", []).append(data["context"].last_request)
+
+    bot.message_handler(func=lambda message: True)(handler)
+    asyncio.run(bot.process_new_messages([create_update(i, 1, text).message for i, text in enumerate("abc")]))
+    assert connector["1"].misc == {"count": 3, "texts": ["a", "b", "c"]}
+
+
+def test_async_polling(async_bot, create_update, fake_runner):
+    batches = [[], [create_update(1, 1, "a"), create_update(2, 2, "b"), create_update(3, 1, "c")]]
+    sent = []
+    provider = AsyncPollingRequestProvider(async_bot)
+
+    async def get_updates(offset=None, **kwargs):
+        if not batches:
+            provider.stop()
+            return []
+        return batches.pop(0)
+
+    async def send_response(chat_id, response):
+        await asyncio.sleep(0.01 if response == "a" else 0)
+        sent.append((chat_id, response))
+
+    async def close_session():
+        pass
+
+    async_bot.get_updates = get_updates
+    async_bot.send_response = send_response
+    async_bot.close_session = close_session
+    provider.run(fake_runner())
+    assert [response for chat_id, response in sent if chat_id == "1"] == ["a", "c"]
+    assert sent[0] == ("2", "b")
+    assert provider.tasks_in_flight == 0
+
+
+@pytest.mark.parametrize(
+    "response,webhook_reply",
+    [
+        ("a", {"method": "sendMessage", "chat_id": "1", "text": "a"}),
+        ({"text": "a", "image": {"source": "https://example.com/image.png"}}, None),
+    ],
+)
+def test_asgi_webhook(async_bot, update_json, fake_runner, response, webhook_reply):
+    sent = []
+
+    async def send_response(chat_id, response):
+        sent.append(chat_id)
+
+    async_bot.send_response = send_response
+    app = ASGIWebhookRequestProvider(async_bot).get_app(fake_runner(lambda update: response))
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": json.dumps(update_json(1, 1, "text")).encode()}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "path": "/dff-bot", "method": "POST", "headers": [(b"content-type", b"application/json")]}
+    asyncio.run(app(scope, receive, send))
+    assert messages[0]["status"] == 200
+    assert json.loads(messages[1]["body"] or "null") == webhook_reply
+    assert sent == ([] if webhook_reply else ["1"])
+
+
+def test_asgi_webhook_error(async_bot, update_json, fake_runner):
+    def respond(update):
+        raise RuntimeError("actor failed")
+
+    app = ASGIWebhookRequestProvider(async_bot).get_app(fake_runner(respond))
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": json.dumps(update_json(1, 1, "text")).encode()}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "path": "/dff-bot", "method": "POST", "headers": [(b"content-type", b"application/json")]}
+    asyncio.run(app(scope, receive, send))
+    assert messages[0]["status"] == 200
+    assert messages[1]["body"] == b""
@@ -0,0 +1,103 @@
+from pathlib import Path
+
+import pytest
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+
+from dff_telegram_connector.basic_connector import DFFBot
+from dff_telegram_connector.cache import MemoryFileIdCache, ShelveFileIdCache, get_cache_key
+from dff_telegram_connector.types import TelegramResponse
+
+KITTEN = Path(__file__).parent.parent / "examples" / "pictures" / "kitten.jpg"
+
+
+def create_photo_message(file_id: str):
+    return types.Message.de_json(
+        {
+            "message_id": 1,
+            "chat": {"id": 1, "type": "private"},
+            "date": 0,
+            "photo": [
+                {"file_id": "small", "file_unique_id": "small", "width": 1, "height": 1},
+                {"file_id": file_id, "file_unique_id": file_id, "width": 2, "height": 2},
+            ],
+        }
+    )
+
+
+def test_cache_key(tmp_path):
+    image = tmp_path / "image.jpg"
+    image.write_bytes(b"1")
+    key = get_cache_key(image)
+    assert key == get_cache_key(image)
+    image.write_bytes(b"22")
+    assert key != get_cache_key(image)
+    assert get_cache_key("https://example.com/1.jpg") == "url:https://example.com/1.jpg"
+    assert get_cache_key(b"data") is None
+
+
+def test_memory_cache_eviction():
+    cache = MemoryFileIdCache(maxsize=2)
+    for index in range(3):
+        cache.set(f"https://example.com/{index}.jpg", str(index))
+    assert len(cache) == 2
+    assert cache.get("https://example.com/0.jpg") is None
+    assert cache.get("https://example.com/2.jpg") == "2"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_shelve_cache(tmp_path):
+    cache = ShelveFileIdCache(str(tmp_path / "cache"))
+    cache.set(KITTEN, "kitten")
+    cache.close()
+    assert ShelveFileIdCache(str(tmp_path / "cache")).get(KITTEN) == "kitten"
+
+
+def test_file_id_reuse():
+    bot = DFFBot("1:test", threaded=False, file_cache=MemoryFileIdCache())
+    sent_photos = []
+
+    def send_photo(chat_id, photo, **kwargs):
+        sent_photos.append(photo)
+        return create_photo_message("kitten_id")
+
+    bot.send_photo = send_photo
+    bot.send_message = lambda *args, **kwargs: None
+    response = TelegramResponse(text="kitten", image={"source": KITTEN})
+    bot.send_response(1, response)
+    bot.send_response(1, response)
+    assert not isinstance(sent_photos[0], str)
+    assert sent_photos[1] == "kitten_id"
+
+
+@pytest.mark.parametrize(
+    "error_code,description,reupload",
+    [
+        (400, "Bad Request: wrong file identifier/HTTP URL specified", True),
+        (403, "Forbidden: bot was blocked by the user", False),
+        (429, "Too Many Requests: retry after 5", False),
+    ],
+)
+def test_file_id_fallback(error_code, description, reupload):
+    cache = MemoryFileIdCache()
+    cache.set(KITTEN, "kitten_id")
+    bot = DFFBot("1:test", threaded=False, file_cache=cache)
+    sent_photos = []
+    error = ApiTelegramException("sendPhoto", None, {"error_code": error_code, "description": description})
+
+    def send_photo(chat_id, photo, **kwargs):
+        sent_photos.append(photo)
+        if photo == "kitten_id":
+            raise error
+        return create_photo_message("new_kitten_id")
+
+    bot.send_photo = send_photo
+    bot.send_message = lambda *args, **kwargs: None
+    response = TelegramResponse(text="kitten", image={"source": KITTEN})
+    if reupload:
+        bot.send_response(1, response)
+        assert len(sent_photos) == 2 and cache.get(KITTEN) == "new_kitten_id"
+    else:
+        with pytest.raises(ApiTelegramException):
+            bot.send_response(1, response)
+        assert sent_photos == ["kitten_id"] and cache.get(KITTEN) == "kitten_id"
@@ -1,5 +1,7 @@
+import pickle
 import pytest
 import sys
+import time
 
 from telebot import types
 from telebot import TeleBot
@@ -7,7 +9,15 @@ from df_engine.core.context import Context
 
 sys.path.insert(0, "../")
 
-from dff_telegram_connector.basic_connector import DatabaseMiddleware
+from dff_telegram_connector.basic_connector import DatabaseMiddleware, DFFBot
+from dff_telegram_connector.utils import (
+    get_initial_context,
+    get_initial_context_factory,
+    get_turn_cache,
+    get_user_id,
+    set_state,
+    unwrap_update,
+)
 from examples.basic_bot import bot as basic_bot
 from examples.middleware import bot as wired_bot
 
@@ -52,6 +62,44 @@ def test_query_handling(query, expected, actor_instance):
     assert condition(context, actor_instance) == False
 
 
+USER = {"id": 7, "is_bot": False, "first_name": "test"}
+POLL = {
+    "id": "42",
+    "question": "?",
+    "options": [],
+    "total_voter_count": 0,
+    "is_closed": False,
+    "is_anonymous": True,
+    "type": "regular",
+    "allows_multiple_answers": False,
+}
+
+
+@pytest.mark.parametrize(
+    "update_json,expected_type,expected_id",
+    [
+        (
+            {"message": {"message_id": 1, "from": USER, "chat": {"id": 7, "type": "private"}, "date": 0, "text": "hi"}},
+            types.Message,
+            "7",
+        ),
+        (
+            {"channel_post": {"message_id": 1, "chat": {"id": -100, "type": "channel"}, "date": 0, "text": "hi"}},
+            types.Message,
+            "-100",
+        ),
+        ({"callback_query": {"id": "1", "from": USER, "chat_instance": "1", "data": "4"}}, types.CallbackQuery, "7"),
+        ({"poll": POLL}, types.Poll, "42"),
+        ({"poll_answer": {"poll_id": "42", "user": USER, "option_ids": [0]}}, types.PollAnswer, "7"),
+    ],
+)
+def test_unwrap_update(update_json, expected_type, expected_id):
+    update = types.Update.de_json({"update_id": 1, **update_json})
+    ctx_id, inner_update = unwrap_update(update)
+    assert isinstance(inner_update, expected_type)
+    assert ctx_id == get_user_id(inner_update) == expected_id
+
+
 @pytest.mark.parametrize("update", [create_text_message("some message"), create_query("some query")])
 def test_middleware(update):
     connector = dict()
@@ -63,3 +111,94 @@ def test_middleware(update):
     middleware.post_process(update, data)
     assert len(connector) == 1
     assert update.from_user.id in connector
+
+
+def test_condition_index(actor_instance):
+    start = basic_bot.cnd.message_handler(commands=["start"])
+    photo = basic_bot.cnd.message_handler(content_types=["photo"])
+    text = basic_bot.cnd.message_handler(content_types=["text"], func=lambda msg: msg.text.startswith("/"))
+    query = basic_bot.cnd.callback_query_handler(func=lambda call: True)
+    context = set_state(get_initial_context("1"), create_text_message("/start"))
+    results = [condition(context.copy(deep=True), actor_instance) for condition in (start, photo, text, query)]
+    assert results == [True, False, True, False]
+    assert get_turn_cache(context)["update_key"] == (types.Message, "text", "start")
+    context = set_state(context, create_query("data"))
+    assert "update_key" not in get_turn_cache(context)
+    assert [condition(context, actor_instance) for condition in (start, query)] == [False, True]
+
+
+def test_condition_index_is_bounded(actor_instance):
+    bot = DFFBot("1:test", threaded=False)
+    start = bot.cnd.message_handler(commands=["start"])
+    text = bot.cnd.message_handler(content_types=["text"])
+    for command in ["/start", "/random_1", "/random_2", "/random_3"]:
+        context = set_state(get_initial_context("1"), create_text_message(command))
+        assert start(context, actor_instance) == (command == "/start") and text(context, actor_instance)
+    assert set(bot.cnd._index) == {(types.Message, "text", "start"), (types.Message, "text", None)}
+
+
+def test_filter_memoization(actor_instance):
+    calls = []
+
+    def func(msg):
+        calls.append(msg)
+        return True
+
+    conditions = [basic_bot.cnd.message_handler(commands=["start", "help"], func=func) for _ in range(2)]
+    conditions.append(basic_bot.cnd.message_handler(commands=["help", "start"], func=func))
+    hits, misses = basic_bot.cnd.cache_hits, basic_bot.cnd.cache_misses
+    context = set_state(get_initial_context("1"), create_text_message("/help"))
+    assert all(condition(context.copy(deep=True), actor_instance) for condition in conditions)
+    assert len(calls) == 1
+    assert (basic_bot.cnd.cache_hits - hits, basic_bot.cnd.cache_misses - misses) == (2, 1)
+    context = set_state(context, create_text_message("/help"))
+    assert conditions[0](context, actor_instance)
+    assert len(calls) == 2
+
+
+def test_turn_cache_is_not_stored(actor_instance):
+    condition = basic_bot.cnd.message_handler(func=lambda msg: True)
+    context = set_state(get_initial_context("1"), create_text_message("text"))
+    assert condition(context.copy(deep=True), actor_instance)
+    restored = pickle.loads(pickle.dumps(context))
+    assert get_turn_cache(restored) is not None
+    assert get_turn_cache(set_state(get_initial_context("1"), create_text_message("next"))) is not None
+    assert get_turn_cache(restored) is None
+
+
+def test_initial_context():
+    first, second = get_initial_context_factory("1")(), get_initial_context("2")
+    first.add_request("text")
+    first.framework_states["TELEGRAM_CONNECTOR"]["data"] = "update"
+    assert first.id == "1" and second.id == "2"
+    assert second.requests == {}
+    assert second.framework_states == {"TELEGRAM_CONNECTOR": {"keep_flag": True, "data": None}}
+
+
+poll_answer = types.PollAnswer.de_json(
+    {"poll_id": "1", "user": {"id": 1, "is_bot": False, "first_name": "test"}, "option_ids": [0]}
+)
+
+
+@pytest.mark.parametrize(
+    "update_type,process,update",
+    [("message", "messages", create_text_message("text")), ("poll_answer", "poll_answer", poll_answer)],
+)
+def test_threaded_middleware(update_type, process, update):
+    connector = dict()
+    bot = DFFBot("1:test", db_connector=connector, threaded=True, num_threads=4)
+
+    def handler(update, data):
+        count = data["context"].misc.get("count", 0)
+        time.sleep(0.05)
+        data["context"].misc["count"] = count + 1
+
+    getattr(bot, f"{update_type}_handler")(func=lambda update: True)(handler)
+
+    for _ in range(3):
+        getattr(bot, f"process_new_{process}")([update])
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and connector.get("1", Context()).misc != {"count": 3}:
+        time.sleep(0.01)
+    assert connector["1"].misc == {"count": 3}
+    bot.worker_pool.close()
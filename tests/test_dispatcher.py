@@ -0,0 +1,76 @@
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from queue import Full
+
+import pytest
+
+from dff_telegram_connector.dispatcher import UserDispatcher
+
+
+def test_same_user_order():
+    dispatcher = UserDispatcher(max_workers=4)
+    results = []
+
+    def task(value):
+        time.sleep(0.01 * (5 - value))
+        results.append(value)
+
+    futures = [dispatcher.submit("user", task, value) for value in range(5)]
+    for future in futures:
+        future.result(timeout=5)
+    assert results == list(range(5))
+    assert dispatcher.queue_depth == 0
+    assert dispatcher.max_queue_depth == 5
+    dispatcher.shutdown()
+
+
+def test_different_users_in_parallel():
+    dispatcher = UserDispatcher(max_workers=2)
+    barrier = threading.Barrier(2, timeout=5)
+
+    futures = [dispatcher.submit(user, barrier.wait) for user in ("first", "second")]
+    assert dispatcher.active_keys <= 2
+    for future in futures:
+        future.result(timeout=5)
+    assert dispatcher.metrics()["queue_depth"] == 0
+    dispatcher.shutdown()
+
+
+def test_exception_propagation():
+    dispatcher = UserDispatcher(max_workers=1)
+
+    def fail():
+        raise ValueError("test")
+
+    future = dispatcher.submit("user", fail)
+    assert isinstance(future.exception(timeout=5), ValueError)
+    assert dispatcher.submit("user", lambda: 1).result(timeout=5) == 1
+    dispatcher.shutdown()
+
+
+def test_bounded_queue():
+    dispatcher = UserDispatcher(max_workers=1, max_pending=2)
+    release = threading.Event()
+
+    futures = [dispatcher.submit("user", release.wait, 5) for _ in range(2)]
+    with pytest.raises(Full):
+        dispatcher.submit("other", release.wait, 5)
+    assert not dispatcher.wait_for_capacity(timeout=0.01)
+    assert dispatcher.wait_for_capacity(3, timeout=0)
+    release.set()
+    assert dispatcher.wait_for_capacity(1, timeout=5)
+    for future in futures:
+        future.result(timeout=5)
+    metrics = dispatcher.metrics()
+    assert metrics["dropped"] == 1
+    assert metrics["completed"] == 2
+    assert 0 < metrics["latency_p50"] <= metrics["latency_p99"]
+    dispatcher.shutdown()
+
+
+def test_process_pool_is_rejected():
+    executor = ProcessPoolExecutor(1)
+    with pytest.raises(TypeError):
+        UserDispatcher(executor=executor)
+    executor.shutdown()
@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+from dff_telegram_connector.rate_limit import RateLimiter, TokenBucket
+
+
+def flood_error(retry_after: float):
+    result_json = {"error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": retry_after}}
+    return ApiTelegramException("sendMessage", None, result_json)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, capacity=2)
+    now = bucket.updated
+    assert bucket.reserve(now) == 0
+    assert bucket.reserve(now) == 0
+    assert bucket.reserve(now) == pytest.approx(0.1)
+    bucket.block(now + 1)
+    assert bucket.delay(now) == pytest.approx(1)
+
+
+def test_chat_limit():
+    limiter = RateLimiter(chat_rate=20, burst=1)
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.acquire(1)
+    limiter.acquire(2)
+    assert time.monotonic() - start >= 0.09
+    stats = limiter.stats()
+    assert stats["sent"] == 4
+    assert stats["delay_max"] > 0
+
+
+def test_priorities():
+    limiter = RateLimiter(global_rate=10)
+    limiter._global.tokens = -2
+    order = []
+
+    def send(chat_id, priority):
+        limiter.acquire(chat_id, priority)
+        order.append(priority)
+
+    threads = [threading.Thread(target=send, args=(chat_id, 5 - chat_id)) for chat_id in range(3)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join(5)
+    assert order == [3, 4, 5]
+
+
+def test_retry_after():
+    limiter = RateLimiter(max_retries=1)
+    errors = [flood_error(0.05)]
+
+    def send():
+        if errors:
+            raise errors.pop()
+        return "ok"
+
+    start = time.monotonic()
+    assert limiter.call(1, send) == "ok"
+    assert time.monotonic() - start >= 0.05
+    assert limiter.retries == 1
+
+    with pytest.raises(ApiTelegramException):
+        limiter.call(2, lambda: (_ for _ in ()).throw(flood_error(0)))
@@ -0,0 +1,162 @@
+import threading
+import time
+from queue import Full
+
+import pytest
+from flask import Flask
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+
+from dff_telegram_connector.basic_connector import DFFBot
+from dff_telegram_connector.dispatcher import UserDispatcher
+from dff_telegram_connector.request_provider import PollingRequestProvider, FlaskRequestProvider
+
+
+@pytest.fixture
+def polling_bot(create_update):
+    bot = DFFBot("1:test", threaded=False)
+    batches = [[], [create_update(1, 1, "a"), create_update(2, 2, "b")], [create_update(3, 1, "c")]]
+    sent = []
+    done = threading.Event()
+
+    def get_updates(offset=None, **kwargs):
+        return batches.pop(0) if batches else []
+
+    def send_response(chat_id, response):
+        sent.append((chat_id, response))
+        if len(sent) == 3:
+            done.set()
+            bot._TeleBot__stop_polling.set()
+
+    bot.get_updates = get_updates
+    bot.send_response = send_response
+    yield bot, sent, done
+
+
+@pytest.mark.parametrize(
+    "params", [{}, {"pipelined": True}, {"pipelined": True, "queue_size": 1, "dispatcher": UserDispatcher(2)}]
+)
+def test_polling(polling_bot, fake_runner, params):
+    bot, sent, done = polling_bot
+    provider = PollingRequestProvider(bot, interval=0.01, **params)
+    thread = threading.Thread(target=provider.run, args=(fake_runner(),), daemon=True)
+    thread.start()
+    assert done.wait(5)
+    thread.join(5)
+    assert bot.last_update_id == 3
+    assert [response for chat_id, response in sent if chat_id == "1"] == ["a", "c"]
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+@pytest.mark.parametrize("error_code", [429, 403])
+def test_polling_keeps_batch_after_error(polling_bot, fake_runner, pipelined, error_code):
+    bot, sent, done = polling_bot
+    send_response = bot.send_response
+    result_json = {"error_code": error_code, "description": "", "parameters": {}}
+    errors = [ApiTelegramException("sendMessage", None, result_json)]
+
+    def flooded_send_response(chat_id, response):
+        send_response(chat_id, response)
+        if errors:
+            raise errors.pop()
+
+    bot.send_response = flooded_send_response
+    provider = PollingRequestProvider(bot, interval=0.01, pipelined=pipelined)
+    thread = threading.Thread(target=provider.run, args=(fake_runner(),), daemon=True)
+    thread.start()
+    assert done.wait(5)
+    thread.join(5)
+    assert sent == [("1", "a"), ("2", "b"), ("1", "c")]
+    assert bot.last_update_id == 3
+
+
+def test_poll_update_is_not_answered(fake_runner):
+    bot = DFFBot("1:test", threaded=False)
+    sent = []
+    bot.send_response = lambda chat_id, response: sent.append(chat_id)
+    poll = {
+        "id": "5",
+        "question": "?",
+        "options": [],
+        "total_voter_count": 0,
+        "is_closed": False,
+        "is_anonymous": False,
+        "type": "regular",
+        "allows_multiple_answers": False,
+    }
+    poll_answer = {"poll_id": "5", "user": {"id": 1, "is_bot": False, "first_name": "test"}, "option_ids": [0]}
+    provider = PollingRequestProvider(bot)
+    provider._handle_update(fake_runner(), types.Update.de_json({"update_id": 1, "poll": poll}))
+    provider._handle_update(fake_runner(), types.Update.de_json({"update_id": 2, "poll_answer": poll_answer}))
+    assert sent == ["1"]
+
+
+def test_polling_drops_update_when_queue_is_full(polling_bot, fake_runner):
+    bot, sent, done = polling_bot
+    dispatcher = UserDispatcher(2)
+    submit = dispatcher.submit
+
+    def submit_or_drop(key, *args):
+        if key == "2":
+            raise Full("the queue is full")
+        return submit(key, *args)
+
+    dispatcher.submit = submit_or_drop
+    provider = PollingRequestProvider(bot, interval=0.01, dispatcher=dispatcher)
+    thread = threading.Thread(target=provider.run, args=(fake_runner(),), daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 5
+    while len(sent) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    bot._TeleBot__stop_polling.set()
+    thread.join(5)
+    dispatcher.shutdown()
+    assert sent == [("1", "a"), ("1", "c")]
+    assert provider.metrics()["dropped_updates"] == 1
+
+
+@pytest.mark.parametrize("lazy_updates", [False, True])
+def test_flask_queued_webhook(update_json, fake_runner, lazy_updates):
+    bot = DFFBot("1:test", threaded=False)
+    sent = []
+    release = threading.Event()
+
+    def send_response(chat_id, response):
+        release.wait(5)
+        sent.append((chat_id, response))
+
+    bot.send_response = send_response
+    bot.remove_webhook = bot.set_webhook = lambda *args, **kwargs: None
+    app = Flask(__name__)
+    app.run = lambda **kwargs: None
+    dispatcher = UserDispatcher(2, max_pending=2)
+    provider = FlaskRequestProvider(bot, app, dispatcher=dispatcher, lazy_updates=lazy_updates)
+    provider.run(fake_runner())
+
+    client = app.test_client()
+    for update_id, text in enumerate(["a", "b", "c"], start=1):
+        response = client.post("/dff-bot", json=update_json(update_id, 1, text))
+        assert response.status_code == 200
+    release.set()
+    dispatcher.shutdown()
+    assert sent == [("1", "a"), ("1", "b")]
+    assert provider.metrics()["dropped_updates"] == 1
+    assert bot.last_update_id == 3
+
+
+def test_polling_survives_flood_limit(polling_bot, fake_runner):
+    bot, sent, done = polling_bot
+    get_updates = bot.get_updates
+    errors = [ApiTelegramException("getUpdates", None, {"error_code": 429, "description": "", "parameters": {}})]
+
+    def flooded_get_updates(offset=None, **kwargs):
+        if errors and offset != -1:
+            raise errors.pop()
+        return get_updates(offset, **kwargs)
+
+    bot.get_updates = flooded_get_updates
+    provider = PollingRequestProvider(bot, interval=0.01)
+    thread = threading.Thread(target=provider.run, args=(fake_runner(),), daemon=True)
+    thread.start()
+    assert done.wait(5)
+    thread.join(5)
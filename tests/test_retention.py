@@ -0,0 +1,78 @@
+from df_engine.core import Context
+from df_runner import Runner
+
+from dff_telegram_connector.basic_connector import DatabaseMiddleware, DFFBot
+from dff_telegram_connector.request_provider import PollingRequestProvider
+from dff_telegram_connector.retention import RetentionPolicy, get_context_size
+from dff_telegram_connector import retention as retention_module
+from dff_telegram_connector.utils import get_initial_context_factory
+
+
+def create_context(turns: int):
+    ctx = Context(id="1")
+    for turn in range(turns):
+        ctx.add_request(f"request {turn}")
+        ctx.add_response(f"response {turn}")
+        ctx.add_label(("flow", f"node {turn}"))
+    return ctx
+
+
+def test_max_turns():
+    policy = RetentionPolicy(max_turns=3)
+    ctx = policy(create_context(10))
+    assert list(ctx.requests) == list(ctx.responses) == list(ctx.labels) == [7, 8, 9]
+    assert ctx.last_request == "request 9"
+    ctx.add_request("request 10")
+    assert list(policy(ctx).requests) == [8, 9, 10]
+    assert policy.stats() == {"trimmed": 8, "contexts": 1, "size_avg": 7.0, "size_max": 7}
+
+
+def test_predicate():
+    policy = RetentionPolicy(predicate=lambda ctx, index: index % 2 == 0)
+    ctx = policy(create_context(5))
+    assert list(ctx.requests) == [0, 2, 4]
+    assert get_context_size(ctx) == 9
+
+
+def test_max_age(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retention_module.time, "time", lambda: now[0])
+    policy = RetentionPolicy(max_age=60)
+    ctx = create_context(1)
+    for turn in range(1, 4):
+        policy(ctx)
+        now[0] += 40
+        ctx.add_request(f"request {turn}")
+    policy(ctx)
+    assert list(ctx.requests) == [2, 3]
+
+
+def test_middleware_retention():
+    connector = {}
+    middleware = DatabaseMiddleware(connector, RetentionPolicy(max_turns=1))
+    connector["1"] = create_context(5)
+    connector["1"].framework_states["TELEGRAM_CONNECTOR"] = {"keep_flag": True, "data": None}
+    data = {}
+
+    class Update:
+        from_user = type("User", (), {"id": 1})
+        text = "new"
+
+    middleware.pre_process(Update, data)
+    middleware.post_process(Update, data)
+    assert list(connector["1"].requests) == [5]
+
+
+def test_runner_retention(actor_instance, create_update):
+    runners = []
+    for retention in [None, RetentionPolicy(max_turns=3)]:
+        runner = Runner(actor=actor_instance)
+        PollingRequestProvider(DFFBot("1:test", threaded=False), retention=retention)._setup_runner(runner)
+        for update_id, text in enumerate(["/start", "/start", "/start", "/start", "/start"], start=1):
+            runner.request_handler("1", create_update(update_id, 1, text).message, get_initial_context_factory("1"))
+        runners.append(runner)
+    full, trimmed = runners[0]._db["1"], runners[1]._db["1"]
+    assert list(trimmed.requests) == [4, 5, 6, 7, 8, 9]
+    assert list(trimmed.responses) == list(trimmed.labels) == [2, 3, 4]
+    assert trimmed.labels == {index: full.labels[index] for index in [2, 3, 4]}
+    assert len(trimmed.framework_states["TELEGRAM_CONNECTOR"]["turns"]) == 3
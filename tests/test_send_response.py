@@ -0,0 +1,102 @@
+import threading
+
+import pytest
+from telebot import types
+
+from dff_telegram_connector.basic_connector import DFFBot, SendOrder
+from dff_telegram_connector.rate_limit import RateLimiter
+from dff_telegram_connector.types import MediaStream, TelegramResponse
+
+IMAGE_URL = "https://folklore.linghub.ru/api/gallery/300/23.JPG"
+
+
+@pytest.fixture
+def recording_bot():
+    def make_bot(**kwargs):
+        bot = DFFBot("1:test", threaded=False, **kwargs)
+        bot.calls = []
+        lock = threading.Lock()
+        # the media calls of a parallel policy pass the barrier only if all three of them run at the same time
+        overlap = threading.Barrier(3, timeout=5) if bot.send_order != SendOrder.SEQUENTIAL else None
+
+        def record(name, media=True):
+            def method(*args, **kwargs):
+                if media and overlap is not None:
+                    overlap.wait()
+                with lock:
+                    bot.calls.append((name, threading.current_thread().name))
+
+            return method
+
+        bot.send_photo = record("photo")
+        bot.send_video = record("video")
+        bot.send_location = record("location")
+        bot.send_message = record("text", media=False)
+        return bot
+
+    yield make_bot
+
+
+def create_response():
+    return TelegramResponse(
+        text="test",
+        image={"source": IMAGE_URL},
+        video={"source": IMAGE_URL},
+        location=types.Location(longitude=1.0, latitude=1.0),
+    )
+
+
+@pytest.mark.parametrize("send_order", [SendOrder.SEQUENTIAL, SendOrder.TEXT_LAST, "concurrent"])
+def test_send_order(recording_bot, send_order):
+    bot = recording_bot(send_order=send_order, send_workers=3)
+    bot.send_response(1, create_response())
+    bot.stop_bot()
+    names = [name for name, _ in bot.calls]
+    assert sorted(names) == ["location", "photo", "text", "video"]
+    if bot.send_order == SendOrder.SEQUENTIAL:
+        assert names == ["photo", "video", "location", "text"]
+        assert {thread for _, thread in bot.calls} == {threading.current_thread().name}
+    if bot.send_order == SendOrder.TEXT_LAST:
+        assert names[-1] == "text"
+
+
+def test_broadcast():
+    bot = DFFBot("1:test", threaded=False, rate_limiter=RateLimiter(global_rate=1000, chat_rate=1000))
+    photos, texts = [], []
+    lock = threading.Lock()
+
+    def send_photo(chat_id, photo, **kwargs):
+        with lock:
+            photos.append((chat_id, photo))
+        return types.Message.de_json(
+            {
+                "message_id": 1,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "private"},
+                "photo": [{"file_id": "photo-id", "file_unique_id": "1", "width": 1, "height": 1}],
+            }
+        )
+
+    def send_message(chat_id, text, reply_markup=None):
+        if chat_id == 3:
+            raise ValueError("blocked")
+        with lock:
+            texts.append((chat_id, reply_markup))
+
+    bot.send_photo, bot.send_message = send_photo, send_message
+    response = {"text": "news", "image": {"source": IMAGE_URL}, "ui": {"keyboard": types.ReplyKeyboardRemove()}}
+    progress = bot.broadcast_response(range(1, 6), response, workers=2)
+
+    assert photos[0] == (1, IMAGE_URL) and sorted(photos[1:]) == [(chat_id, "photo-id") for chat_id in range(2, 6)]
+    assert sorted(chat_id for chat_id, _ in texts) == [1, 2, 4, 5]
+    assert {markup for _, markup in texts} == {types.ReplyKeyboardRemove().to_json()}
+    assert list(progress.errors) == ["3"] and progress.stats()["delivered"] == 4
+
+    progress = bot.broadcast_response(range(1, 6), response, progress=progress)
+    assert len(photos) == 6 and "3" in progress.errors and progress.stats()["sent"] == 0
+
+    with pytest.raises(ValueError):
+        bot.broadcast_response([1, 2], {"text": "news", "image": {"source": iter([b"image"])}})
+    stream = MediaStream(iter([b"image"]), "news.png", key="news")
+    bot.broadcast_response([6, 7], {"text": "news", "image": {"source": stream}})
+    assert photos[6] == (6, stream) and photos[7] == (7, "photo-id")
@@ -0,0 +1,152 @@
+import json
+import pickle
+from copy import deepcopy
+
+import pytest
+from telebot import types
+
+from df_engine.core import Actor
+from df_engine.core.keywords import RESPONSE, TRANSITIONS
+import df_engine.conditions as cnd
+from df_runner import Runner
+
+from dff_telegram_connector.basic_connector import DFFBot
+from dff_telegram_connector.request_provider import PollingRequestProvider
+from dff_telegram_connector.serialization import (
+    JSONSerializer,
+    LazyUpdate,
+    MsgpackSerializer,
+    PickleSerializer,
+    loads_update,
+    msgpack,
+)
+from dff_telegram_connector.storage import SerializingConnector
+from dff_telegram_connector.types import MediaStream
+from dff_telegram_connector.utils import (
+    get_initial_context,
+    get_initial_context_factory,
+    get_update_class,
+    get_user_id,
+    set_state,
+)
+
+
+def create_context():
+    update = types.Update.de_json(
+        {
+            "update_id": 1,
+            "callback_query": {
+                "id": "1",
+                "from": {"id": 1, "is_bot": False, "first_name": "test"},
+                "chat_instance": "1",
+                "data": "yes",
+                "message": {
+                    "message_id": 1,
+                    "from": {"id": 2, "is_bot": True, "first_name": "bot"},
+                    "chat": {"id": 1, "type": "private"},
+                    "date": 0,
+                    "text": "question",
+                },
+            },
+        }
+    )
+    ctx = set_state(get_initial_context("1"), update.callback_query)
+    ctx.add_response({"text": "answer"})
+    ctx.add_label(("flow", "node"))
+    return ctx
+
+
+serializers = [PickleSerializer(), JSONSerializer(), JSONSerializer(compression="zlib"), PickleSerializer("lzma")]
+if msgpack is not None:
+    serializers.append(MsgpackSerializer(compression="zlib"))
+
+
+@pytest.mark.parametrize("serializer", serializers)
+def test_round_trip(serializer):
+    ctx = create_context()
+    restored = serializer.loads(serializer.dumps(ctx))
+    assert restored.last_request == ctx.last_request
+    assert restored.last_response == ctx.last_response
+    assert restored.last_label == ctx.last_label
+
+    update = restored.framework_states["TELEGRAM_CONNECTOR"]["data"]
+    assert isinstance(update, LazyUpdate)
+    assert update.data == "yes" and update.from_user.id == 1 and update.message.text == "question"
+    assert isinstance(update.materialize(), types.CallbackQuery)
+    assert pickle.loads(pickle.dumps(update)).data == "yes"
+
+
+@pytest.mark.parametrize("serializer", serializers)
+def test_runner_round_trip(serializer, actor_instance, create_update):
+    backend = {}
+    runner = Runner(actor=actor_instance, db=SerializingConnector(backend, serializer))
+    PollingRequestProvider(DFFBot("1:test", threaded=False))._setup_runner(runner)
+    for update_id, text in enumerate(["/start", "hello"], start=1):
+        message = create_update(update_id, 1, text).message
+        runner.request_handler("1", message, get_initial_context_factory("1"))
+    ctx = serializer.loads(backend["1"])
+    assert [get_update_class(request) for request in ctx.requests.values()] == [types.Message, str] * 2
+    assert ctx.requests[2].text == "hello" and ctx.requests[3] == "hello"
+    assert isinstance(ctx.requests[2], LazyUpdate)
+
+
+@pytest.mark.parametrize("serializer", serializers)
+def test_media_stream_in_context(serializer, create_update):
+    def stream_response(ctx, actor, *args, **kwargs):
+        return {"text": "chart", "image": {"source": MediaStream(iter([b"png"]), "chart.png", key="chart")}}
+
+    script = {"flow": {"node": {RESPONSE: stream_response, TRANSITIONS: {"node": cnd.true()}}}}
+    runner = Runner(actor=Actor(script, start_label=("flow", "node")))
+    PollingRequestProvider(DFFBot("1:test", threaded=False))._setup_runner(runner)
+    for update_id in range(1, 3):
+        ctx = runner.request_handler("1", create_update(update_id, 1, "hi").message, get_initial_context_factory("1"))
+    assert len(ctx.responses) == 2
+    stream = pickle.loads(pickle.dumps(ctx)).last_response["image"]["source"]
+    assert (stream.filename, stream.key) == ("chart.png", "chart")
+    with pytest.raises(ValueError):
+        stream.read()
+    assert serializer.loads(serializer.dumps(ctx)).last_response["text"] == "chart"
+
+
+def test_serializing_connector():
+    backend = {}
+    connector = SerializingConnector(backend, JSONSerializer(compression="zlib"))
+    connector["1"] = create_context()
+    connector.update({"2": create_context()})
+    assert isinstance(backend["1"], bytes)
+    assert connector["2"].last_request == "data"
+    stats = connector.stats()
+    assert stats["contexts"] == 2
+    assert stats["bytes_total"] == len(backend["1"]) + len(backend["2"])
+    assert len(pickle.dumps(create_context())) > stats["bytes_max"]
+
+
+def test_loads_update(actor_instance):
+    raw = {
+        "update_id": 5,
+        "message": {
+            "message_id": 1,
+            "from": {"id": 7, "is_bot": False, "first_name": "test"},
+            "chat": {"id": 7, "type": "private"},
+            "date": 0,
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+    update_id, update = loads_update(json.dumps(raw).encode("utf-8"))
+    assert update_id == 5 and get_update_class(update) is types.Message and get_user_id(update) == "7"
+
+    bot = DFFBot("1:test", threaded=False)
+    start = bot.cnd.message_handler(commands=["start"], chat_types=["private"])
+    query = bot.cnd.callback_query_handler(func=lambda call: True)
+    ctx = set_state(get_initial_context("7"), update)
+    assert ctx.last_request == "/start"
+    assert start(deepcopy(ctx), actor_instance) and not query(deepcopy(ctx), actor_instance)
+    assert update._update is None
+
+    assert update.entities[0].type == "bot_command"
+    assert isinstance(update.materialize(), types.Message)
+
+    raw["message"]["text"] = "hello"
+    _, update = loads_update(json.dumps(raw))
+    assert update.caption is None and not hasattr(update, "data") and update._update is None
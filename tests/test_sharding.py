@@ -0,0 +1,45 @@
+import multiprocessing
+from collections import Counter
+
+import pytest
+
+from dff_telegram_connector.sharding import ShardPool, get_shard
+
+
+def test_get_shard():
+    users = [str(user_id) for user_id in range(1000)]
+    shards = {user: get_shard(user, 4) for user in users}
+    assert all(get_shard(user, 4) == shard for user, shard in shards.items())
+    assert min(Counter(shards.values()).values()) > 150
+
+    moved = [user for user in users if get_shard(user, 5) != shards[user]]
+    assert all(get_shard(user, 5) == 4 for user in moved)
+    assert len(moved) < 300
+
+
+class FakeBot:
+    def __init__(self, replies):
+        self.replies = replies
+
+    def send_response(self, chat_id, response):
+        self.replies.put((multiprocessing.current_process().name, chat_id, response))
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="fork is not available")
+def test_shard_pool(fake_runner):
+    context = multiprocessing.get_context("fork")
+    replies = context.Queue()
+    shards = ShardPool(lambda: (fake_runner(), FakeBot(replies)), workers=2, start_method="fork")
+    for update in range(5):
+        for user in ("1", "2", "3"):
+            shards.submit(user, update)
+    shards.resize(3)
+    shards.submit("1", 5)
+    shards.shutdown()
+
+    results = [replies.get(timeout=5) for _ in range(16)]
+    for user in ("1", "2", "3"):
+        user_results = [result for result in results if result[1] == user]
+        assert [response for _, _, response in user_results] == list(range(6 if user == "1" else 5))
+        assert len({process for process, _, _ in user_results[:5]}) == 1
+    assert shards.workers == 0
@@ -0,0 +1,85 @@
+from dff_telegram_connector.storage import DeltaConnector, WriteBehindConnector
+from dff_telegram_connector.utils import get_initial_context
+
+
+class CountingDict(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.updates = 0
+        self.reads = 0
+
+    def update(self, *args, **kwargs):
+        self.updates += 1
+        super().update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return super().__getitem__(key)
+
+
+def test_write_behind_batches():
+    backend = CountingDict()
+    connector = WriteBehindConnector(backend, flush_interval=None, flush_threshold=3)
+    connector["1"] = 1
+    connector["1"] = 2
+    connector["2"] = 1
+    assert backend == {}
+    assert connector["1"] == 2
+    connector["3"] = 1
+    assert backend == {"1": 2, "2": 1, "3": 1}
+    assert backend.updates == 1
+    connector.close()
+
+
+def test_write_behind_cache_and_delete():
+    backend = CountingDict({"1": 1, "2": 2})
+    connector = WriteBehindConnector(backend, cache_size=1, flush_interval=None)
+    assert connector["1"] == 1
+    assert connector["1"] == 1
+    assert backend.reads == 1
+    assert connector.get("2") == 2
+    assert len(connector._cache) == 1
+    del connector["1"]
+    assert "1" not in connector
+    assert connector.get("1") is None
+    assert "1" in backend
+    connector.close()
+    assert backend == {"2": 2}
+
+
+def test_write_behind_timer():
+    backend = CountingDict()
+    with WriteBehindConnector(backend, flush_interval=0.01) as connector:
+        connector["1"] = 1
+        for _ in range(100):
+            if backend:
+                break
+            connector._flush_requested.wait(0.01)
+        assert backend == {"1": 1}
+        connector["2"] = 2
+    assert backend == {"1": 1, "2": 2}
+
+
+def test_delta_connector():
+    backend = {}
+    connector = DeltaConnector(backend, compact_every=3)
+    ctx = get_initial_context("1")
+    for turn in range(6):
+        ctx = connector.get("1", ctx)
+        ctx.add_request(f"request {turn}")
+        ctx.add_response(f"response {turn}")
+        ctx.misc["turn"] = turn
+        connector["1"] = ctx
+
+    assert connector.stats() == {"snapshots": 2, "deltas": 4}
+    assert backend["1"]["generation"] == 1
+    assert sorted(backend) == ["1", "1:delta:1:1"]
+    assert backend["1:delta:1:1"]["appended"]["requests"] == {5: "request 5"}
+
+    restored = DeltaConnector(backend)["1"]
+    assert restored.requests == ctx.requests
+    assert restored.misc == {"turn": 5}
+    assert list(DeltaConnector(backend)) == ["1"]
+
+    del connector["1"]
+    assert backend == {}
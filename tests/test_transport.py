@@ -0,0 +1,129 @@
+import json
+import threading
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+
+from dff_telegram_connector.basic_connector import DFFBot
+from dff_telegram_connector.transport import MultipartBody, Transport, unregister_transport
+from dff_telegram_connector.types import MediaStream, TelegramResponse
+
+MESSAGE = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "hi"}
+
+
+class BotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    uploads = []
+    methods = []
+    statuses = []
+
+    def read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding") != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b""
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            body += self.rfile.read(size)
+            self.rfile.readline()
+            if size == 0:
+                return body
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.headers.get("Content-Type", "").startswith("multipart/form-data"):
+            self.uploads.append((dict(self.headers), body))
+        self.methods.append(self.path.split("?")[0].rsplit("/", 1)[-1])
+        status = self.statuses.pop() if self.statuses else 200
+        if status == 200:
+            body = json.dumps({"ok": True, "result": MESSAGE}).encode("utf-8")
+        else:
+            body = json.dumps({"ok": False, "error_code": status, "description": "Bad Gateway"}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BotApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = apihelper.API_URL
+    apihelper.API_URL = f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}"
+    yield
+    apihelper.API_URL = api_url
+    server.shutdown()
+
+
+def test_shared_pool(api_url):
+    transport = Transport(pool_size=2, timeouts={"sendMessage": (1, 2)})
+    bot = DFFBot("1:transport", threaded=False, transport=transport)
+    try:
+        threads = [threading.Thread(target=lambda: [bot.send_message(1, "hi") for _ in range(5)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = transport.stats()
+        assert stats["requests"] == stats["methods"]["sendMessage"] == 20
+        assert 0 < stats["connections"] <= 2
+        assert stats["reused"] == 20 - stats["connections"] and stats["reuse_ratio"] >= 0.9
+        assert transport.get_timeout("sendMessage", 25) == (1, 2) and transport.get_timeout("getMe", 25) == 25
+    finally:
+        unregister_transport(bot.token)
+        transport.close()
+    assert apihelper.CUSTOM_REQUEST_SENDER is None
+
+
+def test_status_retries(api_url):
+    transport = Transport(backoff_factor=0, default_timeout=5)
+    bot = DFFBot("1:retry", threaded=False, transport=transport)
+    BotApiHandler.methods.clear()
+    try:
+        BotApiHandler.statuses[:] = [502, 502]
+        assert apihelper.get_me(bot.token) == MESSAGE
+        BotApiHandler.statuses[:] = [502]
+        with pytest.raises(ApiTelegramException):
+            bot.send_message(1, "hi")
+    finally:
+        BotApiHandler.statuses.clear()
+        unregister_transport(bot.token)
+        transport.close()
+    assert BotApiHandler.methods == ["getMe"] * 3 + ["sendMessage"]
+    assert transport.get_timeout("getUpdates", 25) == 25 and transport.get_timeout("getMe", 25) == 5
+
+
+def test_streamed_upload(api_url):
+    transport = Transport(chunk_size=4)
+    bot = DFFBot("1:stream", threaded=False, transport=transport)
+    BotApiHandler.uploads.clear()
+    try:
+        chunks = (f"chunk{i};".encode("utf-8") for i in range(3))
+        bot.send_response(1, TelegramResponse(text="hi", document={"source": chunks}))
+        bot.send_response(1, TelegramResponse(text="hi", image={"source": MediaStream(b"image", "cat.png")}))
+    finally:
+        unregister_transport(bot.token)
+        transport.close()
+    (document_headers, document), (image_headers, image) = BotApiHandler.uploads
+    assert document_headers["Transfer-Encoding"] == "chunked"
+    assert b'name="document"; filename="file"' in document and b"chunk0;chunk1;chunk2;" in document
+    assert int(image_headers["Content-Length"]) == len(image)
+    assert b'filename="cat.png"\r\nContent-Type: image/png' in image and b"\r\n\r\nimage\r\n" in image
+
+
+def test_multipart_body_replay():
+    body = MultipartBody({"photo": BytesIO(b"data")})
+    assert b"".join(body) == b"".join(body) and len(b"".join(body)) == body.len
+    body = MultipartBody({"photo": MediaStream(iter([b"data"]))})
+    assert body.len is None and b"data" in b"".join(body)
+    with pytest.raises(RuntimeError):
+        list(body)